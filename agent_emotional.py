@@ -1,13 +1,12 @@
+import hashlib
 import re
-import time
-from datetime import datetime
 
 import numpy as np
-from sentence_transformers import SentenceTransformer
-from sklearn.preprocessing import minmax_scale
 
-from config import get_depth
-from llm_base import send_message
+from config import get_depth, memory_budget, memory_consolidation_group
+from embedding_model import get_embedding_service
+from llm_base import parse_json_response, send_message
+from memory_stream import MemoryStream
 from tweet import Tweet
 from utils import Memory
 
@@ -16,8 +15,8 @@ class Agent:
     def __init__(self, name, occupation, experience, character, interest, global_context):
         self.name = name
         self.global_context = global_context
-        self.experiences = {}
-        self.memory_model = SentenceTransformer('./Models/all-MiniLM-L6-v2')
+        self.experiences = MemoryStream()
+        self.memory_model = get_embedding_service()
         self.alpha_recency = 1
         self.alpha_importance = 1
         self.alpha_relevance = 1
@@ -26,6 +25,11 @@ class Agent:
         self.feelings = {}
         self.mood = ""
         self.online = True
+        self.rng = np.random
+        # structured 模式下缓存的 (mood, response_type, expression_form)，心情变化后重新生成
+        self._expression = None
+        # 已合并为摘要、等待下次保存时写入归档文件的原始记忆
+        self.archived_memories = []
         self.occupation = occupation
         self.experience = experience
         self.character = character
@@ -33,12 +37,20 @@ class Agent:
 
         self.identity_info = f"{self.occupation}, {self.experience}, {self.character}, {self.interest}"
 
+    @property
+    def experiences(self):
+        return self._experiences
+
+    @experiences.setter
+    def experiences(self, memories):
+        self._experiences = memories if isinstance(memories, MemoryStream) else MemoryStream(memories)
+        self._experiences.mark_clean()
+
     def observe(self, f_content, event_time, content_hash):
         content = f'At {event_time}, {f_content}'
         importance, emotion_type, emotion_intensity = self.calculate_importance_and_emotion(content)
 
         memory = Memory(content, importance, event_time, emotion_type, emotion_intensity)
-        memory.update_embedding(self.memory_model)
         self.experiences[content_hash] = memory
 
         like_prompt = (
@@ -50,7 +62,9 @@ class Agent:
         if content_hash not in self.experiences or self.experiences[content_hash].emotion_intensity > 4:
             like_response = send_message(
                 f'You are {self.name}, {self.identity_info}. Only output YES or NO, do not output any other word',
-                like_prompt
+                like_prompt,
+                use_cache=False,
+                label='like'
             ).strip().upper()
 
         if 'YES' in like_response:
@@ -58,14 +72,11 @@ class Agent:
             self.like_event(content_hash)
 
     def like_event(self, content_hash):
-        for tweet in self.global_context.tweet_log:
-            if tweet.hash_id == content_hash:
-                tweet.like(self.name)
-                break
+        self.global_context.like_tweet(content_hash, self.name)
 
     def reflect(self, current_event="No Event", person=False):
         print(f"make a reflect to: {current_event}")
-        recent_memories = list(self.experiences.values())[-25:]
+        recent_memories = self.experiences.recent(25)
         memory_texts = [
             f"{mem.content} (your emotion: {mem.emotion_type}, intensity: {mem.emotion_intensity})"
             for mem in recent_memories
@@ -75,7 +86,8 @@ class Agent:
         question_prompt = (f'Lastly, some things have happened'
                            f': {memory_text_block}\nBased on the above statements, what do you want to know about '
                            f'other individual person? You can ask 3 questions with 1 lines of text.\n')
-        questions_response = send_message(f"You are {self.name}, {self.identity_info}", question_prompt).strip()
+        questions_response = send_message(f"You are {self.name}, {self.identity_info}", question_prompt,
+                                          use_cache=False, label='reflect_questions').strip()
         questions = questions_response.split("\n")
 
         reflections = []
@@ -93,7 +105,7 @@ class Agent:
                               f'only output 1 line text as answer to the question.')
             insights_response = send_message(
                 f"You are {self.name}, {self.identity_info}. Please answer the question with 1 line text",
-                insight_prompt).strip()
+                insight_prompt, use_cache=False, label='reflect_insight').strip()
             insights = insights_response.split("\n")
 
             for insight in insights:
@@ -115,7 +127,8 @@ class Agent:
             feeling_response = send_message(
                 f'You are {self.name}, {self.identity_info}. '
                 'Respond with a feeling word and a score (0-10), separated by a comma. For example: Happy,4',
-                feeling_prompt
+                feeling_prompt,
+                label='feeling'
             ).strip()
 
             try:
@@ -138,7 +151,8 @@ class Agent:
             feeling_response = send_message(
                 f'You are {self.name}, {self.identity_info}. '
                 'Respond with a feeling word and a score (0-10), separated by a comma. For example: Happy,4',
-                feeling_prompt
+                feeling_prompt,
+                label='feeling'
             ).strip()
             try:
                 feeling_word, feeling_score = feeling_response.split(',')
@@ -157,7 +171,7 @@ class Agent:
         mood_response = send_message(
             f'You are {self.name}, {self.identity_info}.'
             f'Please describe your current mood in one sentence.',
-            mood_prompt).strip()
+            mood_prompt, use_cache=False, label='mood').strip()
         self.mood = mood_response
         # print(f"{self.name} mood: {mood_response}")
 
@@ -166,6 +180,12 @@ class Agent:
     def text_tuning(self, content, feeling_info, mood):
         content.replace("NULLUSER", "")
         feeling_info.replace("NULLUSER", "")
+        if self.global_context.text_tuning_mode == 'structured':
+            rephrased_message = self.structured_text_tuning(content, mood)
+            if rephrased_message is not None:
+                return rephrased_message
+            print("Structured text tuning failed, falling back to the three-call chain")
+
         # First send_message: Determine kind or malicious response
         system_message = (
             f"Answer concisely in only one word."
@@ -178,7 +198,8 @@ class Agent:
 
         response_type = send_message(
             system_message,
-            user_message
+            user_message,
+            label='tuning_attitude'
         ).strip().lower()
 
         response_type = 'kindly' if 'kindly' in response_type else 'maliciously'
@@ -198,7 +219,8 @@ class Agent:
 
         expression_form = send_message(
             system_message,
-            user_message
+            user_message,
+            label='tuning_form'
         ).strip().replace("I", "you").replace("my", "your")
 
         print(f"\nexpression_form:{expression_form}\n")
@@ -214,18 +236,77 @@ class Agent:
             f"Expression form: {expression_form}. "
             f"Based on the personality and current mood of {self.name}, create a new text to replace the following "
             f"text to better reflect {self.name}'s unique personality and current state: {content}\n\n"
-            f"Follow the random seed: {3041 * np.random.rand()}-{751 * np.random.rand()}-{6235 * np.random.rand()}"
+            f"Follow the random seed: {3041 * self.rng.rand()}-{751 * self.rng.rand()}-{6235 * self.rng.rand()}"
         )
 
         rephrased_message = send_message(
             system_message,
-            user_message
+            user_message,
+            use_cache=False,
+            label='tuning_rephrase'
         ).strip()
 
         print(f"original:{content} \ntuning:{rephrased_message}\n\n")
 
         return rephrased_message.replace('"', '').replace("'", "")
 
+    def structured_text_tuning(self, content, mood):
+        # 一次调用同时得到回应倾向、表达方式和改写结果；表达方式只取决于身份和心情，心情不变时直接复用
+        expression = self._expression if self._expression is not None and self._expression[0] == mood else None
+        seed = f"{3041 * self.rng.rand()}-{751 * self.rng.rand()}-{6235 * self.rng.rand()}"
+
+        if expression is not None:
+            _, response_type, expression_form = expression
+            system_message = (
+                f'Only output a JSON object with the key "text", don\'t output any other words. '
+                f"Keep the text very {'short (5-10 words is acceptable)' if 'short' in expression_form else 'long'}. "
+                f"Imitate internet slang, free for ignoring punctuation like in Internet."
+            )
+            user_message = (
+                f"This is {self.name}. {self.identity_info}. Current mood: '{mood}'. "
+                f"Typically responds {response_type}. Expression form: {expression_form}. "
+                f"Based on the personality and current mood of {self.name}, create a new text to replace the "
+                f"following text to better reflect {self.name}'s unique personality and current state: {content}\n\n"
+                f"Follow the random seed: {seed}"
+            )
+        else:
+            system_message = (
+                'Only output a JSON object with the keys "response_type", "expression_form" and "text", '
+                "don't output any other words. Imitate internet slang, free for ignoring punctuation like in Internet."
+            )
+            user_message = (
+                f"This is {self.name}. {self.identity_info}. Current mood: '{mood}'.\n"
+                f"response_type: Considering the personality and current mood of {self.name}, would this person "
+                f"respond kindly or maliciously? Exaggerate the feeling. Indicate 'kindly' or 'maliciously'.\n"
+                f"expression_form: How would this person express themselves online? "
+                f"Would it be through sarcasm, an interesting joke, dark humors or another form of expression? "
+                f"Would they use vulgar language and emojis to enhance the expression? "
+                f"Would they use other elements of popular internet culture? "
+                f"if their tweet always very short (5-10 words is acceptable), or very long? "
+                f"Specify the form, avoiding words like 'possibly' or 'maybe' that indicate uncertainty.\n"
+                f"text: Following that response type and expression form (very short if the form is short, "
+                f"otherwise long), create a new text to replace the following text to better reflect "
+                f"{self.name}'s unique personality and current state: {content}\n\n"
+                f"Follow the random seed: {seed}"
+            )
+
+        response = send_message(system_message, user_message, use_cache=False, label='tuning_structured',
+                                json_mode=True)
+        data = parse_json_response(response)
+        if data is None or not isinstance(data.get('text'), str) or not data['text'].strip():
+            return None
+
+        if expression is None:
+            response_type = 'kindly' if 'kindly' in str(data.get('response_type', '')).lower() else 'maliciously'
+            expression_form = str(data.get('expression_form', '')).strip().replace("I", "you").replace("my", "your")
+            print(f"\nexpression_form:{expression_form}\n")
+            self._expression = (mood, response_type, expression_form)
+
+        rephrased_message = data['text'].strip()
+        print(f"original:{content} \ntuning:{rephrased_message}\n\n")
+
+        return rephrased_message.replace('"', '').replace("'", "")
+
     def post_tweet(self, query, hash_id):
 
         print(f'query:{query}')
@@ -237,28 +318,7 @@ class Agent:
         recent_text_block = "\n".join(memory_texts)
 
         print(f'recent_block:{recent_text_block}')
-        from_reply_hash_id = None
-        sender_name = ''
-        reply_to_self = False
-        is_reply_some = False
-        for tweet in self.global_context.tweet_log:
-            if tweet.hash_id == hash_id:
-                sender_name = tweet.author
-                if tweet.reply_to_hash_id:
-                    is_reply_some = True
-                    from_reply_hash_id = tweet.reply_to_hash_id
-                    for reply_tweet in self.global_context.tweet_log:
-                        if reply_tweet.hash_id == tweet.reply_to_hash_id and reply_tweet.author == self.name:
-                            reply_to_self = True
-                            break
-                break
-
-        if reply_to_self:
-            print(f"Message {hash_id} is a reply to {self.name}.")
-        elif is_reply_some:
-            print(f"Message {hash_id} is a reply but not a reply to {self.name}.")
-        else:
-            print(f"Message {hash_id} is not a reply.")
+        sender_name, from_reply_hash_id, reply_to_self, is_reply_some = self.reply_context(hash_id)
 
         feeling_info = ""
         if sender_name and sender_name in self.feelings:
@@ -284,7 +344,7 @@ class Agent:
             )
             initial_emotion_response = send_message(
                 f'You are {self.name}, {self.identity_info} ',
-                prompt).strip()
+                prompt, label='emotion').strip()
             try:
                 emotion_type, emotion_intensity_str = initial_emotion_response.split(',')
                 initial_emotion_intensity = float(re.search(r'\d*\.?\d+', emotion_intensity_str).group())
@@ -296,29 +356,10 @@ class Agent:
             self.experiences[hash_id] = Memory(query, 5, self.global_context.virtual_time.get_current_time(), emotion_type,
                                                initial_emotion_intensity)
 
-        if hash_id in self.experiences and self.experiences[hash_id].emotion_intensity == 0:
-            return "NO_TWEET", None
-
-        offset = 1
-        if reply_to_self:
-            offset = 0.3
-            print("增大回复概率")
-        elif is_reply_some:
-            offset = 3
-            print("减小回复概率")
-        else:
-            offset = 1
-
-        if np.random.rand() * offset > self.experiences[hash_id].emotion_intensity / 10:
-            self.experiences[hash_id].emotion_intensity *= 0.5
-            if offset == 3:
-                print(f"因为极大概率不回复，所以不回复")
+        if not self.should_respond(hash_id, reply_to_self, is_reply_some):
             return "NO_TWEET", None
 
-        if offset == 3:
-            print(f"虽然极大概率不回复，仍然回复")
-
-        if self.experiences[hash_id].emotion_intensity > np.random.rand() * 10 + 3:
+        if self.experiences[hash_id].emotion_intensity > self.rng.rand() * 10 + 3:
             self.reflect(query)
 
         summary_prompt = (
@@ -334,7 +375,7 @@ class Agent:
             f'You are {self.name}, {self.identity_info}. '
             f'Please summarize recent events and describe your current motivation based on the information provided. '
             f'For any significant events, be specific about who did what.',
-            summary_prompt).strip()
+            summary_prompt, label='motivation').strip()
 
         agreement_prompt = (
             f'Do you agree or disagree with the following statement: "{query}"? '
@@ -343,7 +384,8 @@ class Agent:
 
         agreement_response = send_message(
             f'You are {self.name}, {self.identity_info}',
-            agreement_prompt
+            agreement_prompt,
+            label='agreement'
         ).strip().lower()
 
         print(f"motivation_summary:{motivation_summary}")
@@ -376,8 +418,59 @@ class Agent:
             f"\n\nFill in blank: '@{sender_name} your_content' if you want to respond ov evaluate {sender_name},"
             f"{nus if not self.has_posted_new_tweet else ''}"
             ,
-            detail_prompt).strip().strip('()').strip('"').strip("'").replace('(', '').replace(')', '')
+            detail_prompt, label='tweet').strip().strip('()').strip('"').strip("'").replace('(', '').replace(')', '')
+
+        return self.publish_response(response, sender_name, feeling_info, hash_id)
+
+    def reply_context(self, hash_id):
+        from_reply_hash_id = None
+        sender_name = ''
+        reply_to_self = False
+        is_reply_some = False
+        tweet = self.global_context.get_tweet(hash_id)
+        if tweet is not None:
+            sender_name = tweet.author
+            if tweet.reply_to_hash_id:
+                is_reply_some = True
+                from_reply_hash_id = tweet.reply_to_hash_id
+                reply_tweet = self.global_context.get_tweet(tweet.reply_to_hash_id)
+                reply_to_self = reply_tweet is not None and reply_tweet.author == self.name
 
+        if reply_to_self:
+            print(f"Message {hash_id} is a reply to {self.name}.")
+        elif is_reply_some:
+            print(f"Message {hash_id} is a reply but not a reply to {self.name}.")
+        else:
+            print(f"Message {hash_id} is not a reply.")
+
+        return sender_name, from_reply_hash_id, reply_to_self, is_reply_some
+
+    def should_respond(self, hash_id, reply_to_self, is_reply_some):
+        if hash_id in self.experiences and self.experiences[hash_id].emotion_intensity == 0:
+            return False
+
+        offset = 1
+        if reply_to_self:
+            offset = 0.3
+            print("增大回复概率")
+        elif is_reply_some:
+            offset = 3
+            print("减小回复概率")
+        else:
+            offset = 1
+
+        if self.rng.rand() * offset > self.experiences[hash_id].emotion_intensity / 10:
+            self.experiences[hash_id].emotion_intensity *= 0.5
+            if offset == 3:
+                print(f"因为极大概率不回复，所以不回复")
+            return False
+
+        if offset == 3:
+            print(f"虽然极大概率不回复，仍然回复")
+        return True
+
+    def publish_response(self, response, sender_name, feeling_info, hash_id, new_emotion_intensity=None):
+        # new_emotion_intensity 为 None 时单独询问回复后的情绪强度（fused 模式已在决策调用中给出）
         if 'your_content' in response:
             return "NO_TWEET", None
 
@@ -402,36 +495,132 @@ class Agent:
         if self.has_posted_new_tweet and 'NULLUSER' in reply_response:
             return "NO_TWEET", None
 
-        new_hash_id = Tweet.generate_hash_id(detail_response, self.global_context.virtual_time.get_current_time())
+        new_hash_id = Tweet.generate_hash_id(detail_response, self.global_context.virtual_time.get_current_time(),
+                                             self.rng)
 
         tweet_content = detail_response.strip()
 
-        new_tweet = Tweet(tweet_content, self.name, self.global_context.virtual_time.advance(), False, new_hash_id)
+        # 发布时间在 publish_tweet 中推进虚拟时间后写入
+        new_tweet = Tweet(tweet_content, self.name, None, False, new_hash_id)
 
         action_description = f"{self.name} posted a new tweet: {new_tweet.content}"
         if is_reply:
             new_tweet.reply_to_hash_id = hash_id
-            new_emotion_prompt = (
-                f"You are {self.name}, {self.identity_info}. You have just replied to a tweet. "
-                f"Please provide a new emotion intensity between 0 and 10 for future tweets."
-            )
-            new_emotion_response = send_message(
-                'Please respond with a number between 0 and 10.',
-                new_emotion_prompt).strip()
-            try:
-                new_emotion_intensity = float(re.search(r'\d*\.?\d+', new_emotion_response).group())
+            if new_emotion_intensity is not None:
                 self.experiences[hash_id].emotion_intensity = new_emotion_intensity
-            except:
-                self.experiences[hash_id].emotion_intensity = 5
+            else:
+                new_emotion_prompt = (
+                    f"You are {self.name}, {self.identity_info}. You have just replied to a tweet. "
+                    f"Please provide a new emotion intensity between 0 and 10 for future tweets."
+                )
+                new_emotion_response = send_message(
+                    'Please respond with a number between 0 and 10.',
+                    new_emotion_prompt, label='reply_emotion').strip()
+                try:
+                    new_emotion_intensity = float(re.search(r'\d*\.?\d+', new_emotion_response).group())
+                    self.experiences[hash_id].emotion_intensity = new_emotion_intensity
+                except:
+                    self.experiences[hash_id].emotion_intensity = 5
 
             action_description = f"To respond thw tweet posted by {sender_name}, {action_description}"
         else:
             self.has_posted_new_tweet = True
 
-        self.global_context.tweet_log.append(new_tweet)
+        self.global_context.publish_tweet(new_tweet)
 
         return action_description, new_hash_id
 
+    def fused_react(self, query, event_time, hash_id, observe):
+        # 一次 JSON 调用完成 observe 和 post_tweet；响应无法使用时返回 None
+        print(f'query:{query}')
+        recent_memories = self.retrieve_relevant_memories(query)
+        recent_text_block = "\n".join(
+            f"{mem.content} (your emotion: {mem.emotion_type}, intensity: {mem.emotion_intensity})"
+            for mem in recent_memories
+        )
+        sender_name, from_reply_hash_id, reply_to_self, is_reply_some = self.reply_context(hash_id)
+
+        keys = ['importance', 'emotion_type', 'emotion_intensity', 'like', 'agreement']
+        feeling_info = ""
+        known_sender = sender_name and sender_name in self.feelings
+        if known_sender:
+            feeling_word, feeling_score = self.feelings[sender_name]
+            feeling_info = f"Your overall feeling towards {sender_name} is '{feeling_word}' with a score of {feeling_score}."
+        else:
+            keys += ['feeling_word', 'feeling_score']
+        keys += ['tweet', 'next_intensity']
+
+        fill_in = f"'@{sender_name} your_content' if you want to respond or evaluate {sender_name}"
+        if not self.has_posted_new_tweet:
+            fill_in += f", or 'NULLUSER your_content' to say something without responding {sender_name}"
+        key_list = ', '.join(f'"{key}"' for key in keys)
+        system_message = (
+            f'Only output a JSON object with the keys {key_list}, '
+            f"don't output any other words. You are {self.name}, {self.identity_info}."
+        )
+        user_message = (
+            f"{sender_name} posted a tweet about '{query}'.\n"
+            f"Your current mood is '{self.mood}'. Your relevant experiences:\n{recent_text_block}\n{feeling_info}\n\n"
+            f"importance: the importance of this event to you (1 to 10).\n"
+            f"emotion_type: your emotion type for this event, e.g. 'happy'.\n"
+            f"emotion_intensity: your emotion intensity for this event (0 to 10).\n"
+            f"like: do you want to like this tweet? 'YES' or 'NO'.\n"
+            f"agreement: do you agree or disagree with the statement? 'agree' or 'disagree'.\n"
+        )
+        if not known_sender:
+            user_message += (
+                f"feeling_word: one word for how you feel towards {sender_name}.\n"
+                f"feeling_score: the strength of that feeling (0 to 10).\n"
+            )
+        user_message += (
+            f"tweet: the tweet you would post, consistent with your agreement and your motivation. "
+            f"Feel free to use rhetorical strategies such as examples, factual data, or a touch of joke. "
+            f"Fill in: {fill_in}.\n"
+            f"next_intensity: your emotion intensity for future tweets after replying (0 to 10)."
+        )
+
+        response = send_message(system_message, user_message, label='decision', json_mode=True)
+        data = parse_json_response(response)
+        if data is None or not isinstance(data.get('tweet'), str):
+            return None
+
+        def number(key, default):
+            match = re.search(r'\d*\.?\d+', str(data.get(key, '')))
+            return float(match.group()) if match else default
+
+        emotion_type = str(data.get('emotion_type') or 'normal').strip()
+        emotion_intensity = number('emotion_intensity', 5)
+        if not known_sender:
+            self.feelings[sender_name] = (str(data.get('feeling_word') or 'normal').strip(), number('feeling_score', 5))
+            feeling_word, feeling_score = self.feelings[sender_name]
+            feeling_info = f"Your overall feeling towards {sender_name} is '{feeling_word}' with a score of {feeling_score}."
+        print(f"feelings to {sender_name}:{feeling_info}")
+
+        if observe:
+            content = f'At {event_time}, {query}'
+            self.experiences[hash_id] = Memory(content, int(number('importance', 5)), event_time, emotion_type,
+                                               emotion_intensity)
+            if emotion_intensity > 4 and (data.get('like') is True or 'YES' in str(data.get('like', '')).upper()):
+                print(f'{self.name} 点赞了内容：{content}')
+                self.like_event(hash_id)
+
+        if from_reply_hash_id and from_reply_hash_id in self.experiences and hash_id in self.experiences:
+            self.experiences[hash_id].emotion_intensity = self.experiences[from_reply_hash_id].emotion_intensity
+
+        if hash_id not in self.experiences:
+            self.experiences[hash_id] = Memory(query, 5, self.global_context.virtual_time.get_current_time(),
+                                               emotion_type, emotion_intensity)
+
+        if not self.should_respond(hash_id, reply_to_self, is_reply_some):
+            return "NO_TWEET", None
+
+        if self.experiences[hash_id].emotion_intensity > self.rng.rand() * 10 + 3:
+            self.reflect(query)
+
+        print(f"agreement:{data.get('agreement')}")
+        tweet = data['tweet'].strip().strip('()').strip('"').strip("'").replace('(', '').replace(')', '')
+        return self.publish_response(tweet, sender_name, feeling_info, hash_id, number('next_intensity', 5))
+
     def force_post_tweet(self, query):
         self.has_posted_new_tweet = True
         self.observe(query, self.global_context.virtual_time.get_current_time(), 'force_post_event')
@@ -449,7 +638,7 @@ class Agent:
             f'You are {self.name}, {self.identity_info}. '
             f'Please summarize recent events and describe your current motivation based on the information provided. '
             f'For any significant events, be specific about who did what.',
-            summary_prompt).strip()
+            summary_prompt, label='motivation').strip()
 
         detail_prompt = (
             f"{motivation_summary}. "
@@ -460,13 +649,14 @@ class Agent:
 
         detail_response = send_message(f'You are {self.name}, {self.identity_info}. '
                                        'Please complete the sentence inside the parentheses',
-                                       detail_prompt).strip().strip('()')
+                                       detail_prompt, label='force_post').strip().strip('()')
 
         detail_response = self.text_tuning(detail_response, "no special feeling", self.mood)
 
-        temp_push_hash = Tweet.generate_hash_id(detail_response, time.time())
-        new_tweet = Tweet(detail_response, self.name, self.global_context.virtual_time.advance(), False, temp_push_hash)
-        self.global_context.tweet_log.append(new_tweet)
+        temp_push_hash = Tweet.generate_hash_id(detail_response, self.global_context.virtual_time.get_current_time(),
+                                                self.rng)
+        new_tweet = Tweet(detail_response, self.name, None, False, temp_push_hash)
+        self.global_context.publish_tweet(new_tweet)
         action_description = f"To respond to the query: \"{query}\", {self.name} posted a new tweet: \"{detail_response}\""
 
         return action_description, new_tweet.hash_id
@@ -483,7 +673,8 @@ class Agent:
 
             response = send_message(
                 system_message,
-                prompt
+                prompt,
+                label='importance_emotion'
             ).strip()
 
             importance_str, emotion_type, emotion_intensity_str = response.split(',')
@@ -497,100 +688,58 @@ class Agent:
             print(f"An error occurred while calculating importance and emotion: {e}")
             return 5, 'normal', 5.0
 
-    def calculate_recency(self, memory):
-        current_time = self.global_context.virtual_time.get_current_time()
-        event_time = datetime.strptime(memory.event_time, "%Y-%m-%d %H:%M")
-        current_time = datetime.strptime(current_time, "%Y-%m-%d %H:%M")
-        hours_passed = (current_time - event_time).total_seconds() / 3600
-        recency_score = np.exp(-0.005 * hours_passed)
-        return recency_score
-
-    def calculate_relevance(self, memory, query_embedding):
-        if memory.embedding is None:
-            memory.update_embedding(self.memory_model)
-        relevance_score = np.dot(memory.embedding, query_embedding) / (
-                np.linalg.norm(memory.embedding) * np.linalg.norm(query_embedding))
-        return relevance_score
-
     def retrieve_relevant_memories(self, query, max_memories=5):
-        query_embedding = self.memory_model.encode(query)
-        recency_scores = []
-        importance_scores = []
-        relevance_scores = []
-        emotion_scores = []
-
-        for memory in self.experiences.values():
-            recency_score = self.calculate_recency(memory)
-            recency_scores.append(recency_score)
-
-            importance_score = memory.importance
-            importance_scores.append(importance_score)
-
-            relevance_score = self.calculate_relevance(memory, query_embedding)
-            relevance_scores.append(relevance_score)
-
-            emotion_score = memory.emotion_intensity
-            emotion_scores.append(emotion_score)
-
-        recency_scores = minmax_scale(recency_scores)
-        importance_scores = minmax_scale(importance_scores)
-        relevance_scores = minmax_scale(relevance_scores)
-        emotion_scores = minmax_scale(emotion_scores)
-
-        scores = []
-        for i, memory in enumerate(self.experiences.values()):
-            combined_score = (
-                    self.alpha_recency * recency_scores[i] +
-                    self.alpha_importance * importance_scores[i] +
-                    self.alpha_relevance * relevance_scores[i] +
-                    self.alpha_emotion * emotion_scores[i]
-            )
-            scores.append({
-                'memory': memory,
-                'score': combined_score
-            })
-
-        scores = sorted(scores, key=lambda x: x['score'], reverse=True)
-        relevant_memories = [score['memory'] for score in scores[:max_memories]]
-        return relevant_memories
+        query_embedding = self.memory_model.encode_query(query)
+        return self.experiences.top_k(
+            query_embedding,
+            self.global_context.virtual_time.get_current_minutes(),
+            (self.alpha_recency, self.alpha_importance, self.alpha_relevance, self.alpha_emotion),
+            max_memories,
+            self.memory_model
+        )
 
     def react_to_event(self, event_description, event_time, hash_id):
         rp_id = None
         rp_content = ""
         rp_sender_name = ""
         sender_name = ''
-        for tweet in self.global_context.tweet_log:
-            if tweet.hash_id == hash_id:
-                sender_name = tweet.author
-                rp_content = ""
-
-            if tweet.hash_id == hash_id:
-                rp_id = tweet.reply_to_hash_id
+        tweet = self.global_context.get_tweet(hash_id)
+        if tweet is not None:
+            sender_name = tweet.author
+            rp_id = tweet.reply_to_hash_id
 
         if sender_name == self.name:
             print("随机到自己的事件，不处理")
             return
         if rp_id is not None:
-            for tweet in self.global_context.tweet_log:
-                if tweet.hash_id == rp_id:
-                    rp_sender_name = tweet.author
-                    rp_content = tweet.content
-                    break
+            reply_tweet = self.global_context.get_tweet(rp_id)
+            if reply_tweet is not None:
+                rp_sender_name = reply_tweet.author
+                rp_content = reply_tweet.content
 
             event_description = (f'To respond the tweet posted by {rp_sender_name}:'
                                  f'{rp_content}, ') + event_description
 
         if (rp_id and (rp_id in self.experiences) and
-                np.random.rand() < self.experiences[rp_id].emotion_intensity):
-            self.observe(event_description, event_time, hash_id)
-        elif rp_id is None:
-            self.observe(event_description, event_time, hash_id)
+                self.rng.rand() < self.experiences[rp_id].emotion_intensity):
+            observe = True
+        else:
+            observe = rp_id is None
 
         print(f'event description:{event_description}, hash_id:{hash_id}')
-        new_action, new_hash_id = self.post_tweet(event_description, hash_id)
+        result = None
+        if self.global_context.decision_mode == 'fused':
+            result = self.fused_react(event_description, event_time, hash_id, observe)
+            if result is None:
+                print("Fused decision failed, falling back to the prompt chain")
+        if result is None:
+            if observe:
+                self.observe(event_description, event_time, hash_id)
+            result = self.post_tweet(event_description, hash_id)
+        new_action, new_hash_id = result
 
         if new_action != 'NO_TWEET':
-            self.global_context.global_queue.append((new_action, event_time, new_hash_id, get_depth()))
+            self.global_context.enqueue((new_action, event_time, new_hash_id, get_depth()))
 
     def ask_question(self, question, role_name=None):
         print(f'Question: {question}')
@@ -623,7 +772,7 @@ class Agent:
             f'You are {self.name}, {self.identity_info}. '
             f'Please summarize recent events and describe your current motivation based on the information provided. '
             f'For any significant events, be specific about who did what.',
-            summary_prompt).strip()
+            summary_prompt, label='motivation').strip()
 
         print(f"Motivation summary: {motivation_summary}")
 
@@ -636,8 +785,8 @@ class Agent:
         response = send_message(
             f'You are {self.name}, {self.identity_info}. '
             'Please provide your answer. Only output the text of the answer, do not output any other text.'
-            f'The random seed is {np.random.rand() * 10000}',
-            answer_prompt).strip()
+            f'The random seed is {self.rng.rand() * 10000}',
+            answer_prompt, use_cache=False, label='answer').strip()
 
         tuned_response = re.sub(r'^["\']+|["\']+$', '', response.strip())
 
@@ -645,7 +794,79 @@ class Agent:
 
         return tuned_response
 
-    def to_dict(self):
+    def consolidate_memories(self):
+        # 记忆超过 memory_budget 时，把较旧、不重要的记忆按组合并为摘要，原始记忆移入 archived_memories；
+        # 摘要取组内最大深度，按深度过滤不会看到之后的内容，精确回退依赖深度快照
+        experiences = self.experiences
+        if memory_budget is None or len(experiences) <= memory_budget:
+            return []
+        # 摘要的嵌入取平均值，先把尚未计算的嵌入补齐
+        self.memory_model.flush()
+
+        # 合并到预算的 90% 以下，避免之后每新增一条记忆就合并一次；最新的一半预算不参与合并
+        target = memory_budget - memory_budget // 10
+        group_size = max(2, memory_consolidation_group)
+        count = -(-(len(experiences) - target) * group_size // (group_size - 1))
+        keys = experiences.consolidation_keys(count, self.global_context.virtual_time.get_current_minutes(),
+                                              memory_budget // 2)
+        chunks = [keys[start:start + group_size] for start in range(0, len(keys), group_size)]
+        chunks = [chunk for chunk in chunks if len(chunk) > 1]
+        folded = [key for chunk in chunks for key in chunk]
+        removed = dict(zip(folded, experiences.remove(folded)))
+
+        summaries = []
+        for chunk in chunks:
+            memories = [removed[key] for key in chunk]
+            weights = {}
+            for memory in memories:
+                if memory.emotion_type and memory.emotion_type.strip():
+                    emotion = memory.emotion_type.strip()
+                    weights[emotion] = weights.get(emotion, 0) + memory.emotion_intensity
+            emotion_type = max(weights, key=weights.get) if weights else None
+            first = min(memories, key=lambda memory: memory.minutes)
+            last = max(memories, key=lambda memory: memory.minutes)
+            highlights = sorted(memories, key=lambda memory: -memory.importance)[:3]
+            feeling = f' that left you {emotion_type}' if emotion_type else ''
+            content = (f'Summary of {len(memories)} earlier memories{feeling}, from {first.event_time} to '
+                       f'{last.event_time}: ' + ' | '.join(memory.content[:120] for memory in highlights))
+            embeddings = [memory.embedding for memory in memories if memory.embedding is not None]
+            summary = Memory(content, max(memory.importance for memory in memories), last.event_time, emotion_type,
+                             round(float(np.mean([memory.emotion_intensity for memory in memories])), 1),
+                             max(memory.depth for memory in memories),
+                             np.mean(embeddings, axis=0) if embeddings else None)
+            summary_key = 'summary-' + hashlib.md5('\x00'.join(map(str, chunk)).encode('utf-8')).hexdigest()
+            experiences[summary_key] = summary
+            summaries.append(summary)
+
+            for key, memory in zip(chunk, memories):
+                data = memory.to_dict()
+                data.pop('embedding', None)
+                self.archived_memories.append({'agent': self.name, 'summary': summary_key, 'key': str(key),
+                                               'memory': data})
+        if summaries:
+            print(f'{self.name} 将 {len(folded)} 条记忆合并为 {len(summaries)} 条摘要')
+        return summaries
+
+    def update_profile(self, occupation, experience, character, interest):
+        self.occupation = occupation
+        self.experience = experience
+        self.character = character
+        self.interest = interest
+        self.identity_info = f"{self.occupation}, {self.experience}, {self.character}, {self.interest}"
+
+    def state_dict(self):
+        return {
+            'occupation': self.occupation,
+            'experience': self.experience,
+            'character': self.character,
+            'interest': self.interest,
+            'has_posted_new_tweet': self.has_posted_new_tweet,
+            'feelings': self.feelings,
+            'mood': self.mood,
+            'online': self.online
+        }
+
+    def to_dict(self, embedding_writer=None):
         return {
             'name': self.name,
             'occupation': self.occupation,
@@ -657,14 +878,14 @@ class Agent:
             'mood': self.mood,
             'online': self.online,
             'global_context': None,  # Avoiding direct serialization of global context
-            'experiences': {k: v.to_dict() for k, v in self.experiences.items()}
+            'experiences': {k: v.to_dict(embedding_writer) for k, v in self.experiences.items()}
         }
 
     @classmethod
-    def from_dict(cls, data, global_context):
+    def from_dict(cls, data, global_context, embedding_reader=None):
         agent = cls(data['name'], data['occupation'], data['experience'], data['character'], data['interest'],
                     global_context)
-        agent.experiences = {k: Memory.from_dict(v) for k, v in data['experiences'].items()}
+        agent.experiences = {k: Memory.from_dict(v, embedding_reader) for k, v in data['experiences'].items()}
         agent.has_posted_new_tweet = data['has_posted_new_tweet']
         agent.feelings = data['feelings']
         agent.mood = data['mood']
@@ -0,0 +1,159 @@
+import argparse
+import contextlib
+import multiprocessing
+import os
+import time
+import traceback
+
+from config import llm_requests_per_minute, llm_tokens_per_minute, max_concurrent_llm_requests
+from llm_base import set_rate_limiters, set_request_limiter
+from main import load_scenario, make_output_dirs, md5_hash, read_json_file, simulate_step, write_json_file
+from rate_limiter import RateLimitManager
+
+
+def batch_dir(output_dir):
+    return os.path.join(output_dir, 'Batch')
+
+
+def status_file(output_dir, event_hash):
+    return os.path.join(batch_dir(output_dir), f'status_{event_hash}.json')
+
+
+def log_file(output_dir, event_hash):
+    return os.path.join(batch_dir(output_dir), 'logs', f'{event_hash}.log')
+
+
+def init_worker(limiter, request_bucket, token_bucket):
+    # 每个工作进程在首次检索时加载一次自己的嵌入模型；LLM 并发上限和每分钟请求数、token 数的
+    # 令牌桶都在管理进程中，由所有进程共享，空闲进程的额度可以被其他进程用掉
+    if limiter is not None:
+        set_request_limiter(limiter)
+    set_rate_limiters(request_bucket, token_bucket)
+
+
+def new_status(line, event, event_hash):
+    return {
+        'line': line,
+        'event': event,
+        'event_hash': event_hash,
+        'status': 'pending',
+        'completed_depth': -1,
+        'depth_seconds': {},
+        'tweets': 0,
+        'memories': 0,
+        'error': None
+    }
+
+
+def run_event(task):
+    # 模拟一个事件尚未完成的所有深度，返回状态记录
+    line, event, max_depth, options = task
+    output_dir = options['output_dir']
+    event_hash = md5_hash(event)
+    filename = status_file(output_dir, event_hash)
+
+    status = read_json_file(filename)
+    if status is None or options['restart'] or status['event'] != event:
+        status = new_status(line, event, event_hash)
+    status['line'] = line
+    if status['completed_depth'] >= max_depth:
+        return status
+
+    status['status'] = 'running'
+    status['error'] = None
+    write_json_file(filename, status)
+
+    # 各事件的模拟输出写到单独的日志，不与其他进程交错
+    with open(log_file(output_dir, event_hash), 'a', encoding='utf-8') as log, contextlib.redirect_stdout(log):
+        try:
+            global_context, files = load_scenario(event, event_hash, output_dir, status['completed_depth'] + 1)
+            # 从上次完成的深度之后继续；中断的深度在重跑时会先被按深度过滤掉
+            for depth in range(status['completed_depth'] + 1, max_depth + 1):
+                print(f'===== depth {depth} =====')
+                start = time.time()
+                simulate_step(global_context, files, depth, options['max_workers'], seed=options['seed'],
+                              text_tuning_mode=options['text_tuning_mode'], decision_mode=options['decision_mode'])
+                status['completed_depth'] = depth
+                status['depth_seconds'][str(depth)] = round(time.time() - start, 3)
+                status['tweets'] = len(global_context.tweet_log)
+                status['memories'] = sum(len(agent.experiences) for agent in global_context.agents)
+                write_json_file(filename, status)
+            status['status'] = 'completed'
+        except Exception:
+            traceback.print_exc()
+            status['status'] = 'failed'
+            status['error'] = traceback.format_exc()
+
+    write_json_file(filename, status)
+    return status
+
+
+def write_manifest(filename, args, statuses, started):
+    counts = {}
+    for status in statuses.values():
+        counts[status['status']] = counts.get(status['status'], 0) + 1
+    write_json_file(filename, {
+        'events_file': args.events_file,
+        'output_dir': args.output_dir,
+        'max_depth': args.max_depth,
+        'seed': args.seed,
+        'started': started,
+        'updated': time.time(),
+        'counts': counts,
+        'events': [statuses[line] for line in sorted(statuses)]
+    })
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Simulate every event of an events file across depths 0..N.')
+    parser.add_argument('--events-file', default='Output/events.txt')
+    parser.add_argument('--max-depth', type=int, default=5)
+    parser.add_argument('--lines', type=int, nargs='*', help='only these 1-based lines of the events file')
+    parser.add_argument('--processes', type=int, default=4, help='worker processes, one event per process at a time')
+    parser.add_argument('--max-workers', type=int, default=1, help='concurrent agents within one event')
+    parser.add_argument('--max-concurrent-requests', type=int, default=max_concurrent_llm_requests,
+                        help='in-flight LLM requests shared by all processes')
+    parser.add_argument('--output-dir', default='Output')
+    parser.add_argument('--seed', default=None)
+    parser.add_argument('--restart', action='store_true', help='ignore saved progress and start from depth 0')
+    parser.add_argument('--text-tuning-mode', choices=['chain', 'structured'], help='defaults to config.py')
+    parser.add_argument('--decision-mode', choices=['chain', 'fused'], help='defaults to config.py')
+    args = parser.parse_args()
+
+    with open(args.events_file, 'r', encoding='utf-8') as f:
+        events = [(line, event.strip()) for line, event in enumerate(f, start=1) if event.strip()]
+    if args.lines:
+        events = [(line, event) for line, event in events if line in args.lines]
+
+    make_output_dirs(args.output_dir)
+    os.makedirs(os.path.join(batch_dir(args.output_dir), 'logs'), exist_ok=True)
+    manifest_file = os.path.join(batch_dir(args.output_dir), 'manifest.json')
+
+    options = {'output_dir': args.output_dir, 'max_workers': args.max_workers, 'seed': args.seed,
+               'text_tuning_mode': args.text_tuning_mode, 'decision_mode': args.decision_mode,
+               'restart': args.restart}
+    tasks = [(line, event, args.max_depth, options) for line, event in events]
+    statuses = {line: new_status(line, event, md5_hash(event)) for line, event in events}
+    started = time.time()
+    write_manifest(manifest_file, args, statuses, started)
+
+    with RateLimitManager() as manager:
+        limiter = manager.BoundedSemaphore(args.max_concurrent_requests)
+        request_bucket = manager.TokenBucket(llm_requests_per_minute) if llm_requests_per_minute else None
+        token_bucket = manager.TokenBucket(llm_tokens_per_minute) if llm_tokens_per_minute else None
+        with multiprocessing.Pool(args.processes, initializer=init_worker,
+                                  initargs=(limiter, request_bucket, token_bucket)) as pool:
+            for status in pool.imap_unordered(run_event, tasks):
+                statuses[status['line']] = status
+                write_manifest(manifest_file, args, statuses, started)
+                print(f"[{sum(s['status'] in ('completed', 'failed') for s in statuses.values())}/{len(tasks)}] "
+                      f"line {status['line']}: {status['status']} (depth {status['completed_depth']})")
+
+    failed = [status['line'] for status in statuses.values() if status['status'] == 'failed']
+    print(f'Manifest written to {manifest_file}')
+    if failed:
+        print(f'Failed lines: {failed}; rerun the same command to resume them.')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,371 @@
+import argparse
+import contextlib
+import glob
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+
+import llm_base
+from embedding_model import EmbeddingService, HashingEncoder, set_embedding_service
+from embedding_store import embedding_files
+from event_queue import EventQueue
+from llm_stub import StubBackend
+from memory_index import IVFIndex
+
+# 必须在创建任何 Agent 之前替换：基准测试不访问网络，也不加载嵌入模型
+llm_base.set_backend(StubBackend())
+llm_base.set_response_cache(None)
+llm_base.set_rate_limits(None, None)
+set_embedding_service(EmbeddingService(model=HashingEncoder()))
+
+import main  # noqa: E402
+from agent_emotional import Agent  # noqa: E402
+from config import default_agents_list, init_depth  # noqa: E402
+from tweet import Tweet, TweetLog, preprocess_tweets  # noqa: E402
+from utils import GlobalContext, Memory  # noqa: E402
+from virtual_time import VirtualTime  # noqa: E402
+
+START_TIME = datetime(2024, 1, 1, 9, 0)
+TIME_FORMAT = '%Y-%m-%d %H:%M'
+
+
+def summarize(samples):
+    samples = sorted(samples)
+    return {
+        'runs': len(samples),
+        'mean': statistics.fmean(samples),
+        'p50': samples[len(samples) // 2],
+        'p95': samples[min(len(samples) - 1, int(len(samples) * 0.95))],
+        'min': samples[0],
+        'max': samples[-1]
+    }
+
+
+def measure(fn, repeat):
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+    return summarize(samples)
+
+
+@contextlib.contextmanager
+def quiet():
+    # 模拟代码会打印大量日志
+    with contextlib.redirect_stdout(io.StringIO()):
+        yield
+
+
+def new_global_context(event='A new city law bans private cars from downtown'):
+    global_context = GlobalContext(event)
+    global_context.virtual_time = VirtualTime(start_time=START_TIME)
+    return global_context
+
+
+def bench_simulation(rounds, max_workers, latency):
+    llm_base.set_backend(StubBackend(('constant', latency)))
+    global_context = new_global_context()
+    stats_before = llm_base.get_call_stats()
+    round_seconds = []
+    with quiet():
+        main.initialize_agents(default_agents_list, global_context)
+        for depth in range(rounds):
+            init_depth(depth)
+            start = time.perf_counter()
+            main.run_simulation_for_event(global_context.event, global_context, max_workers, seed='benchmark')
+            round_seconds.append(time.perf_counter() - start)
+    calls = llm_base.get_call_stats()['calls'] - stats_before['calls']
+    llm_base.set_backend(StubBackend())
+    return {
+        'rounds': rounds,
+        'max_workers': max_workers,
+        'stub_latency': latency,
+        'rounds_per_second': rounds / sum(round_seconds),
+        'round_seconds': summarize(round_seconds),
+        'llm_calls_per_round': calls / rounds,
+        'tweets': len(global_context.tweet_log),
+        'memories': sum(len(agent.experiences) for agent in global_context.agents)
+    }
+
+
+def synthetic_agent(global_context, memory_count, rng):
+    properties = default_agents_list[0]
+    agent = Agent(properties['name'], properties['occupation'], properties['experience'], properties['character'],
+                  properties['interest'], global_context)
+    words = properties['experience'].split() + properties['interest'].split()
+    encoder = HashingEncoder()
+    for i in range(memory_count):
+        content = ' '.join(rng.choice(words) for _ in range(20))
+        event_time = (START_TIME + timedelta(minutes=rng.randint(0, 60 * 24 * 30))).strftime(TIME_FORMAT)
+        memory = Memory(content, rng.randint(1, 10), event_time, rng.choice(['happy', 'angry']), rng.randint(0, 10),
+                        depth=0, embedding=encoder.encode(content))
+        agent.experiences[f'memory-{i}'] = memory
+    return agent
+
+
+def bench_retrieval(sizes, queries):
+    rng = random.Random(0)
+    results = {}
+    for size in sizes:
+        global_context = new_global_context()
+        global_context.virtual_time = VirtualTime(start_time=START_TIME + timedelta(days=31))
+        agent = synthetic_agent(global_context, size, rng)
+        query_texts = [f'query {i} about writing and debates' for i in range(queries)]
+        samples = []
+        for query in query_texts:
+            start = time.perf_counter()
+            agent.retrieve_relevant_memories(query)
+            samples.append(time.perf_counter() - start)
+        results[str(size)] = summarize(samples)
+    return results
+
+
+def bench_ann(sizes, queries, nprobes, k=5):
+    # 对比近似检索与逐条计算：recall 为两者前 k 条结果的重合比例，relevance_recall 只按相关度排序
+    rng = random.Random(0)
+    words = default_agents_list[0]['experience'].split()
+    results = {}
+    for size in sizes:
+        global_context = new_global_context()
+        global_context.virtual_time = VirtualTime(start_time=START_TIME + timedelta(days=31))
+        agent = synthetic_agent(global_context, size, rng)
+        stream = agent.experiences
+        now = global_context.virtual_time.get_current_minutes()
+        weights = (agent.alpha_recency, agent.alpha_importance, agent.alpha_relevance, agent.alpha_emotion)
+        query_embeddings = [agent.memory_model.encode_query(' '.join(rng.choice(words) for _ in range(8)))
+                            for _ in range(queries)]
+
+        def top_k(query_embedding, weights=weights, exact=False):
+            return {id(memory) for memory in stream.top_k(query_embedding, now, weights, k, agent.memory_model, exact)}
+
+        exact_samples = []
+        exact, exact_relevance = [], []
+        for query_embedding in query_embeddings:
+            start = time.perf_counter()
+            exact.append(top_k(query_embedding, exact=True))
+            exact_samples.append(time.perf_counter() - start)
+            exact_relevance.append(top_k(query_embedding, (0, 0, 1, 0), exact=True))
+        size_results = {'exact': summarize(exact_samples)}
+
+        for nprobe in nprobes:
+            stream.index = IVFIndex(min_size=0, nprobe=nprobe)
+            start = time.perf_counter()
+            top_k(query_embeddings[0])
+            train_seconds = time.perf_counter() - start
+            samples, recall, relevance_recall = [], [], []
+            for i, query_embedding in enumerate(query_embeddings):
+                start = time.perf_counter()
+                found = top_k(query_embedding)
+                samples.append(time.perf_counter() - start)
+                recall.append(len(found & exact[i]) / k)
+                relevance_recall.append(len(top_k(query_embedding, (0, 0, 1, 0)) & exact_relevance[i]) / k)
+            size_results[f'nprobe_{nprobe}'] = {
+                'lists': len(stream.index.centroids),
+                'train_seconds': train_seconds,
+                'latency': summarize(samples),
+                'recall': statistics.fmean(recall),
+                'relevance_recall': statistics.fmean(relevance_recall)
+            }
+        results[str(size)] = size_results
+    return results
+
+
+def bench_persistence(agents_file, repeat):
+    work_dir = tempfile.mkdtemp(prefix='fema-benchmark-')
+    try:
+        legacy_file = os.path.join(work_dir, 'agents_legacy.json')
+        shutil.copy(agents_file, legacy_file)
+        global_context = new_global_context()
+
+        with quiet():
+            agents = main.load_agents(legacy_file, global_context)
+            result = {
+                'agents_file': agents_file,
+                'file_bytes': os.path.getsize(agents_file),
+                'agents': len(agents),
+                'memories': sum(len(agent.experiences) for agent in agents),
+                'load_inline_json': measure(lambda: main.load_agents(legacy_file, global_context), repeat)
+            }
+
+            saved_file = os.path.join(work_dir, 'agents_saved.json')
+            result['save'] = measure(lambda: main.save_agents(agents, saved_file), repeat)
+            result['load'] = measure(lambda: main.load_agents(saved_file, global_context), repeat)
+        result['saved_bytes'] = (os.path.getsize(saved_file) +
+                                 sum(os.path.getsize(path) for path in embedding_files(saved_file)))
+        return result
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def synthetic_tweets(count, rng):
+    tweets = []
+    for i in range(count):
+        # 约三分之一是根推文，其余回复任意更早的推文
+        parent = None if i == 0 or rng.random() < 0.3 else tweets[rng.randrange(i)]['hash_id']
+        tweets.append({
+            'content': f'tweet {i}',
+            'author': f'agent_{i % 7}',
+            'tweet_time': START_TIME.strftime(TIME_FORMAT),
+            'likes': [],
+            'hash_id': f'{i:032x}',
+            'reply_to_hash_id': parent,
+            'depth': i * 10 // count
+        })
+    return tweets
+
+
+def bench_preprocess(sizes, repeat):
+    rng = random.Random(0)
+    results = {}
+    for size in sizes:
+        tweets = synthetic_tweets(size, rng)
+        samples = []
+        for _ in range(repeat):
+            # preprocess_tweets 会原地写入 comments 字段，每次使用新的副本
+            batch = [dict(tweet) for tweet in tweets]
+            start = time.perf_counter()
+            preprocess_tweets(batch)
+            samples.append(time.perf_counter() - start)
+        results[str(size)] = summarize(samples)
+    return results
+
+
+def bench_thread_index(sizes, repeat, page_size=20):
+    # 服务端按会话建一次线程索引，之后每个请求只取一页
+    rng = random.Random(0)
+    results = {}
+    for size in sizes:
+        tweets = [Tweet.from_dict(tweet) for tweet in synthetic_tweets(size, rng)]
+        tweet_log = TweetLog(tweets)
+        results[str(size)] = {
+            'build': measure(lambda: TweetLog(tweets), repeat),
+            'first_page': measure(lambda: tweet_log.thread_page(limit=page_size), repeat)
+        }
+    return results
+
+
+def bench_queue(sizes, agents, repeat):
+    # 一轮模拟中为每个 agent 选取事件；队列中有两个深度，另有少量深度为 0 的事件
+    rng = random.Random(0)
+    results = {}
+    for size in sizes:
+        events = [(f'event {i}', START_TIME.strftime(TIME_FORMAT), f'{i:032x}', 0 if i < 2 else 1 + i % 2)
+                  for i in range(size)]
+
+        def select_round():
+            queue = EventQueue(events)
+            for _ in range(agents):
+                queue.feed(rng)
+
+        results[str(size)] = measure(select_round, repeat)
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def flatten(results, prefix=''):
+    # 把嵌套结果展开为 "a.b.mean" 形式，便于两次运行逐项对比
+    values = {}
+    for key, value in results.items():
+        name = f'{prefix}{key}'
+        if isinstance(value, dict):
+            values.update(flatten(value, name + '.'))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            values[name] = value
+    return values
+
+
+def compare(baseline_file, report):
+    with open(baseline_file, 'r', encoding='utf-8') as f:
+        baseline = json.load(f)
+    old, new = flatten(baseline['results']), flatten(report['results'])
+    print(f"\nCompared with {baseline_file} ({baseline.get('commit')}):")
+    for name in sorted(old.keys() & new.keys()):
+        if name.endswith(('.mean', '.p95', 'rounds_per_second')) and old[name]:
+            print(f'  {name}: {old[name]:.6g} -> {new[name]:.6g} ({new[name] / old[name]:.2f}x)')
+
+
+def main_cli():
+    largest_agents_file = max(glob.glob('Output/Agents/agents_*.json'), key=os.path.getsize, default=None)
+
+    parser = argparse.ArgumentParser(description='Benchmark simulation rounds, retrieval, persistence and tweet trees.')
+    parser.add_argument('--output', default='Output/benchmark.json')
+    parser.add_argument('--compare', help='previous benchmark JSON to compare against')
+    parser.add_argument('--only', nargs='*',
+                        choices=['simulation', 'retrieval', 'ann', 'persistence', 'preprocess', 'queue'])
+    parser.add_argument('--rounds', type=int, default=5)
+    parser.add_argument('--max-workers', type=int, default=1)
+    parser.add_argument('--stub-latency', type=float, default=0.0, help='seconds per stubbed LLM call')
+    parser.add_argument('--memory-sizes', type=int, nargs='*', default=[100, 1000, 10000])
+    parser.add_argument('--queries', type=int, default=50)
+    parser.add_argument('--ann-sizes', type=int, nargs='*', default=[10000, 50000])
+    parser.add_argument('--ann-nprobe', type=int, nargs='*', default=[4, 8, 16])
+    parser.add_argument('--agents-file', default=largest_agents_file)
+    parser.add_argument('--tweet-sizes', type=int, nargs='*', default=[1000, 10000, 50000])
+    parser.add_argument('--queue-sizes', type=int, nargs='*', default=[1000, 100000])
+    parser.add_argument('--queue-agents', type=int, default=20)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    selected = set(args.only or ['simulation', 'retrieval', 'ann', 'persistence', 'preprocess', 'queue'])
+    results = {}
+    if 'simulation' in selected:
+        print('Running simulation benchmark...')
+        results['simulation'] = bench_simulation(args.rounds, args.max_workers, args.stub_latency)
+    if 'retrieval' in selected:
+        print('Running retrieval benchmark...')
+        results['retrieval'] = bench_retrieval(args.memory_sizes, args.queries)
+    if 'ann' in selected:
+        print('Running approximate retrieval benchmark...')
+        results['ann'] = bench_ann(args.ann_sizes, args.queries, args.ann_nprobe)
+    if 'persistence' in selected and args.agents_file:
+        print('Running persistence benchmark...')
+        results['persistence'] = bench_persistence(args.agents_file, args.repeat)
+    if 'preprocess' in selected:
+        print('Running preprocess_tweets benchmark...')
+        results['preprocess_tweets'] = bench_preprocess(args.tweet_sizes, args.repeat)
+        results['thread_index'] = bench_thread_index(args.tweet_sizes, args.repeat)
+    if 'queue' in selected:
+        print('Running event queue benchmark...')
+        results['queue'] = bench_queue(args.queue_sizes, args.queue_agents, args.repeat)
+
+    report = {
+        'commit': git_commit(),
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'machine': platform.machine(),
+        'args': vars(args),
+        'results': results
+    }
+    directory = os.path.dirname(args.output)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=4)
+    print(json.dumps(results, indent=2))
+    print(f'Results written to {args.output}')
+
+    if args.compare:
+        compare(args.compare, report)
+
+
+if __name__ == '__main__':
+    main_cli()
@@ -1,13 +1,59 @@
+from contextvars import ContextVar
+
 global_depth_flag = 0  # 全局深度标志
+# 后台任务中各场景并行模拟时，每个线程（及其派生的工作线程）使用自己的深度
+_current_depth = ContextVar('current_depth', default=None)
+
+llm_backend = 'openai'  # 'stub'：离线的确定性桩，用于基准测试和回归测试
+llm_model = 'gpt-3.5-turbo'
+embedding_backend = 'sentence_transformers'  # 'hashing'：无需模型文件的离线嵌入
+text_tuning_mode = 'chain'  # 'structured'：改写推文时用一次 JSON 调用代替三次调用
+decision_mode = 'chain'  # 'fused'：每个事件用一次 JSON 调用得到重要性、情绪、点赞、立场和推文草稿
+
+max_concurrent_llm_requests = 8  # 同时在途的 LLM 请求上限
+llm_requests_per_minute = 3500  # 每分钟请求数上限，设为 None 关闭
+llm_tokens_per_minute = 200000  # 每分钟 token 上限，设为 None 关闭
+llm_expected_completion_tokens = 256  # 发送前按此预估回复长度预扣 token，返回后按实际用量结算
+llm_timeout = 60  # 单次请求超时（秒）
+llm_max_retries = 5  # 429、超时、连接错误和 5xx 的重试次数
+llm_retry_base_delay = 1.0  # 指数退避的初始延迟（秒）
+llm_retry_max_delay = 60.0
+llm_max_connections = 20  # 共享 HTTP 连接池大小
+
+llm_cache_file = 'Output/llm_cache.sqlite3'  # 设为 None 关闭 LLM 响应缓存
+llm_cache_max_entries = 100000
+llm_cache_max_age = 30 * 24 * 3600  # 秒
+
+journal_compaction_records = 1000  # 增量日志超过该条数时重写完整快照
+
+memory_index = None  # 'ivf'：记忆很多的 agent 先按相关度用近似最近邻索引筛出候选，只对候选计算综合得分
+memory_index_min_size = 5000  # 记忆少于该条数时仍逐条计算
+memory_index_nprobe = 8  # 每次检索搜索的簇数
+memory_index_shortlist = 256  # 按相关度保留的候选数
+
+memory_budget = None  # 每个 agent 常驻记忆的条数上限，超出后把重要性低、时间久的记忆合并为摘要；None 表示不限制
+memory_consolidation_group = 10  # 每条摘要最多合并的记忆数
+
+queue_max_events_per_depth = None  # 全局队列中每个深度最多保留的事件数，已满时新回复不再入队（用户发帖除外）；None 表示不限制
+queue_retention_depths = 1  # 每轮结束后保留最近几个深度的事件；1 即只保留当前深度及更深的事件，None 表示从不清理
+
+session_memory_budget = 512 * 1024 * 1024  # 服务端常驻场景会话的内存预算（字节，估算值）
+response_cache_entries = 8  # 每个场景会话按修订号缓存的序列化响应数
+response_compress_min_bytes = 1024  # 超过该大小的响应体才用 gzip/brotli 压缩
+
+max_simulation_jobs = 4  # 服务端同时运行的后台模拟任务数
+job_history_size = 100  # 保留的已结束任务数
 
 
 def init_depth(res):
     global global_depth_flag
     global_depth_flag = res
+    _current_depth.set(res)
 
 
 def get_depth():
-    return global_depth_flag
+    depth = _current_depth.get()
+    return global_depth_flag if depth is None else depth
 
 default_agents_list = [
     {
@@ -0,0 +1,105 @@
+import hashlib
+import re
+import threading
+import weakref
+
+import numpy as np
+
+from config import embedding_backend
+
+MODEL_PATH = './Models/all-MiniLM-L6-v2'
+
+
+class HashingEncoder:
+    # 离线用的词袋特征哈希编码器，代替 SentenceTransformer：词语相同的文本向量相近，不需要模型文件和 torch
+
+    def __init__(self, dim=384):
+        self.dim = dim
+
+    def _encode_one(self, sentence):
+        vector = np.zeros(self.dim, dtype=np.float32)
+        for word in re.findall(r'\w+', sentence.lower()):
+            h = int(hashlib.md5(word.encode('utf-8')).hexdigest()[:8], 16)
+            vector[h % self.dim] += 1.0 if h & 0x80000000 else -1.0
+        norm = np.linalg.norm(vector)
+        if norm == 0:
+            # 空文本也返回单位向量，避免余弦相似度除以零
+            vector[0] = norm = 1.0
+        return vector / norm
+
+    def encode(self, sentences, **kwargs):
+        if isinstance(sentences, str):
+            return self._encode_one(sentences)
+        if not sentences:
+            return np.zeros((0, self.dim), dtype=np.float32)
+        return np.stack([self._encode_one(sentence) for sentence in sentences])
+
+
+class EmbeddingService:
+    def __init__(self, model_path=MODEL_PATH, model=None):
+        self.model_path = model_path
+        self._model = model
+        self._load_lock = threading.Lock()
+        self._encode_lock = threading.Lock()
+        self._pending = []
+        self._pending_lock = threading.Lock()
+
+    @property
+    def model(self):
+        # 延迟加载：只读取已存储嵌入的记忆永远不会触发模型加载
+        if self._model is None:
+            with self._load_lock:
+                if self._model is None:
+                    from sentence_transformers import SentenceTransformer
+                    print(f'Loading embedding model from {self.model_path}')
+                    self._model = SentenceTransformer(self.model_path)
+        return self._model
+
+    def encode(self, sentences, **kwargs):
+        model = self.model
+        with self._encode_lock:
+            return model.encode(sentences, **kwargs)
+
+    def queue(self, memory):
+        # 只保存弱引用：flush 之前就被丢弃（合并为摘要、按深度过滤、被替换）的记忆不再嵌入
+        with self._pending_lock:
+            self._pending.append(weakref.ref(memory))
+
+    def flush(self, query=None):
+        # 一次 encode 调用同时嵌入所有等待中的记忆（以及可选的查询语句）
+        with self._encode_lock:
+            with self._pending_lock:
+                pending, self._pending = self._pending, []
+            pending = [ref() for ref in pending]
+            pending = [memory for memory in pending if memory is not None and memory.embedding is None]
+            sentences = [memory.content for memory in pending]
+            if query is not None:
+                sentences.append(query)
+            if not sentences:
+                return None
+            embeddings = self.model.encode(sentences)
+            for memory, embedding in zip(pending, embeddings):
+                memory.embedding = embedding
+        return embeddings[-1] if query is not None else None
+
+    def encode_query(self, query):
+        return self.flush(query)
+
+
+_service = None
+_service_lock = threading.Lock()
+
+
+def get_embedding_service():
+    global _service
+    if _service is None:
+        with _service_lock:
+            if _service is None:
+                _service = EmbeddingService(model=HashingEncoder() if embedding_backend == 'hashing' else None)
+    return _service
+
+
+def set_embedding_service(service):
+    # 需在创建 Agent 之前调用，Agent 在构造时保存了服务的引用
+    global _service
+    _service = service
@@ -0,0 +1,168 @@
+import glob
+import hashlib
+import io
+import json
+import os
+
+import numpy as np
+
+
+def embeddings_file(agents_file):
+    # 旧格式的旁路文件名；现在的文件名带内容 hash，由 agents JSON 中的 embeddings_file 指向
+    return os.path.splitext(agents_file)[0] + '.npy'
+
+
+def embedding_files(agents_file):
+    base = os.path.splitext(agents_file)[0]
+    return sorted(glob.glob(glob.escape(base) + '.*.npy')) + [path for path in [base + '.npy'] if os.path.exists(path)]
+
+
+def agent_embeddings_file(agents_file, agent_data):
+    name = agent_data.get('embeddings_file')
+    return os.path.join(os.path.dirname(agents_file), name) if name else embeddings_file(agents_file)
+
+
+class EmbeddingWriter:
+    def __init__(self):
+        self._rows = []
+
+    def add(self, embedding):
+        # 复制一份：传入的可能是 MemoryStream 矩阵的视图
+        self._rows.append(np.array(embedding, dtype=np.float32))
+        return len(self._rows) - 1
+
+    def __len__(self):
+        return len(self._rows)
+
+    def _matrix(self):
+        return np.stack(self._rows) if self._rows else np.zeros((0, 0), dtype=np.float32)
+
+    def save(self, agents_file):
+        # 按内容 hash 命名，不覆盖旧 JSON 仍在引用的文件；返回写入 JSON 的文件名
+        data = self.tobytes()
+        filename = f'{os.path.splitext(agents_file)[0]}.{hashlib.md5(data).hexdigest()[:16]}.npy'
+        if not os.path.exists(filename):
+            temp_file = filename + '.tmp'
+            with open(temp_file, 'wb') as f:
+                f.write(data)
+            os.replace(temp_file, filename)
+        return os.path.basename(filename)
+
+    def tobytes(self):
+        buffer = io.BytesIO()
+        np.save(buffer, self._matrix())
+        return buffer.getvalue()
+
+
+class EmbeddingReader:
+    def __init__(self, filename, defer_open=False):
+        # 以只读内存映射打开，只有真正用到的行才会从磁盘读入。
+        # defer_open 只能用于内容不会再变的文件（快照对象）：首次读取时才打开，避免同时占用大量文件句柄
+        self.filename = filename
+        self._opened = False
+        self._matrix = None
+        if not defer_open:
+            self._open()
+
+    def _open(self):
+        if not self._opened:
+            self._matrix = np.load(self.filename, mmap_mode='r') if os.path.exists(self.filename) else None
+            self._opened = True
+
+    def get(self, row):
+        self._open()
+        if self._matrix is None or row >= len(self._matrix):
+            return None
+        return np.array(self._matrix[row])
+
+    def get_rows(self, rows):
+        # 按行号排序后一次读取，缺失的行返回 None
+        self._open()
+        if self._matrix is None:
+            return [None] * len(rows)
+        present = sorted({row for row in rows if row < len(self._matrix)})
+        block = np.array(self._matrix[present]) if present else None
+        position = {row: i for i, row in enumerate(present)}
+        return [block[position[row]] if row in position else None for row in rows]
+
+
+class EmbeddingReaders:
+    # 按 agent 记录中的 embeddings_file 打开旁路文件，同一文件只打开一次
+    def __init__(self, agents_file):
+        self.agents_file = agents_file
+        self._readers = {}
+
+    def get(self, agent_data):
+        filename = agent_embeddings_file(self.agents_file, agent_data)
+        reader = self._readers.get(filename)
+        if reader is None:
+            reader = self._readers[filename] = EmbeddingReader(filename)
+        return reader
+
+
+class LazyEmbedding:
+    # 旁路文件中的一行，首次需要时才读取
+
+    __slots__ = ('reader', 'row')
+
+    def __init__(self, reader, row):
+        self.reader = reader
+        self.row = row
+
+    def load(self):
+        return self.reader.get(self.row)
+
+
+def split_embeddings(agents, agents_file):
+    # 把原始 agent 数据中的嵌入移入新的 writer 并就地重编 embedding_row；内联的嵌入列表优先于旧旁路文件
+    writer = EmbeddingWriter()
+    readers = EmbeddingReaders(agents_file)
+    for agent in agents:
+        reader = readers.get(agent)
+        agent.pop('embeddings_file', None)
+        for memory in agent.get('experiences', {}).values():
+            embedding = memory.pop('embedding', None)
+            if embedding is None and 'embedding_row' in memory:
+                embedding = reader.get(memory['embedding_row'])
+            memory.pop('embedding_row', None)
+            if embedding is not None:
+                memory['embedding_row'] = writer.add(embedding)
+    return writer
+
+
+def write_agents_file(agents_file, agents, writer):
+    # 先写入新的旁路文件，再原子替换 JSON，读取方不会拿到互相不匹配的一对文件；最后删除不再引用的旧文件
+    name = writer.save(agents_file)
+    for agent in agents:
+        agent['embeddings_file'] = name
+    temp_file = agents_file + '.tmp'
+    with open(temp_file, 'w', encoding='utf-8') as f:
+        json.dump(agents, f, ensure_ascii=False, indent=4)
+    os.replace(temp_file, agents_file)
+    for filename in embedding_files(agents_file):
+        if os.path.basename(filename) != name:
+            try:
+                os.remove(filename)
+            except OSError:
+                # 仍被内存映射占用（Windows），下次保存时再删除
+                pass
+
+
+def migrate_agents_file(filename):
+    # 把 agents 文件中内联的嵌入列表迁移到 .npy 旁路文件
+    with open(filename, 'r', encoding='utf-8') as f:
+        agents = json.load(f)
+
+    migrated = sum(1 for agent in agents for memory in agent.get('experiences', {}).values()
+                   if memory.get('embedding') is not None)
+    writer = split_embeddings(agents, filename)
+    write_agents_file(filename, agents, writer)
+    return migrated
+
+
+if __name__ == '__main__':
+    for agents_file in sorted(glob.glob('Output/Agents/agents_*.json')):
+        before = os.path.getsize(agents_file)
+        count = migrate_agents_file(agents_file)
+        after = os.path.getsize(agents_file) + sum(os.path.getsize(path) for path in embedding_files(agents_file))
+        print(f'{agents_file}: migrated {count} embeddings, {before} -> {after} bytes')
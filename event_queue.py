@@ -0,0 +1,109 @@
+import heapq
+from collections.abc import Sequence
+
+from config import queue_max_events_per_depth, queue_retention_depths
+
+# 每个 agent 每轮看到的事件数：深度为 0 的事件全部包含，其余随机抽样补足
+FEED_SIZE = 6
+
+
+class _Bucket:
+    # 同一深度的事件，按 (序号, 事件) 排列；前端用反向列表实现，两端追加和按下标访问都是 O(1)
+    __slots__ = ('front', 'back')
+
+    def __init__(self):
+        self.front = []
+        self.back = []
+
+    def __len__(self):
+        return len(self.front) + len(self.back)
+
+    def __getitem__(self, index):
+        if index < len(self.front):
+            return self.front[-1 - index]
+        return self.back[index - len(self.front)]
+
+    def __iter__(self):
+        yield from reversed(self.front)
+        yield from self.back
+
+
+class _EventView(Sequence):
+    # 只读的事件序列，供 random.sample 按下标取样，不复制整个队列
+    def __init__(self, entries):
+        self._entries = entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __getitem__(self, index):
+        return self._entries[index][1]
+
+
+class EventQueue:
+    # 全局事件队列，按深度索引，迭代顺序与 deque 相同：left=True 相当于 appendleft（用户发帖）；
+    # 每个深度最多 max_per_depth 个事件，prune 按 retention_depths 清理旧深度
+
+    def __init__(self, events=(), max_per_depth=queue_max_events_per_depth, retention_depths=queue_retention_depths):
+        self.max_per_depth = max_per_depth
+        self.retention_depths = retention_depths
+        self._buckets = {}
+        self._size = 0
+        # 前端追加的序号递减，后端追加的递增，按序号合并即为队列顺序
+        self._first_seq = 0
+        self._next_seq = 0
+        self._feed = None
+        # 已保存的队列原样加载，上限只作用于之后加入的事件
+        for event in events:
+            self._add(event, left=False)
+
+    def __len__(self):
+        return self._size
+
+    def __iter__(self):
+        for _, event in heapq.merge(*self._buckets.values()):
+            yield event
+
+    def depth_counts(self):
+        return {depth: len(bucket) for depth, bucket in self._buckets.items()}
+
+    def append(self, event, left=False):
+        # 该深度已满、事件被丢弃时返回 False
+        if not left and self.max_per_depth is not None and len(self._buckets.get(event[3], ())) >= self.max_per_depth:
+            return False
+        self._add(event, left)
+        return True
+
+    def _add(self, event, left):
+        bucket = self._buckets.get(event[3])
+        if bucket is None:
+            bucket = self._buckets[event[3]] = _Bucket()
+        if left:
+            self._first_seq -= 1
+            bucket.front.append((self._first_seq, event))
+        else:
+            bucket.back.append((self._next_seq, event))
+            self._next_seq += 1
+        self._size += 1
+        self._feed = None
+
+    def prune(self, min_depth):
+        # 返回实际保留的最小深度；从不清理时返回 None
+        if self.retention_depths is None:
+            return None
+        min_depth = min_depth - self.retention_depths + 1
+        for depth in [depth for depth in self._buckets if depth < min_depth]:
+            self._size -= len(self._buckets.pop(depth))
+        self._feed = None
+        return min_depth
+
+    def feed(self, rng, size=FEED_SIZE):
+        # 与在队列列表上抽样的结果相同，带种子的运行不变；抽样视图在队列变化后只建一次
+        if self._feed is None:
+            mandatory = [event for _, event in self._buckets.get(0, ())]
+            others = [bucket for depth, bucket in self._buckets.items() if depth != 0 and len(bucket)]
+            # 通常只有一个非零深度，直接在其上取样；多个深度时按序号合并一次
+            entries = others[0] if len(others) == 1 else list(heapq.merge(*others))
+            self._feed = (mandatory, _EventView(entries))
+        mandatory, others = self._feed
+        return mandatory + rng.sample(others, min(max(0, size - len(mandatory)), len(others)))
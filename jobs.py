@@ -0,0 +1,154 @@
+import threading
+import time
+import traceback
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from config import job_history_size, max_simulation_jobs
+from main import SimulationCancelled
+
+QUEUED = 'queued'
+RUNNING = 'running'
+COMPLETED = 'completed'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+
+FINISHED = (COMPLETED, FAILED, CANCELLED)
+
+
+class Job:
+    # 后台模拟任务，带进度事件和取消标志
+
+    def __init__(self, key, params=None):
+        self.id = uuid.uuid4().hex
+        self.key = key
+        self.params = params or {}
+        self.status = QUEUED
+        self.error = None
+        self.events = []
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.cancel_event = threading.Event()
+        self._condition = threading.Condition()
+
+    @property
+    def done(self):
+        return self.status in FINISHED
+
+    def report(self, update):
+        # 并发模式下多个工作线程会同时上报
+        with self._condition:
+            self.events.append(dict(update, time=time.time()))
+            self._condition.notify_all()
+
+    def _set_status(self, status, error=None):
+        with self._condition:
+            self.status = status
+            self.error = error
+            if status == RUNNING:
+                self.started = time.time()
+            elif status in FINISHED:
+                self.finished = time.time()
+            self.events.append({'type': 'status', 'status': status, 'error': error, 'time': time.time()})
+            self._condition.notify_all()
+
+    def wait_events(self, start, timeout=None):
+        # 返回 start 之后的事件，最多等待 timeout 秒
+        with self._condition:
+            if len(self.events) <= start and not self.done:
+                self._condition.wait(timeout)
+            return self.events[start:], self.done
+
+    def to_dict(self):
+        with self._condition:
+            progress = [event for event in self.events if event['type'] in ('start', 'event')]
+            start = next((event for event in progress if event['type'] == 'start'), None)
+            processed = sum(1 for event in progress if event['type'] == 'event')
+            return {
+                'id': self.id,
+                'key': self.key,
+                'params': self.params,
+                'status': self.status,
+                'error': self.error,
+                'created': self.created,
+                'started': self.started,
+                'finished': self.finished,
+                'processed_events': processed,
+                'total_events': start['events'] if start else None,
+                'last_event': self.events[-1] if self.events else None
+            }
+
+
+class JobManager:
+    # 在线程池中运行模拟任务，每个场景同时最多一个活动任务
+
+    def __init__(self, max_workers=max_simulation_jobs, history_size=job_history_size):
+        self.history_size = history_size
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='simulation-job')
+        self._jobs = OrderedDict()
+        self._active = {}
+        self._lock = threading.Lock()
+
+    def submit(self, key, fn, params=None):
+        # 同一 key 已有活动任务时返回该任务，created 为 False
+        with self._lock:
+            active = self._active.get(key)
+            if active is not None:
+                return active, False
+            job = Job(key, params)
+            self._jobs[job.id] = job
+            self._active[key] = job
+            self._trim_history()
+        self._executor.submit(self._run, job, fn)
+        return job, True
+
+    def _trim_history(self):
+        finished = [job_id for job_id, job in self._jobs.items() if job.done]
+        for job_id in finished[:max(0, len(finished) - self.history_size)]:
+            del self._jobs[job_id]
+
+    def _run(self, job, fn):
+        try:
+            if job.cancel_event.is_set():
+                raise SimulationCancelled()
+            job._set_status(RUNNING)
+            fn(job)
+            job._set_status(COMPLETED)
+        except SimulationCancelled:
+            job._set_status(CANCELLED)
+        except Exception as e:
+            traceback.print_exc()
+            job._set_status(FAILED, str(e))
+        finally:
+            with self._lock:
+                if self._active.get(job.key) is job:
+                    del self._active[job.key]
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def active(self, key):
+        with self._lock:
+            return self._active.get(key)
+
+    def cancel(self, job_id):
+        job = self.get(job_id)
+        if job is not None and not job.done:
+            # 在下一个事件开始前生效，正在进行的 LLM 调用不会被打断
+            job.cancel_event.set()
+        return job
+
+    def list(self):
+        with self._lock:
+            jobs = list(self._jobs.values())
+        return [job.to_dict() for job in jobs]
+
+    def shutdown(self):
+        with self._lock:
+            jobs = list(self._active.values())
+        for job in jobs:
+            job.cancel_event.set()
+        self._executor.shutdown(wait=True)
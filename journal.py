@@ -0,0 +1,118 @@
+import json
+import os
+
+
+class ScenarioJournal:
+    # 上次完整快照之后的场景修改，追加写入 JSONL；加载时在快照数据上回放，压缩时重写快照并清空日志
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._buffer = []
+        self.record_count = sum(1 for _ in self.records())
+        # 各 agent 上次写入日志（或快照）的状态，未变化的 agent 不再重复记录
+        self._agent_states = {}
+
+    def append(self, op, **fields):
+        fields['op'] = op
+        self._buffer.append(fields)
+
+    def flush(self):
+        if not self._buffer:
+            return
+        with open(self.filename, 'a', encoding='utf-8') as f:
+            for record in self._buffer:
+                f.write(json.dumps(record, ensure_ascii=False) + '\n')
+        self.record_count += len(self._buffer)
+        self._buffer = []
+
+    def append_agent(self, name, state):
+        encoded = json.dumps(state, ensure_ascii=False, sort_keys=True)
+        if self._agent_states.get(name) == encoded:
+            return
+        self._agent_states[name] = encoded
+        self.append('agent', agent=name, state=state)
+
+    def remember_agents(self, agents):
+        # 加载或写完整快照后调用：此时磁盘上的状态就是 agent 的当前状态
+        self._agent_states = {agent.name: json.dumps(agent.state_dict(), ensure_ascii=False, sort_keys=True)
+                              for agent in agents}
+
+    def truncate(self):
+        self._buffer = []
+        self.record_count = 0
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
+
+    def records(self, *ops):
+        if not os.path.exists(self.filename):
+            return
+        with open(self.filename, 'r', encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # 进程中断时最后一行可能不完整
+                    print(f"Warning: truncated journal record in {self.filename}")
+                    break
+                if not ops or record['op'] in ops:
+                    yield record
+
+    def replay_tweets(self, tweets):
+        tweet_dict = {tweet['hash_id']: tweet for tweet in tweets}
+        for record in self.records('tweet', 'like'):
+            if record['op'] == 'tweet':
+                tweet = record['tweet']
+                if tweet['hash_id'] in tweet_dict:
+                    tweet_dict[tweet['hash_id']].update(tweet)
+                else:
+                    tweets.append(tweet)
+                    tweet_dict[tweet['hash_id']] = tweet
+            else:
+                tweet = tweet_dict.get(record['hash_id'])
+                if tweet is not None and record['user'] not in tweet['likes']:
+                    tweet['likes'].append(record['user'])
+        return tweets
+
+    def replay_queue(self, queue):
+        for record in self.records('enqueue', 'prune_queue'):
+            if record['op'] == 'enqueue':
+                if record['left']:
+                    queue.insert(0, record['event'])
+                else:
+                    queue.append(record['event'])
+            else:
+                queue = [event for event in queue if event[3] > record['min_depth'] - 1]
+        return queue
+
+    def agent_records(self):
+        # 按 agent 名分组，保持日志中的顺序
+        records = {}
+        for record in self.records('agent', 'memory', 'forget'):
+            records.setdefault(record['agent'], []).append(record)
+        return records
+
+    @staticmethod
+    def replay_agent(agent, records):
+        # records 来自 agent_records()，流式加载时逐个 agent 回放
+        for record in records.get(agent['name'], ()):
+            if record['op'] == 'agent':
+                agent.update(record['state'])
+            elif record['op'] == 'forget':
+                agent['experiences'].pop(record['key'], None)
+            else:
+                agent['experiences'][record['key']] = record['memory']
+        return agent
+
+    def replay_agents(self, agents):
+        records = self.agent_records()
+        for agent in agents:
+            self.replay_agent(agent, records)
+        return agents
+
+    def replay_virtual_time(self, virtual_time):
+        for record in self.records('virtual_time'):
+            virtual_time = record['virtual_time']
+        return virtual_time
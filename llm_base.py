@@ -1,29 +1,332 @@
+import json
+import random
+import threading
 import time
-from openai import OpenAI
+from collections import deque
 
-client = OpenAI(
-    # This is the default and can be omitted
-    api_key='',
+import httpx
+from openai import OpenAI, APIConnectionError, APIStatusError
+
+from config import (llm_backend, llm_model, max_concurrent_llm_requests, llm_cache_file, llm_cache_max_entries, llm_cache_max_age,
+                    llm_requests_per_minute, llm_tokens_per_minute, llm_expected_completion_tokens, llm_timeout,
+                    llm_max_retries, llm_retry_base_delay, llm_retry_max_delay, llm_max_connections)
+from llm_cache import ResponseCache
+from rate_limiter import TokenBucket
+
+# 所有 agent 共用同一个连接池，避免每次请求重新建立 TLS 连接
+http_client = httpx.Client(
+    limits=httpx.Limits(max_connections=llm_max_connections, max_keepalive_connections=llm_max_connections),
+    timeout=llm_timeout,
 )
 
 
-def send_message(system_message: str, user_message: str, model='gpt-3.5-turbo'):
+def create_client():
+    return OpenAI(
+        # This is the default and can be omitted
+        api_key='',
+        # 重试由 send_message 统一处理
+        max_retries=0,
+        timeout=llm_timeout,
+        http_client=http_client,
+    )
+
+
+_in_flight = threading.BoundedSemaphore(max_concurrent_llm_requests)
+
+
+def set_max_concurrent_requests(limit):
+    global _in_flight
+    _in_flight = threading.BoundedSemaphore(limit)
+
+
+def set_request_limiter(limiter):
+    # 多进程批量运行时传入 multiprocessing.Manager().BoundedSemaphore，所有进程共享同一上限
+    global _in_flight
+    _in_flight = limiter
+
+
+_request_bucket = None
+_token_bucket = None
+
+
+def set_rate_limits(requests_per_minute, tokens_per_minute):
+    set_rate_limiters(TokenBucket(requests_per_minute) if requests_per_minute else None,
+                      TokenBucket(tokens_per_minute) if tokens_per_minute else None)
+
+
+def set_rate_limiters(request_bucket, token_bucket):
+    # 多进程批量运行时传入 RateLimitManager 中令牌桶的代理，所有进程共享同一份每分钟限额
+    global _request_bucket, _token_bucket
+    _request_bucket = request_bucket
+    _token_bucket = token_bucket
+
+
+set_rate_limits(llm_requests_per_minute, llm_tokens_per_minute)
 
-    chat_completion = client.chat.completions.create(
-        messages=[
-            {
-                "role": 'system',
-                "content": system_message
-            },
-            {
-                "role": 'user',
-                "content": user_message
+
+def estimate_tokens(text):
+    # 英文约 4 个字符一个 token，只用于预扣，返回后按实际用量结算
+    return len(text) // 4 + 1
+
+
+class CallStats:
+    # 按调用位置统计 LLM 调用的延迟、重试、token 和缓存命中
+
+    def __init__(self, window=1000):
+        self._lock = threading.Lock()
+        self._window = window
+        self._labels = {}
+
+    def _entry(self, label):
+        entry = self._labels.get(label)
+        if entry is None:
+            entry = self._labels[label] = {
+                'calls': 0, 'failures': 0, 'retries': 0, 'cache_hits': 0, 'prompt_tokens': 0,
+                'completion_tokens': 0, 'total_latency': 0.0, 'total_wait': 0.0,
+                'latencies': deque(maxlen=self._window)
             }
-        ],
-        model=model,
-    )
+        return entry
+
+    def record(self, label, latency, wait, retries, prompt_tokens, completion_tokens, failed=False):
+        with self._lock:
+            entry = self._entry(label)
+            entry['calls'] += 1
+            entry['failures'] += failed
+            entry['retries'] += retries
+            entry['prompt_tokens'] += prompt_tokens
+            entry['completion_tokens'] += completion_tokens
+            entry['total_latency'] += latency
+            entry['total_wait'] += wait
+            if not failed:
+                entry['latencies'].append(latency)
+
+    def record_cache_hit(self, label):
+        with self._lock:
+            self._entry(label)['cache_hits'] += 1
+
+    def reset(self):
+        with self._lock:
+            self._labels = {}
+
+    @staticmethod
+    def _summarize(entries):
+        summary = {key: sum(entry[key] for entry in entries) for key in (
+            'calls', 'failures', 'retries', 'cache_hits', 'prompt_tokens', 'completion_tokens', 'total_latency',
+            'total_wait')}
+        calls = summary['calls']
+        succeeded = calls - summary['failures']
+        latencies = sorted(latency for entry in entries for latency in entry['latencies'])
+        summary['tokens'] = summary['prompt_tokens'] + summary['completion_tokens']
+        summary['mean_latency'] = summary['total_latency'] / calls if calls else None
+        summary['p50_latency'] = latencies[len(latencies) // 2] if latencies else None
+        summary['p95_latency'] = latencies[int(len(latencies) * 0.95)] if latencies else None
+        summary['max_latency'] = latencies[-1] if latencies else None
+        summary['mean_tokens'] = summary['tokens'] / succeeded if succeeded else None
+        return summary
+
+    def summary(self):
+        with self._lock:
+            entries = dict(self._labels)
+            labels = {label: self._summarize([entry]) for label, entry in sorted(entries.items())}
+            total = self._summarize(list(entries.values()))
+        total['labels'] = labels
+        return total
+
+
+call_stats = CallStats()
+
+
+def get_call_stats():
+    return call_stats.summary()
+
+
+def reset_call_stats():
+    call_stats.reset()
+
+
+def format_call_stats(stats=None):
+    stats = stats or get_call_stats()
+    lines = [f"{'label':<20}{'calls':>7}{'hits':>6}{'retry':>6}{'fail':>5}{'mean s':>9}{'p95 s':>9}"
+             f"{'total s':>10}{'prompt tok':>12}{'compl tok':>11}"]
+    # 按累计耗时排序，最耗时的调用点排在最前
+    rows = sorted(stats['labels'].items(), key=lambda item: item[1]['total_latency'], reverse=True)
+    for label, row in rows + [('TOTAL', stats)]:
+        lines.append(f"{label:<20}{row['calls']:>7}{row['cache_hits']:>6}{row['retries']:>6}{row['failures']:>5}"
+                     f"{row['mean_latency'] or 0:>9.3f}{row['p95_latency'] or 0:>9.3f}{row['total_latency']:>10.1f}"
+                     f"{row['prompt_tokens']:>12}{row['completion_tokens']:>11}")
+    return '\n'.join(lines)
+
+
+class OpenAIBackend:
+    name = 'openai'
+    cacheable = True
+
+    def __init__(self, openai_client=None, model=llm_model):
+        self._client = openai_client
+        self._client_lock = threading.Lock()
+        self.model = model
+
+    @property
+    def client(self):
+        # 延迟创建：只使用桩或缓存时不需要 API key
+        if self._client is None:
+            with self._client_lock:
+                if self._client is None:
+                    self._client = create_client()
+        return self._client
+
+    def complete(self, system_message, user_message, model, json_mode=False):
+        # 返回 (content, prompt_tokens, completion_tokens)，接口没有返回 token 数时为 None
+        # JSON 模式要求提示词中出现 "JSON"
+        extra = {'response_format': {'type': 'json_object'}} if json_mode else {}
+        chat_completion = self.client.chat.completions.create(
+            messages=[
+                {
+                    "role": 'system',
+                    "content": system_message
+                },
+                {
+                    "role": 'user',
+                    "content": user_message
+                }
+            ],
+            model=model,
+            **extra
+        )
+        content = chat_completion.choices[0].message.content
+        usage = getattr(chat_completion, 'usage', None)
+        if usage is None:
+            return content, None, None
+        return content, usage.prompt_tokens, usage.completion_tokens
+
+    def is_retryable(self, error):
+        # APITimeoutError 是 APIConnectionError 的子类
+        if isinstance(error, APIConnectionError):
+            return True
+        return isinstance(error, APIStatusError) and (error.status_code in (408, 409, 429) or error.status_code >= 500)
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_backend():
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                if llm_backend == 'stub':
+                    from llm_stub import StubBackend
+                    _backend = StubBackend()
+                else:
+                    _backend = OpenAIBackend()
+    return _backend
+
+
+def set_backend(backend):
+    global _backend
+    _backend = backend
+
+
+_jitter = random.Random()
+
+
+def retry_delay(attempt, error):
+    delay = _jitter.uniform(0, min(llm_retry_max_delay, llm_retry_base_delay * 2 ** attempt))
+    response = getattr(error, 'response', None)
+    if response is not None:
+        try:
+            # 服务端给出 Retry-After 时至少等待这么久
+            delay = max(delay, float(response.headers.get('retry-after')))
+        except (TypeError, ValueError):
+            pass
+    return delay
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_response_cache():
+    global _cache
+    if _cache is None and llm_cache_file:
+        with _cache_lock:
+            if _cache is None:
+                _cache = ResponseCache(llm_cache_file, llm_cache_max_entries, llm_cache_max_age)
+    return _cache
+
+
+def set_response_cache(cache):
+    global _cache
+    _cache = cache
+
+
+def parse_json_response(response):
+    # 模型偶尔会在 JSON 外包一层说明文字或代码块
+    start, end = response.find('{'), response.rfind('}')
+    if start == -1 or end < start:
+        return None
+    try:
+        data = json.loads(response[start:end + 1])
+    except json.JSONDecodeError:
+        return None
+    return data if isinstance(data, dict) else None
+
+
+def send_message(system_message: str, user_message: str, model=None, use_cache=True, label='other',
+                 json_mode=False):
+    # label 标识调用点（如 'importance_emotion'、'like'），按调用点统计耗时和 token
+    backend = get_backend()
+    model = model or backend.model
+    # 含随机种子的提示词，以及每次重新模拟都应重新采样的调用（点赞、反思、心情）应传 use_cache=False
+    cache = get_response_cache() if use_cache and backend.cacheable else None
+    if cache is not None:
+        cached = cache.get(backend.name, model, system_message, user_message, json_mode)
+        if cached is not None:
+            call_stats.record_cache_hit(label)
+            return cached
+
+    estimated_prompt_tokens = estimate_tokens(system_message) + estimate_tokens(user_message)
+    estimated_tokens = estimated_prompt_tokens + llm_expected_completion_tokens
+    started = time.monotonic()
+    for attempt in range(llm_max_retries + 1):
+        if _request_bucket is not None:
+            _request_bucket.acquire()
+        if _token_bucket is not None:
+            _token_bucket.acquire(estimated_tokens)
+
+        request_started = time.monotonic()
+        try:
+            with _in_flight:
+                request_started = time.monotonic()
+                content, prompt_tokens, completion_tokens = backend.complete(system_message, user_message, model,
+                                                                             json_mode)
+            break
+        except Exception as e:
+            # 失败的请求不计 token，退回预扣的额度，否则每次重试都会再扣一次，限流时拖慢其他调用
+            if _token_bucket is not None:
+                _token_bucket.adjust(-estimated_tokens)
+            if not backend.is_retryable(e) or attempt == llm_max_retries:
+                latency = time.monotonic() - request_started
+                call_stats.record(label, latency, time.monotonic() - started - latency, attempt, 0, 0, failed=True)
+                raise
+            delay = retry_delay(attempt, e)
+            print(f'LLM request failed ({type(e).__name__}), retry {attempt + 1}/{llm_max_retries} in {delay:.1f}s')
+            time.sleep(delay)
+
+    latency = time.monotonic() - request_started
+    if prompt_tokens is None:
+        prompt_tokens = estimated_prompt_tokens
+    if completion_tokens is None:
+        completion_tokens = estimate_tokens(content or '')
+    if _token_bucket is not None:
+        _token_bucket.adjust(prompt_tokens + completion_tokens - estimated_tokens)
+    call_stats.record(label, latency, time.monotonic() - started - latency, attempt, prompt_tokens, completion_tokens)
+
+    if cache is not None and content is not None:
+        cache.put(backend.name, model, system_message, user_message, content, json_mode)
 
-    return chat_completion.choices[0].message.content  # , latency  # 返回内容和延迟时间
+    return content  # , latency  # 返回内容和延迟时间
 
 
 if __name__ == '__main__':
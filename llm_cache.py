@@ -0,0 +1,94 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+
+class ResponseCache:
+    # 磁盘上的 LLM 响应缓存，键为 (后端, 模型, JSON 模式, 系统消息, 用户消息)
+
+    def __init__(self, filename, max_entries=100000, max_age=None, evict_every=100):
+        self.filename = filename
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.evict_every = evict_every
+        self.hits = 0
+        self.misses = 0
+        self._puts = 0
+        self._lock = threading.Lock()
+
+        directory = os.path.dirname(filename)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(filename, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS responses ('
+            'key TEXT PRIMARY KEY, response TEXT NOT NULL, created REAL NOT NULL, accessed REAL NOT NULL)'
+        )
+        self._conn.execute('CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)')
+        self._conn.commit()
+
+    @staticmethod
+    def make_key(backend, model, system_message, user_message, json_mode=False):
+        # JSON 模式下同一提示词的回复格式不同，不能共用
+        parts = (backend, model, 'json' if json_mode else 'text', system_message, user_message)
+        return hashlib.sha256('\x00'.join(parts).encode('utf-8')).hexdigest()
+
+    def get(self, backend, model, system_message, user_message, json_mode=False):
+        key = self.make_key(backend, model, system_message, user_message, json_mode)
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute('SELECT response, created FROM responses WHERE key = ?', (key,)).fetchone()
+            if row is None or (self.max_age is not None and now - row[1] > self.max_age):
+                self.misses += 1
+                return None
+            self._conn.execute('UPDATE responses SET accessed = ? WHERE key = ?', (now, key))
+            self._conn.commit()
+            self.hits += 1
+            return row[0]
+
+    def put(self, backend, model, system_message, user_message, response, json_mode=False):
+        key = self.make_key(backend, model, system_message, user_message, json_mode)
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO responses (key, response, created, accessed) VALUES (?, ?, ?, ?)',
+                (key, response, now, now)
+            )
+            self._conn.commit()
+            self._puts += 1
+            if self._puts % self.evict_every == 0:
+                self._evict(now)
+
+    def _evict(self, now):
+        if self.max_age is not None:
+            self._conn.execute('DELETE FROM responses WHERE created < ?', (now - self.max_age,))
+        if self.max_entries is not None:
+            # 超出容量时按最近访问时间淘汰
+            self._conn.execute(
+                'DELETE FROM responses WHERE key NOT IN '
+                '(SELECT key FROM responses ORDER BY accessed DESC LIMIT ?)',
+                (self.max_entries,)
+            )
+        self._conn.commit()
+
+    def evict(self):
+        with self._lock:
+            self._evict(time.time())
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute('DELETE FROM responses')
+            self._conn.commit()
+
+    def stats(self):
+        with self._lock:
+            entries = self._conn.execute('SELECT COUNT(*) FROM responses').fetchone()[0]
+        return {'hits': self.hits, 'misses': self.misses, 'entries': entries}
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
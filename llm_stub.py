@@ -0,0 +1,139 @@
+import hashlib
+import json
+import random
+import re
+import time
+
+from llm_base import estimate_tokens
+
+EMOTIONS = ['happy', 'angry', 'sad', 'anxious', 'excited', 'calm', 'frustrated', 'amused', 'disgusted', 'hopeful']
+FEELINGS = ['Happy', 'Annoyed', 'Curious', 'Hostile', 'Friendly', 'Indifferent', 'Suspicious', 'Amused']
+EXPRESSION_FORMS = [
+    'sarcasm with a few emojis, very short (5-10 words is acceptable)',
+    'a long rant full of dark humor and internet slang',
+    'an interesting joke, short and punchy',
+    'vulgar language with lots of emojis, fairly long',
+]
+OPENERS = ['Honestly', 'Lol', 'Wow', 'Ugh', 'Okay so', 'Imagine thinking', 'Fun fact', 'Hot take']
+STOPWORDS = {
+    'the', 'a', 'an', 'and', 'or', 'of', 'to', 'in', 'on', 'for', 'is', 'are', 'was', 'be', 'with', 'you', 'your',
+    'this', 'that', 'it', 'as', 'at', 'by', 'from', 'about', 'what', 'would', 'please', 'based', 'current',
+}
+
+
+class StubBackend:
+    # 离线的确定性对话接口：识别 agent_emotional.py 中的结构化提示，按解析器期望的格式回答；
+    # 回答和延迟只取决于提示和 seed。latency 为 ('constant', 秒)、('uniform', 下限, 上限) 或 ('lognormal', 中位数, sigma)
+
+    name = 'stub'
+    model = 'stub'
+    # 桩的回答不写入磁盘缓存，也不读取真实模型的缓存
+    cacheable = False
+
+    def __init__(self, latency=('constant', 0.0), seed=0):
+        self.latency = latency
+        self.seed = seed
+
+    def sample_latency(self, rng):
+        kind, *params = self.latency
+        if kind == 'constant':
+            return params[0]
+        if kind == 'uniform':
+            return rng.uniform(*params)
+        if kind == 'lognormal':
+            median, sigma = params
+            return median * rng.lognormvariate(0, sigma)
+        raise ValueError(f'Unknown latency distribution: {kind}')
+
+    def complete(self, system_message, user_message, model, json_mode=False):
+        digest = hashlib.md5(f'{self.seed}\x00{system_message}\x00{user_message}'.encode('utf-8')).hexdigest()
+        rng = random.Random(digest)
+        content = self.respond(system_message, user_message, rng)
+        delay = self.sample_latency(rng)
+        if delay > 0:
+            time.sleep(delay)
+        return content, estimate_tokens(system_message) + estimate_tokens(user_message), estimate_tokens(content)
+
+    def is_retryable(self, error):
+        return False
+
+    def respond(self, system_message, user_message, rng):
+        if 'Only output a JSON object' in system_message:
+            # 键名取自 "with the keys "a", "b" and "c", don't output ..."
+            keys = re.findall(r'"(\w+)"', system_message.split("don't output")[0])
+            return json.dumps({key: self.json_field(key, user_message, rng) for key in keys}, ensure_ascii=False)
+        if 'importance (1 to 10)' in user_message:
+            return f'{rng.randint(1, 10)}, {rng.choice(EMOTIONS)}, {rng.randint(0, 10)}'
+        if 'emotion type, and the emotion intensity' in user_message:
+            return f'{rng.choice(EMOTIONS)}, {rng.randint(0, 10)}'
+        if 'YES or NO' in system_message:
+            return rng.choice(['YES', 'NO'])
+        if 'feeling word and a score' in system_message:
+            return f'{rng.choice(FEELINGS)},{rng.randint(0, 10)}'
+        if "'kindly' or 'maliciously'" in user_message:
+            return rng.choice(['kindly', 'maliciously'])
+        if 'express themselves online' in user_message:
+            return rng.choice(EXPRESSION_FORMS)
+        if 'number between 0 and 10' in system_message:
+            return str(rng.randint(0, 10))
+        if 'agree or disagree' in user_message:
+            return rng.choice(['agree', 'disagree'])
+        if 'You can ask 3 questions' in user_message:
+            topic = self._words(user_message, rng, 3)
+            return '\n'.join(f'What does {name} really think about {topic}?' for name in ('everyone', 'the others', 'you'))
+        if 'create a new text to replace the following text' in user_message:
+            return self._rephrase(user_message, rng)
+        match = re.search(r"Fill in blank: '@(.*?) your_content'", system_message)
+        if match:
+            if 'NULLUSER your_content' in system_message and rng.random() < 0.2:
+                return f'NULLUSER {self._sentence(user_message, rng)}'
+            return f'@{match.group(1)} {self._sentence(user_message, rng)}'
+        if 'new tweet would you post' in user_message:
+            return f'({self._sentence(user_message, rng)})'
+        if 'current mood in one sentence' in system_message:
+            return f'You feel {rng.choice(EMOTIONS)} about {self._words(user_message, rng, 4)}.'
+        if 'summarize your current motivation' in user_message:
+            return (f'You want to talk about {self._words(user_message, rng, 5)} '
+                    f'because you feel {rng.choice(EMOTIONS)}.')
+        return self._sentence(user_message, rng)
+
+    def json_field(self, key, user_message, rng):
+        if key in ('importance', 'feeling_score'):
+            return rng.randint(1, 10)
+        if key in ('emotion_intensity', 'next_intensity'):
+            return rng.randint(0, 10)
+        if key == 'emotion_type':
+            return rng.choice(EMOTIONS)
+        if key == 'feeling_word':
+            return rng.choice(FEELINGS)
+        if key == 'like':
+            return rng.choice(['YES', 'NO'])
+        if key == 'agreement':
+            return rng.choice(['agree', 'disagree'])
+        if key == 'tweet':
+            match = re.search(r"'@(.*?) your_content'", user_message)
+            if match is None or 'NULLUSER your_content' in user_message and rng.random() < 0.2:
+                return f'NULLUSER {self._sentence(user_message, rng)}'
+            return f'@{match.group(1)} {self._sentence(user_message, rng)}'
+        if key == 'response_type':
+            return rng.choice(['kindly', 'maliciously'])
+        if key == 'expression_form':
+            return rng.choice(EXPRESSION_FORMS)
+        if key == 'text':
+            return self._rephrase(user_message, rng)
+        return self._sentence(user_message, rng)
+
+    def _rephrase(self, user_message, rng):
+        match = re.search(r'unique personality and current state: (.*)\n\nFollow the random seed', user_message, re.S)
+        original = match.group(1).strip() if match else ''
+        return f'{rng.choice(OPENERS)} {original} {self._words(user_message, rng, rng.randint(3, 8))}'
+
+    @staticmethod
+    def _words(text, rng, count):
+        words = [word for word in re.findall(r'[A-Za-z]{3,}', text) if word.lower() not in STOPWORDS]
+        if not words:
+            return 'things'
+        return ' '.join(rng.choice(words) for _ in range(count))
+
+    def _sentence(self, text, rng):
+        return f'{rng.choice(OPENERS)}, {self._words(text, rng, rng.randint(8, 25))}'
@@ -1,12 +1,25 @@
+import contextvars
 import hashlib
 import json
 import os
 import random
-from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
+import numpy as np
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
 from agent_emotional import Agent
-from config import default_agents_list, init_depth, get_depth
+from config import default_agents_list, init_depth, get_depth, journal_compaction_records
+from embedding_model import get_embedding_service
+from embedding_store import EmbeddingReaders, EmbeddingWriter, split_embeddings, write_agents_file
+from journal import ScenarioJournal
+from llm_base import format_call_stats
+from snapshot_store import SnapshotStore
 from tweet import Tweet
 from utils import GlobalContext
 from virtual_time import VirtualTime
@@ -16,6 +29,47 @@ def md5_hash(text):
     return hashlib.md5(text.encode('utf-8')).hexdigest()
 
 
+def scenario_id(event_hash, branch='main'):
+    # 分支的工作文件与会话都以 "<event_hash>-<branch>" 区分，main 分支沿用原来的文件名
+    return event_hash if branch == 'main' else f'{event_hash}-{branch}'
+
+
+def split_scenario_id(scenario):
+    event_hash, _, branch = scenario.partition('-')
+    return event_hash, branch or 'main'
+
+
+def scenario_files(event_hash, output_dir='Output'):
+    return {
+        'agents': f'{output_dir}/Agents/agents_{event_hash}.json',
+        'tweets': f'{output_dir}/Tweets/tweets_{event_hash}.json',
+        'global_queue': f'{output_dir}/GlobalContext/global_queue_{event_hash}.json',
+        'virtual_time': f'{output_dir}/GlobalContext/virtual_time_{event_hash}.json',
+        'journal': f'{output_dir}/GlobalContext/journal_{event_hash}.jsonl',
+        'archive': f'{output_dir}/Agents/archive_{event_hash}.jsonl'
+    }
+
+
+def make_output_dirs(output_dir='Output'):
+    for directory in ('Agents', 'Tweets', 'GlobalContext'):
+        os.makedirs(os.path.join(output_dir, directory), exist_ok=True)
+
+
+def read_json_file(filename, default=None):
+    if not os.path.exists(filename):
+        return default
+    with open(filename, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def write_json_file(filename, data):
+    # 先写临时文件再替换，中途出错不会留下截断的 JSON
+    temp_file = filename + '.tmp'
+    with open(temp_file, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, indent=4)
+    os.replace(temp_file, filename)
+
+
 def load_test_events(events_file):
     with open(events_file, 'r', encoding='utf-8') as file:
         events = file.readlines()
@@ -39,14 +93,39 @@ def initialize_agents(agents_properties, global_context):
 
 
 def save_agents(agents, filename):
-    with open(filename, 'w', encoding='utf-8') as f:
-        json.dump([agent.to_dict() for agent in agents], f, ensure_ascii=False, indent=4)
-
-
-def load_agents(filename, global_context):
-    with open(filename, 'r', encoding='utf-8') as f:
-        data = json.load(f)
-    return [Agent.from_dict(agent_data, global_context) for agent_data in data]
+    get_embedding_service().flush()
+    embedding_writer = EmbeddingWriter()
+    data = [agent.to_dict(embedding_writer) for agent in agents]
+    write_agents_file(filename, data, embedding_writer)
+
+
+def iter_agents_file(filename):
+    # 安装了 ijson 时逐个 agent 解析，内存中只保留当前 agent 的原始数据
+    with open(filename, 'rb') as f:
+        if ijson is None:
+            yield from json.load(f)
+        else:
+            yield from ijson.items(f, 'item', use_float=True)
+
+
+def load_agents(filename, global_context, journal=None, max_depth=None):
+    # 解析时跳过 depth >= max_depth 的记忆；嵌入留在 .npy 旁路文件中，检索需要时才读取
+    records = journal.agent_records() if journal is not None else {}
+    # 兼容旧格式：JSON 中内联的 embedding 列表优先于 .npy 旁路文件
+    embedding_readers = EmbeddingReaders(filename)
+    agents = []
+    skipped = 0
+    for agent_data in iter_agents_file(filename):
+        ScenarioJournal.replay_agent(agent_data, records)
+        if max_depth is not None:
+            experiences = agent_data['experiences']
+            agent_data['experiences'] = {k: v for k, v in experiences.items() if v.get('depth', 0) < max_depth}
+            skipped += len(experiences) - len(agent_data['experiences'])
+        agents.append(Agent.from_dict(agent_data, global_context, embedding_readers.get(agent_data)))
+    if skipped:
+        # 被跳过的记忆仍在磁盘快照中，下次保存时必须整体重写
+        global_context.needs_full_save = True
+    return agents
 
 
 def save_global_context_queue(global_context, filename):
@@ -57,7 +136,7 @@ def save_global_context_queue(global_context, filename):
 def load_global_context_queue(global_context, filename):
     with open(filename, 'r', encoding='utf-8') as f:
         data = json.load(f)
-    global_context.global_queue = deque(data)
+    global_context.global_queue = data
     return global_context
 
 
@@ -72,41 +151,96 @@ def load_virtual_time(filename):
     return VirtualTime.from_dict(data)
 
 
-def run_simulation_for_event(event, global_context):
+class SimulationCancelled(Exception):
+    pass
+
+
+def check_cancelled(cancel_event):
+    if cancel_event is not None and cancel_event.is_set():
+        raise SimulationCancelled()
+
+
+def react_to_events(agent, selected_events, progress=None, cancel_event=None):
+    for index, event in enumerate(selected_events):
+        check_cancelled(cancel_event)
+        current_event, current_event_time, current_hash_id, _ = event
+        print(f"{agent.name}：正在处理事件: {current_hash_id}")
+        agent.react_to_event(current_event, current_event_time, current_hash_id)
+        if progress is not None:
+            progress({'type': 'event', 'agent': agent.name, 'hash_id': current_hash_id, 'index': index + 1,
+                      'total': len(selected_events)})
+    agent.consolidate_memories()
+    if progress is not None:
+        progress({'type': 'agent', 'agent': agent.name, 'events': len(selected_events)})
+
+
+def react_concurrently(global_context, agent_events, max_workers, ordered, progress=None, cancel_event=None):
+    def react(agent, selected_events):
+        if not ordered:
+            react_to_events(agent, selected_events, progress, cancel_event)
+            return []
+        with global_context.staged_changes() as changes:
+            react_to_events(agent, selected_events, progress, cancel_event)
+        return changes
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # 工作线程继承提交者的上下文（当前场景的模拟深度）
+        futures = [executor.submit(contextvars.copy_context().run, react, agent, selected_events)
+                   for agent, selected_events in agent_events]
+        results = [future.result() for future in futures]
+
+    # 所有 agent 完成后再按 agent 顺序提交，推文顺序、时间和队列与完成先后无关
+    for changes in results:
+        global_context.commit_changes(changes)
+
+
+def run_simulation_for_event(event, global_context, max_workers=1, ordered=True, seed=None, progress=None,
+                             cancel_event=None):
     agents = global_context.agents
     event_time = global_context.virtual_time.get_current_time()
 
+    rng = random
+    if seed is not None:
+        rng = random.Random(f'{seed}-{get_depth()}')
+        global_context.rng = rng
+        for agent in agents:
+            agent.rng = np.random.RandomState(int(md5_hash(f'{seed}-{get_depth()}-{agent.name}')[:8], 16))
+
     if len(global_context.global_queue) <= 1:
         print("初始化队列，执行强制post")
-        selected_agents = random.sample(agents, 2)
+        selected_agents = rng.sample(agents, 2)
         for agent in selected_agents:
+            check_cancelled(cancel_event)
             tweet_content, tweet_hash_id = agent.force_post_tweet(event)
             print('强制推文：', tweet_content)
             print('强制推文hash id：', tweet_hash_id)
-            global_context.global_queue.append((tweet_content, event_time, tweet_hash_id, max(0, get_depth() - 1)))
+            global_context.enqueue((tweet_content, event_time, tweet_hash_id, max(0, get_depth() - 1)))
 
-    events_to_process = [event for event in global_context.global_queue]
-    mandatory_events = [event for event in events_to_process if event[3] == 0]
+    agent_events = []
     for agent in agents:
         if not agent.online:
             print(f"{agent.name}已下线，没有看见任何消息")
             continue
 
-        # 确保 event[3] == 0 的事件一定被选中
-        remaining_events = [event for event in events_to_process if event[3] != 0]
+        # 深度为 0 的事件一定被选中，其余随机选择，使总数达到 6 个；队列按深度索引，不必每个 agent 复制一遍
+        selected_events = global_context.global_queue.feed(rng)
+        agent_events.append((agent, selected_events))
 
-        # 随机选择剩余的事件，使总数达到6个
-        selected_events = mandatory_events + random.sample(remaining_events,
-                                                           min(max(0, 6 - len(mandatory_events)),
-                                                               len(remaining_events)))
+    if progress is not None:
+        progress({'type': 'start', 'depth': get_depth(), 'agents': [agent.name for agent, _ in agent_events],
+                  'events': sum(len(selected_events) for _, selected_events in agent_events)})
 
-        for event in selected_events:
-            current_event, current_event_time, current_hash_id, _ = event
-            print(f"{agent.name}：正在处理事件: {current_hash_id}")
-            agent.react_to_event(current_event, current_event_time, current_hash_id)
+    if max_workers > 1:
+        react_concurrently(global_context, agent_events, max_workers, ordered, progress, cancel_event)
+    else:
+        for agent, selected_events in agent_events:
+            react_to_events(agent, selected_events, progress, cancel_event)
 
         # 更新 global_queue，去掉已处理的事件
-    global_context.global_queue = deque([event for event in global_context.global_queue if event[3] > get_depth() - 1])
+    global_context.prune_queue(get_depth())
+
+    # 本轮所有 agent 新增、尚未被检索触发的记忆一次性批量嵌入
+    get_embedding_service().flush()
 
 
 def save_simulation_data(agents, agents_file, global_context, global_context_file, tweets_file, virtual_time_file):
@@ -116,13 +250,119 @@ def save_simulation_data(agents, agents_file, global_context, global_context_fil
     save_virtual_time(global_context.virtual_time, virtual_time_file)
 
 
+def archive_memories(agents, filename):
+    # 合并为摘要的原始记忆追加到归档文件，不再参与检索
+    entries = []
+    for agent in agents:
+        entries.extend(agent.archived_memories)
+        agent.archived_memories = []
+    if not entries:
+        return
+    with open(filename, 'a', encoding='utf-8') as f:
+        for entry in entries:
+            f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+
+
+def checkpoint_simulation_data(global_context, files):
+    # 只把本次变化追加到日志；日志过长或状态被整体修改时才重写完整快照
+    journal = global_context.journal
+    agents = global_context.agents
+    archive_memories(agents, files['archive'])
+    if journal is not None and not global_context.needs_full_save:
+        get_embedding_service().flush()
+        for agent in agents:
+            journal.append_agent(agent.name, agent.state_dict())
+            for key in agent.experiences.drain_removed():
+                journal.append('forget', agent=agent.name, key=str(key))
+            for key in agent.experiences.drain_dirty():
+                journal.append('memory', agent=agent.name, key=str(key), memory=agent.experiences[key].to_dict())
+        journal.append('virtual_time', virtual_time=global_context.virtual_time.to_dict())
+        journal.flush()
+        if journal.record_count < journal_compaction_records:
+            return
+
+    save_simulation_data(agents, files['agents'], global_context, files['global_queue'], files['tweets'],
+                         files['virtual_time'])
+    for agent in agents:
+        agent.experiences.mark_clean()
+    if journal is not None:
+        journal.truncate()
+        journal.remember_agents(agents)
+    global_context.needs_full_save = False
+
+
+def compact_scenario(event_hash, output_dir='Output'):
+    # 在原始 JSON 层面合并日志，不需要构造 Agent 或加载嵌入模型
+    files = scenario_files(event_hash, output_dir)
+    journal = ScenarioJournal(files['journal'])
+    if journal.record_count == 0:
+        return
+
+    if os.path.exists(files['agents']):
+        agents = journal.replay_agents(read_json_file(files['agents']))
+        write_agents_file(files['agents'], agents, split_embeddings(agents, files['agents']))
+    write_json_file(files['tweets'], journal.replay_tweets(read_json_file(files['tweets'], [])))
+    write_json_file(files['global_queue'], journal.replay_queue(read_json_file(files['global_queue'], [])))
+    virtual_time = journal.replay_virtual_time(read_json_file(files['virtual_time']))
+    if virtual_time is not None:
+        write_json_file(files['virtual_time'], virtual_time)
+    journal.truncate()
+
+
+def load_scenario(event, event_hash=None, output_dir='Output', depth=None):
+    # 给定 depth 时只加载 depth 之前的状态，回退到较早深度不需要构造被丢弃的数据
+    global_context = GlobalContext(event)
+    scenario = event_hash or md5_hash(event)
+    files = scenario_files(scenario, output_dir)
+    journal = ScenarioJournal(files['journal'])
+    global_context.journal = journal
+
+    base_hash, global_context.branch = split_scenario_id(scenario)
+    snapshots = SnapshotStore(base_hash, output_dir)
+    global_context.snapshots = snapshots
+    latest = snapshots.latest(global_context.branch)
+    # 工作文件与最新快照同时写入，两者一致；回退或新建的分支直接从快照恢复
+    restore_depth = None
+    if latest is not None and depth is not None and depth <= latest:
+        restore_depth = depth - 1
+    elif latest is not None and not os.path.exists(files['agents']):
+        restore_depth = latest
+    if restore_depth is not None and snapshots.restore(global_context.branch, restore_depth, global_context):
+        global_context.snapshot_depth = restore_depth
+        global_context.needs_full_save = True
+        return global_context, files
+    global_context.snapshot_depth = latest
+
+    if os.path.exists(files['agents']):
+        agents = load_agents(files['agents'], global_context, journal, depth)
+    else:
+        agents = initialize_agents(default_agents_list, global_context)
+        global_context.needs_full_save = True
+
+    global_context.agents = agents
+    journal.remember_agents(agents)
+
+    tweets = journal.replay_tweets(read_json_file(files['tweets'], []))
+    global_context.tweet_log = [Tweet.from_dict(tweet) for tweet in tweets]
+
+    global_context.global_queue = journal.replay_queue(read_json_file(files['global_queue'], []))
+
+    virtual_time = journal.replay_virtual_time(read_json_file(files['virtual_time']))
+    if virtual_time is not None:
+        global_context.virtual_time = VirtualTime.from_dict(virtual_time)
+    else:
+        global_context.virtual_time = VirtualTime(start_time=datetime(2024, 1, 1, 9, 0))
+
+    return global_context, files
+
+
 def filter_data_by_depth(data, current_depth):
     return [item for item in data if item.depth < current_depth]
 
 
 def filter_agent_experiences(agents, current_depth):
     for agent in agents:
-        agent.experiences = {k: v for k, v in agent.experiences.items() if v.depth < current_depth}
+        agent.experiences.filter_depth(current_depth)
     return agents
 
 
@@ -144,138 +384,117 @@ def print_max_depth(agents, tweets, global_queue):
     return max_depth
 
 
-def process(event, current_depth):
-    global_context = GlobalContext(event)
-
-    event_hash = md5_hash(event)
-    agents_file = f'Output/Agents/agents_{event_hash}.json'
-    tweets_file = f'Output/Tweets/tweets_{event_hash}.json'
-    global_context_file = f'Output/GlobalContext/global_queue_{event_hash}.json'
-    virtual_time_file = f'Output/GlobalContext/virtual_time_{event_hash}.json'
+def process(event, current_depth, max_workers=1, ordered=True, seed=None, output_dir='Output', text_tuning_mode=None,
+            decision_mode=None, branch='main'):
+    global_context, files = load_scenario(event, scenario_id(md5_hash(event), branch), output_dir, current_depth)
+    simulate_step(global_context, files, current_depth, max_workers, ordered, seed, text_tuning_mode=text_tuning_mode,
+                  decision_mode=decision_mode)
+    print(format_call_stats())
 
-    if os.path.exists(agents_file):
-        agents = load_agents(agents_file, global_context)
-    else:
-        agents = initialize_agents(default_agents_list, global_context)
 
-    global_context.agents = agents
+def simulate_step(global_context, files, current_depth, max_workers=1, ordered=True, seed=None, progress=None,
+                  cancel_event=None, text_tuning_mode=None, decision_mode=None):
+    if text_tuning_mode is not None:
+        global_context.text_tuning_mode = text_tuning_mode
+    if decision_mode is not None:
+        global_context.decision_mode = decision_mode
 
-    if os.path.exists(tweets_file):
-        tweets = Tweet.load_tweets(tweets_file)
-    else:
-        tweets = []
+    init_depth(current_depth)
+    debug_depth = get_depth()
 
-    if os.path.exists(global_context_file):
-        load_global_context_queue(global_context, global_context_file)
-    else:
-        global_context.global_queue = deque()
+    snapshots = global_context.snapshots
+    if snapshots is not None:
+        # 重新模拟已完成的深度：直接换成上一深度的快照，不需要按深度过滤
+        if (global_context.snapshot_depth is not None and global_context.snapshot_depth >= current_depth and
+                snapshots.restore(global_context.branch, current_depth - 1, global_context)):
+            global_context.snapshot_depth = current_depth - 1
+            global_context.needs_full_save = True
 
-    if os.path.exists(virtual_time_file):
-        global_context.virtual_time = load_virtual_time(virtual_time_file)
-    else:
-        global_context.virtual_time = VirtualTime(start_time=datetime(2024, 1, 1, 9, 0))
+    agents = global_context.agents
+    tweets = global_context.tweet_log
 
-    init_depth(current_depth)
-    debug_depth = get_depth()
+    memory_count = sum(len(agent.experiences) for agent in agents)
+    tweet_count = len(tweets)
 
     agents = filter_agent_experiences(agents, get_depth())
     tweets = filter_data_by_depth(tweets, get_depth())
 
+    # 回退到较早深度时丢弃的数据无法用追加日志表达
+    if sum(len(agent.experiences) for agent in agents) != memory_count or len(tweets) != tweet_count:
+        global_context.needs_full_save = True
+
     global_context.tweet_log = tweets
 
-    run_simulation_for_event(event, global_context)
-    save_simulation_data(agents, agents_file, global_context, global_context_file, tweets_file, virtual_time_file)
+    if snapshots is not None and snapshots.manifest(global_context.branch, current_depth - 1) is None:
+        # 旧场景或第一次模拟：先记录本深度开始前的状态，之后才能回退到这里
+        snapshots.save(global_context.branch, current_depth - 1, global_context)
 
+    run_simulation_for_event(global_context.event, global_context, max_workers, ordered, seed, progress,
+                             cancel_event)
+    checkpoint_simulation_data(global_context, files)
+    if snapshots is not None:
+        # 成功完成后才丢弃该分支此后深度的快照引用；取消或出错时仍可从原来的快照恢复
+        latest = snapshots.latest(global_context.branch)
+        if latest is not None and latest > current_depth:
+            snapshots.rewind(global_context.branch, current_depth + 1)
+        snapshots.save(global_context.branch, current_depth, global_context)
+        global_context.snapshot_depth = current_depth
 
-def add_post_to_queue(event, content, author):
-    global_context = GlobalContext(event)
 
+def branch_scenario(event, name, depth, source='main', output_dir='Output'):
+    # 以 source 在 depth 之前的快照创建分支 name，返回其文件和会话使用的场景 id
     event_hash = md5_hash(event)
-    agents_file = f'Output/Agents/agents_{event_hash}.json'
-    tweets_file = f'Output/Tweets/tweets_{event_hash}.json'
-    global_context_file = f'Output/GlobalContext/global_queue_{event_hash}.json'
-    virtual_time_file = f'Output/GlobalContext/virtual_time_{event_hash}.json'
-
-    if os.path.exists(agents_file):
-        agents = load_agents(agents_file, global_context)
-    else:
-        agents = initialize_agents(default_agents_list, global_context)
-
-    global_context.agents = agents
+    SnapshotStore(event_hash, output_dir).branch(source, name, depth)
+    global_context, files = load_scenario(event, scenario_id(event_hash, name), output_dir)
+    checkpoint_simulation_data(global_context, files)
+    return scenario_id(event_hash, name)
 
-    if os.path.exists(tweets_file):
-        tweets = Tweet.load_tweets(tweets_file)
-    else:
-        tweets = []
 
-    if os.path.exists(global_context_file):
-        load_global_context_queue(global_context, global_context_file)
-    else:
-        global_context.global_queue = deque()
+def add_post_to_queue(event, content, author):
+    global_context, files = load_scenario(event)
+    post_to_queue(global_context, files, content, author)
 
-    if os.path.exists(virtual_time_file):
-        global_context.virtual_time = load_virtual_time(virtual_time_file)
-    else:
-        global_context.virtual_time = VirtualTime(start_time=datetime(2024, 1, 1, 9, 0))
 
+def post_to_queue(global_context, files, content, author):
     current_time = global_context.virtual_time.get_current_time()
     new_hash_id = Tweet.generate_hash_id(content, current_time)
 
     new_tweet = Tweet(content, author, current_time, hash_id=new_hash_id)
-    global_context.tweet_log = tweets
-    global_context.tweet_log.append(new_tweet)
+    global_context.append_tweet(new_tweet)
 
-    global_context.global_queue.appendleft((content, current_time, new_hash_id, get_depth()))
+    global_context.enqueue((content, current_time, new_hash_id, get_depth()), left=True)
 
     print(f"Added new post to queue: {content} by {author} at {current_time}")
 
-    save_simulation_data(agents, agents_file, global_context, global_context_file, tweets_file, virtual_time_file)
+    checkpoint_simulation_data(global_context, files)
 
 
 def create_data(event_hash):
-    agents_file = f'Output/Agents/agents_{event_hash}.json'
-    tweets_file = f'Output/Tweets/tweets_{event_hash}.json'
-    global_context_file = f'Output/GlobalContext/global_queue_{event_hash}.json'
-    virtual_time_file = f'Output/GlobalContext/virtual_time_{event_hash}.json'
+    files = scenario_files(event_hash)
 
     agents = initialize_agents(default_agents_list, GlobalContext(""))
-    save_agents(agents, agents_file)
-
-    with open(tweets_file, 'w', encoding='utf-8') as f:
-        json.dump([], f, ensure_ascii=False, indent=4)
+    save_agents(agents, files['agents'])
 
-    with open(global_context_file, 'w', encoding='utf-8') as f:
-        json.dump([], f, ensure_ascii=False, indent=4)
+    write_json_file(files['tweets'], [])
+    write_json_file(files['global_queue'], [])
 
     virtual_time = VirtualTime(start_time=datetime(2024, 1, 1, 9, 0))
-    save_virtual_time(virtual_time, virtual_time_file)
+    save_virtual_time(virtual_time, files['virtual_time'])
+    ScenarioJournal(files['journal']).truncate()
+    if os.path.exists(files['archive']):
+        os.remove(files['archive'])
 
 
 def ask_agent(event, agent_name, role_name):
-    event_hash = md5_hash(event)
-    agents_file = f'Output/Agents/agents_{event_hash}.json'
-    global_context_file = f'Output/GlobalContext/global_queue_{event_hash}.json'
-    virtual_time_file = f'Output/GlobalContext/virtual_time_{event_hash}.json'
+    files = scenario_files(md5_hash(event))
 
-    if not os.path.exists(agents_file):
+    if not os.path.exists(files['agents']):
         print(f"Agents file for event '{event}' not found.")
         return
 
-    # Load global_context
-    global_context = GlobalContext(event)
-
-    if os.path.exists(global_context_file):
-        load_global_context_queue(global_context, global_context_file)
-    else:
-        global_context.global_queue = deque()
-
-    if os.path.exists(virtual_time_file):
-        global_context.virtual_time = load_virtual_time(virtual_time_file)
-    else:
-        global_context.virtual_time = VirtualTime(start_time=datetime(2024, 1, 1, 9, 0))
-
-    # Load agents
-    agents = load_agents(agents_file, global_context)
+    # Load global_context and agents
+    global_context, _ = load_scenario(event)
+    agents = global_context.agents
 
     # Find the specified agent
     agent = next((agent for agent in agents if agent.name == agent_name), None)
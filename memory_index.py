@@ -0,0 +1,76 @@
+import numpy as np
+
+from config import memory_index_min_size, memory_index_nprobe, memory_index_shortlist
+
+# 训练 k-means 时每个簇最多取这么多样本，记忆很多时训练时间也有上限
+TRAIN_SAMPLES_PER_LIST = 64
+TRAIN_ITERATIONS = 10
+# 批量分配簇时每次计算的行数，限制临时矩阵的大小
+ASSIGN_BATCH = 8192
+
+
+def _normalize(vectors):
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return vectors / norms
+
+
+class IVFIndex:
+    # 倒排文件近似最近邻索引：用球面 k-means 把嵌入分为约 sqrt(n) 个簇，查询只在最近的 nprobe 个簇中
+    # 计算相关度，保留最相关的 shortlist 条参与常规打分；每条记忆所属的簇由 MemoryStream 保存，这里只有簇中心
+
+    def __init__(self, min_size=memory_index_min_size, nprobe=memory_index_nprobe, shortlist=memory_index_shortlist,
+                 seed=0):
+        self.min_size = min_size
+        self.nprobe = nprobe
+        self.shortlist = shortlist
+        self.seed = seed
+        self.centroids = None
+        # 上次训练时的记忆条数，记忆数翻倍后重新训练
+        self.trained_size = 0
+
+    def reset(self):
+        self.centroids = None
+        self.trained_size = 0
+
+    @property
+    def trained(self):
+        return self.centroids is not None
+
+    def needs_training(self, size):
+        return size >= self.min_size and (not self.trained or size >= 2 * self.trained_size)
+
+    def train(self, embeddings):
+        # 输入的行不必归一化
+        n = len(embeddings)
+        nlist = max(1, int(np.sqrt(n)))
+        rng = np.random.default_rng(self.seed)
+        sample = embeddings[rng.choice(n, min(n, nlist * TRAIN_SAMPLES_PER_LIST), replace=False)]
+        sample = _normalize(sample.astype(np.float32))
+        centroids = sample[rng.choice(len(sample), nlist, replace=False)]
+        for _ in range(TRAIN_ITERATIONS):
+            labels = np.argmax(sample @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, labels, sample)
+            counts = np.bincount(labels, minlength=nlist)
+            # 空簇保留原来的中心
+            empty = counts == 0
+            sums[empty] = centroids[empty]
+            centroids = _normalize(sums)
+        self.centroids = centroids
+        self.trained_size = n
+
+    def assign(self, embeddings):
+        # 返回每一行所属的簇，行的模长不影响结果
+        labels = np.empty(len(embeddings), dtype=np.int32)
+        for start in range(0, len(embeddings), ASSIGN_BATCH):
+            batch = embeddings[start:start + ASSIGN_BATCH]
+            labels[start:start + ASSIGN_BATCH] = np.argmax(batch @ self.centroids.T, axis=1)
+        return labels
+
+    def probe(self, query_embedding):
+        # 返回要搜索的簇的布尔掩码，查询须已归一化
+        nprobe = min(self.nprobe, len(self.centroids))
+        mask = np.zeros(len(self.centroids), dtype=bool)
+        mask[np.argpartition(-(self.centroids @ query_embedding), nprobe - 1)[:nprobe]] = True
+        return mask
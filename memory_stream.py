@@ -0,0 +1,377 @@
+import threading
+
+import numpy as np
+
+from config import memory_index
+from embedding_store import LazyEmbedding
+from memory_index import IVFIndex
+
+
+def _minmax(values):
+    # 与 sklearn.preprocessing.minmax_scale 一致：常数列缩放为 0
+    low = values.min()
+    value_range = values.max() - low
+    if value_range == 0:
+        return np.zeros_like(values)
+    return (values - low) / value_range
+
+
+class MemoryStream(dict):
+    # agent 的记忆，用法与 {key: Memory} 字典相同，同时把检索字段放在连续数组中做向量化检索；
+    # 第 i 行对应 self._memories[i]，加入后的嵌入只保存在矩阵中。index 是可选的 IVFIndex
+
+    def __init__(self, memories=None):
+        super().__init__()
+        # 其他线程的批量嵌入会通过 refresh 写入本对象的数组
+        self._lock = threading.RLock()
+        # 上次持久化以来新增或修改过的 key（有序），供增量日志使用
+        self._dirty = {}
+        # 上次持久化以来删除的 key
+        self._removed = {}
+        # 上次快照以来新增或修改过的 key，与日志各自独立；第一次 drain_changed 之前不记录
+        self._changed = None
+        self.index = IVFIndex() if memory_index == 'ivf' else None
+        self._clear_arrays()
+        if memories:
+            self.update(memories)
+
+    def _clear_arrays(self):
+        self._keys = []
+        self._memories = []
+        self._size = 0
+        self._embeddings = None
+        self._inv_norm = np.zeros(0, dtype=np.float32)
+        self._has_embedding = np.zeros(0, dtype=bool)
+        self._minutes = np.zeros(0, dtype=np.int64)
+        self._importance = np.zeros(0)
+        self._emotion = np.zeros(0)
+        self._depth = np.zeros(0, dtype=np.int64)
+        # 每行所属的索引簇，-1 表示尚未分配
+        self._cluster = np.zeros(0, dtype=np.int32)
+        if self.index is not None:
+            self.index.reset()
+        # 嵌入仍在 .npy 旁路文件中、尚未读入的行，首次检索时批量读取
+        self._lazy_rows = set()
+
+    def _row_arrays(self):
+        return (self._inv_norm, self._has_embedding, self._minutes, self._importance, self._emotion, self._depth,
+                self._cluster)
+
+    def _grow(self, capacity):
+        capacity = max(capacity, 2 * len(self._minutes), 16)
+        (self._inv_norm, self._has_embedding, self._minutes, self._importance, self._emotion, self._depth,
+         self._cluster) = (np.resize(array, capacity) for array in self._row_arrays())
+        if self._embeddings is not None:
+            embeddings = np.zeros((capacity, self._embeddings.shape[1]), dtype=np.float32)
+            embeddings[:self._size] = self._embeddings[:self._size]
+            self._embeddings = embeddings
+
+    def _write_row(self, row, memory):
+        self._minutes[row] = memory.minutes
+        self._importance[row] = memory.importance
+        self._emotion[row] = memory.emotion_intensity
+        self._depth[row] = memory.depth
+
+        embedding = memory._embedding
+        if isinstance(embedding, LazyEmbedding):
+            self._has_embedding[row] = False
+            self._lazy_rows.add(row)
+            return
+        self._lazy_rows.discard(row)
+        if embedding is None:
+            # 嵌入已在矩阵中，或者还没有计算
+            return
+        if self._embeddings is None:
+            self._embeddings = np.zeros((len(self._minutes), embedding.shape[0]), dtype=np.float32)
+        self._embeddings[row] = embedding
+        norm = np.linalg.norm(self._embeddings[row])
+        self._inv_norm[row] = 1 / norm if norm else 0
+        self._has_embedding[row] = True
+        if self.index is not None and self.index.trained:
+            self._cluster[row] = self.index.assign(self._embeddings[row:row + 1])[0]
+        # 矩阵成为唯一的副本
+        memory._embedding = None
+
+    @staticmethod
+    def _detach(memory):
+        # 离开本对象（删除、替换、按深度丢弃或移入别的 MemoryStream）时取回自己的嵌入
+        stream = memory._stream
+        if stream is None:
+            return
+        with stream._lock:
+            if memory._embedding is None and stream._has_embedding[memory._row]:
+                memory._embedding = stream._embeddings[memory._row].copy()
+            memory._stream = memory._row = None
+
+    def _place(self, row, memory):
+        if memory._stream is not None:
+            self._detach(memory)
+        memory._stream, memory._row = self, row
+        self._has_embedding[row] = False
+        self._cluster[row] = -1
+        self._write_row(row, memory)
+
+    def _attach(self, key, memory):
+        row = self._size
+        if row == len(self._minutes):
+            self._grow(row + 1)
+        self._keys.append(key)
+        self._memories.append(memory)
+        self._size += 1
+        self._place(row, memory)
+
+    def _drop_rows(self, drop):
+        # 丢弃标记的行，其余行按原顺序压缩到数组前部，无需逐条重建
+        for row in np.flatnonzero(drop):
+            self._detach(self._memories[row])
+        rows = np.flatnonzero(~drop)
+        self._keys = [self._keys[row] for row in rows]
+        self._memories = [self._memories[row] for row in rows]
+        self._size = len(rows)
+        for array in self._row_arrays():
+            array[:self._size] = array[rows]
+        if self._embeddings is not None:
+            self._embeddings[:self._size] = self._embeddings[rows]
+        for row, memory in enumerate(self._memories):
+            memory._row = row
+        self._lazy_rows = {row for row, memory in enumerate(self._memories)
+                           if isinstance(memory._embedding, LazyEmbedding)}
+
+    def embedding_view(self, memory):
+        with self._lock:
+            if memory._stream is not self or not self._has_embedding[memory._row]:
+                return memory._embedding
+            view = self._embeddings[memory._row]
+            view.flags.writeable = False
+            return view
+
+    def refresh(self, memory):
+        with self._lock:
+            if memory._stream is self:
+                self._write_row(memory._row, memory)
+                self._mark_dirty(self._keys[memory._row])
+
+    def _mark_dirty(self, key):
+        self._dirty[key] = True
+        if self._changed is not None:
+            self._changed.add(key)
+
+    def _load_lazy(self):
+        with self._lock:
+            if not self._lazy_rows:
+                return
+            rows = sorted(self._lazy_rows)
+            by_reader = {}
+            for row in rows:
+                memory = self._memories[row]
+                if isinstance(memory._embedding, LazyEmbedding):
+                    by_reader.setdefault(memory._embedding.reader, []).append(memory)
+            for reader, memories in by_reader.items():
+                embeddings = reader.get_rows([memory._embedding.row for memory in memories])
+                for memory, embedding in zip(memories, embeddings):
+                    memory._embedding = None if embedding is None else np.asarray(embedding, dtype=np.float32)
+            for row in rows:
+                self._write_row(row, self._memories[row])
+
+    def filter_depth(self, max_depth):
+        # 就地删除 depth >= max_depth 的记忆，返回删除条数
+        with self._lock:
+            n = self._size
+            drop = self._depth[:n] >= max_depth
+            if not drop.any():
+                return 0
+            for row in np.flatnonzero(drop):
+                key = self._keys[row]
+                super().__delitem__(key)
+                self._dirty.pop(key, None)
+            self._drop_rows(drop)
+            return n - self._size
+
+    def drain_dirty(self):
+        with self._lock:
+            keys = [key for key in self._dirty if key in self]
+            self._dirty = {}
+            return keys
+
+    def drain_removed(self):
+        # 删除后又重新加入的 key 由 drain_dirty 记录
+        with self._lock:
+            keys = [key for key in self._removed if key not in self]
+            self._removed = {}
+            return keys
+
+    def drain_changed(self):
+        # 快照用：上次调用以来新增或修改过的 key；第一次调用返回 None，表示之前的修改没有记录
+        with self._lock:
+            changed, self._changed = self._changed, set()
+            return changed
+
+    def mark_clean(self):
+        with self._lock:
+            self._dirty = {}
+            self._removed = {}
+
+    def recent(self, n):
+        # 最近加入的 n 条记忆，按加入顺序
+        with self._lock:
+            return self._memories[max(0, self._size - n):self._size]
+
+    def consolidation_keys(self, count, now_minutes, keep_recent):
+        # 按重要性和新近度选出最不值得保留的 count 条，最近加入的 keep_recent 条不参与；按流中顺序返回
+        with self._lock:
+            n = self._size - keep_recent
+            if n <= 0 or count <= 0:
+                return []
+            recency_scores = np.exp(-0.005 * (now_minutes - self._minutes[:n]) / 60)
+            value = _minmax(self._importance[:n]) + _minmax(recency_scores)
+            rows = np.sort(np.argsort(value, kind='stable')[:count])
+            return [self._keys[row] for row in rows]
+
+    def remove(self, keys):
+        # 一次压缩删除 keys，返回对应的记忆（嵌入随记忆带走）
+        with self._lock:
+            drop = np.zeros(self._size, dtype=bool)
+            memories = []
+            for key in keys:
+                memory = self[key]
+                drop[memory._row] = True
+                memories.append(memory)
+                super().__delitem__(key)
+                self._removed[key] = True
+            self._drop_rows(drop)
+            return memories
+
+    def __setitem__(self, key, memory):
+        with self._lock:
+            old = self.get(key)
+            super().__setitem__(key, memory)
+            self._mark_dirty(key)
+            if old is memory:
+                self.refresh(memory)
+            elif old is not None:
+                row = old._row
+                self._detach(old)
+                self._memories[row] = memory
+                self._place(row, memory)
+            else:
+                self._attach(key, memory)
+
+    def _delete_row(self, key, memory):
+        drop = np.zeros(self._size, dtype=bool)
+        drop[memory._row] = True
+        super().__delitem__(key)
+        self._removed[key] = True
+        self._drop_rows(drop)
+
+    def __delitem__(self, key):
+        with self._lock:
+            self._delete_row(key, self[key])
+
+    def pop(self, key, *default):
+        if key not in self:
+            return super().pop(key, *default)
+        memory = self[key]
+        del self[key]
+        return memory
+
+    def popitem(self):
+        with self._lock:
+            key = next(reversed(self))
+            memory = self[key]
+            self._delete_row(key, memory)
+            return key, memory
+
+    def clear(self):
+        with self._lock:
+            for memory in self._memories:
+                self._detach(memory)
+            self._removed.update(dict.fromkeys(self))
+            super().clear()
+            self._clear_arrays()
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def update(self, *args, **kwargs):
+        for key, memory in dict(*args, **kwargs).items():
+            self[key] = memory
+
+    def top_k(self, query_embedding, now_minutes, weights, k, model, exact=False):
+        # exact 为真时不使用 ANN 索引
+        self._load_lazy()
+        # 必须在加锁前 flush：flush 会回写各 agent 的 MemoryStream
+        if not self._has_embedding[:self._size].all():
+            model.flush()
+            for memory in list(self.values()):
+                if memory.embedding is None:
+                    memory.update_embedding(model)
+
+        with self._lock:
+            return self._top_k(query_embedding, now_minutes, weights, k, exact)
+
+    def _candidates(self, query_embedding, other_scores, k):
+        # 候选为最近几个簇里相关度最高的记忆，加上时近性、重要性和情绪得分最高的记忆；
+        # 返回 None 表示逐条计算全部记忆的相关度
+        index = self.index
+        n = self._size
+        if index is None or n < index.min_size:
+            return None
+        if index.needs_training(n):
+            index.train(self._embeddings[:n])
+            self._cluster[:n] = index.assign(self._embeddings[:n])
+        # 末尾补一个 False，未分配的行（-1）不会被选中
+        probe = np.append(index.probe(query_embedding), False)
+        rows = np.flatnonzero(probe[self._cluster[:n]])
+        if len(rows) < k:
+            return None
+        shortlist = max(index.shortlist, k)
+        if len(rows) > shortlist:
+            relevance_scores = (self._embeddings[rows] @ query_embedding) * self._inv_norm[rows]
+            rows = rows[np.argpartition(-relevance_scores, shortlist - 1)[:shortlist]]
+        if n > shortlist:
+            rows = np.concatenate([rows, np.argpartition(-other_scores, shortlist - 1)[:shortlist]])
+        return np.unique(rows)
+
+    def _top_k(self, query_embedding, now_minutes, weights, k, exact=False):
+        n = self._size
+        if n == 0:
+            return []
+
+        alpha_recency, alpha_importance, alpha_relevance, alpha_emotion = weights
+
+        query_embedding = np.asarray(query_embedding, dtype=np.float32)
+        query_embedding = query_embedding / np.linalg.norm(query_embedding)
+
+        # 只有相关度需要与整个嵌入矩阵相乘，其余三项总是在全部记忆上计算和缩放
+        hours_passed = (now_minutes - self._minutes[:n]) / 60
+        recency_scores = np.exp(-0.005 * hours_passed)
+        recency = alpha_recency * _minmax(recency_scores)
+        importance = alpha_importance * _minmax(self._importance[:n])
+        emotion = alpha_emotion * _minmax(self._emotion[:n])
+
+        candidates = None if exact else self._candidates(query_embedding, recency + importance + emotion, k)
+        # 候选按行号升序排列，下面按位置处理并列分数对两种情况都成立
+        if candidates is None:
+            selected = slice(0, n)
+        else:
+            selected, n = candidates, len(candidates)
+            recency, importance, emotion = recency[selected], importance[selected], emotion[selected]
+
+        relevance_scores = (self._embeddings[selected] @ query_embedding) * self._inv_norm[selected]
+
+        scores = recency + importance + alpha_relevance * _minmax(relevance_scores.astype(np.float64)) + emotion
+
+        if k < n:
+            # 边界处的并列分数按插入顺序取，与原先稳定排序的结果一致
+            kth_score = -np.partition(-scores, k - 1)[k - 1]
+            above = np.flatnonzero(scores > kth_score)
+            ties = np.flatnonzero(scores == kth_score)[:k - len(above)]
+            rows = np.concatenate([above, ties])
+        else:
+            rows = np.arange(n)
+        rows = rows[np.lexsort((rows, -scores[rows]))]
+        if candidates is not None:
+            rows = candidates[rows]
+        return [self._memories[row] for row in rows]
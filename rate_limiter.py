@@ -0,0 +1,47 @@
+import threading
+import time
+from multiprocessing.managers import SyncManager
+
+
+class TokenBucket:
+    # 线程安全的令牌桶：acquire 阻塞到令牌足够；adjust 在得知实际消耗后补差，
+    # 余额可以为负，之后的调用等待而不是被拒绝
+
+    def __init__(self, rate_per_minute, capacity=None):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = capacity if capacity is not None else rate_per_minute
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self, amount=1):
+        # 单次请求超过桶容量时按容量计，避免永远等不到
+        amount = min(amount, self.capacity)
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                if self._tokens >= amount:
+                    self._tokens -= amount
+                    return waited
+                delay = (amount - self._tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+    def adjust(self, amount):
+        with self._lock:
+            self._refill(time.monotonic())
+            self._tokens = min(self.capacity, self._tokens - amount)
+
+
+class RateLimitManager(SyncManager):
+    # 多进程批量运行时在管理进程中创建令牌桶，各工作进程通过代理共用同一份限额
+    pass
+
+
+RateLimitManager.register('TokenBucket', TokenBucket)
@@ -1,25 +1,145 @@
+import atexit
+import gzip
 import json
 import os
+import time
 
-from flask import Flask, request, render_template, jsonify
+from flask import Flask, Response, request, render_template, jsonify, stream_with_context
 
-from main import create_data, md5_hash, process, add_post_to_queue
-
-app = Flask(__name__)
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
+from agent_emotional import Agent
+from config import response_compress_min_bytes
+from jobs import JobManager
+from llm_base import get_call_stats, reset_call_stats
+from main import branch_scenario, create_data, md5_hash, post_to_queue, scenario_files, scenario_id, simulate_step
+from session import SessionBusy, SessionCache
+from snapshot_store import SnapshotStore
+from tweet import preprocess_tweets
 
-def load_tweets(filename):
-    if os.path.exists(filename):
-        with open(filename, 'r', encoding='utf-8') as f:
-            return preprocess_tweets(json.load(f))
-    return []
+app = Flask(__name__)
 
+sessions = SessionCache()
+jobs = JobManager()
+THREAD_PAGE_SIZE = 20
+MAX_THREAD_PAGE_SIZE = 200
+# ETag 中带上进程启动时间：服务重启后修订号从 0 开始，旧的 ETag 不会被误认为未修改
+SERVER_EPOCH = format(time.time_ns(), 'x')
+# atexit 后注册先执行：先停止后台任务，再把会话写回磁盘
+atexit.register(sessions.flush_all)
+atexit.register(jobs.shutdown)
+
+
+def find_session(event_hash):
+    # 只读请求不为磁盘上不存在的场景创建会话
+    if sessions.peek(event_hash) is None and not os.path.exists(scenario_files(event_hash)['agents']):
+        return None
+    return sessions.get(event_hash=event_hash)
+
+
+def session_tweets(session):
+    global_context = session.global_context
+    with global_context.lock:
+        return [tweet.to_dict() for tweet in global_context.tweet_log]
+
+
+def session_agents(session):
+    return [dict(agent.state_dict(), name=agent.name) for agent in session.global_context.agents]
+
+
+def thread_item(tweet_log, tweet):
+    # 不带回复内容，只带数量；前端展开时再按页请求直接回复
+    data = tweet.to_dict()
+    counts = tweet_log.comment_counts(tweet.hash_id)
+    data['total_comments'] = sum(counts.values())
+    data['comments_by_depth'] = {str(depth): count for depth, count in sorted(counts.items())}
+    data['reply_count'] = tweet_log.reply_count(tweet.hash_id)
+    data['comments'] = []
+    return data
+
+
+def thread_page(session, parent_hash_id=None, cursor=None, limit=THREAD_PAGE_SIZE):
+    # 未知游标抛出 KeyError
+    limit = max(1, min(int(limit), MAX_THREAD_PAGE_SIZE))
+    global_context = session.global_context
+    with global_context.lock:
+        tweet_log = global_context.tweet_log
+        tweets, next_cursor = tweet_log.thread_page(parent_hash_id, cursor, limit)
+        return {
+            'tweets': [thread_item(tweet_log, tweet) for tweet in tweets],
+            'next_cursor': next_cursor,
+            'max_depth': tweet_log.max_depth
+        }
+
+
+def negotiate_encoding(size):
+    if size < response_compress_min_bytes:
+        return None
+    if brotli is not None and request.accept_encodings['br']:
+        return 'br'
+    if request.accept_encodings['gzip']:
+        return 'gzip'
+    return None
+
+
+def compress(body, encoding):
+    if encoding == 'br':
+        return brotli.compress(body, quality=5)
+    return gzip.compress(body, compresslevel=6, mtime=0)
+
+
+def versioned_response(session, key, build, mimetype='application/json', cache=True):
+    # 带修订号 ETag 返回 build() 的文本：If-None-Match 命中时直接返回 304，
+    # 较大的响应压缩；cache 为真时按修订号缓存编码后的内容
+    revision = session.current_revision()
+    etag = md5_hash(f'{SERVER_EPOCH}:{session.event_hash}:{revision}:{key}')
+    if request.method in ('GET', 'HEAD') and request.if_none_match.contains_weak(etag):
+        return cache_headers(Response(status=304), etag)
+
+    encodings = session.payload(key, revision if cache else None, lambda: {None: build().encode('utf-8')})
+    body = encodings[None]
+    encoding = negotiate_encoding(len(body))
+    if encoding is not None:
+        if encoding not in encodings:
+            encodings[encoding] = compress(body, encoding)
+        body = encodings[encoding]
+    response = Response(body, mimetype=mimetype)
+    if encoding is not None:
+        response.headers['Content-Encoding'] = encoding
+    return cache_headers(response, etag)
+
+
+def cache_headers(response, etag):
+    # no-cache：浏览器可以缓存，但每次使用前都带 If-None-Match 重新验证
+    response.headers['Cache-Control'] = 'no-cache'
+    response.vary.add('Accept-Encoding')
+    response.set_etag(etag, weak=True)
+    return response
+
+
+def json_text(data):
+    return app.json.dumps(data, separators=(',', ':'))
+
+
+def events_version():
+    # 首页还包含事件列表，它不属于任何场景的修订号
+    try:
+        stat = os.stat(project_events_file)
+    except OSError:
+        return 'none'
+    return f'{stat.st_mtime_ns}-{stat.st_size}'
 
-def load_tweets_with_comments(filename):
-    if os.path.exists(filename):
-        with open(filename, 'r', encoding='utf-8') as f:
-            return preprocess_tweets(json.load(f), True)
-    return []
+
+def load_tweets(event_hash):
+    # 页面只渲染第一页根推文，其余由前端按 next_cursor 分页加载
+    session = find_session(event_hash)
+    if session is not None:
+        page = thread_page(session)
+        return page['tweets'], page['max_depth'], page['next_cursor']
+    return [], 0, None
 
 
 def load_events(filename):
@@ -35,80 +155,39 @@ def save_events(filename, events):
             f.write(event + '\n')
 
 
-def load_agents(filename):
-    if os.path.exists(filename):
-        with open(filename, 'r', encoding='utf-8') as f:
-            return json.load(f)
+def load_agents(event_hash):
+    session = find_session(event_hash)
+    if session is not None:
+        return session_agents(session)
     return []
 
 
-def save_agents(filename, agents):
-    with open(filename, 'w', encoding='utf-8') as f:
-        json.dump(agents, f, ensure_ascii=False, indent=4)
-
-
-def preprocess_tweets(tweets, individual_comment=False):
-    tweet_dict = {}
-    root_tweets = []
-    max_depth = 0
-
-    for tweet in tweets:
-        tweet['comments'] = []
-        tweet_dict[tweet['hash_id']] = tweet
-        if tweet['depth'] > max_depth:
-            max_depth = tweet['depth']
-
-    for tweet in tweets:
-        if not individual_comment:
-            if tweet['reply_to_hash_id'] is None:
-                root_tweets.append(tweet)
-            else:
-                parent_tweet = tweet_dict.get(tweet['reply_to_hash_id'])
-                if parent_tweet:
-                    parent_tweet['comments'].append(tweet)
-                else:
-                    print(f"Warning: Parent tweet with hash_id {tweet['reply_to_hash_id']} not found.")
-        else:
-            root_tweets.append(tweet)
-            if tweet['reply_to_hash_id'] is not None:
-                parent_tweet = tweet_dict.get(tweet['reply_to_hash_id'])
-                if parent_tweet:
-                    parent_tweet['comments'].append(tweet)
-                else:
-                    print(f"Warning: Parent tweet with hash_id {tweet['reply_to_hash_id']} not found.")
-
-    for tweet in root_tweets:
-        tweet['total_comments'] = count_comments(tweet)
-
-    return root_tweets, max_depth
-
-
-def count_comments(tweet):
-    total = len(tweet['comments'])
-    for comment in tweet['comments']:
-        total += count_comments(comment)
-    return total
-
-
-project_tweets_file = 'Output/Tweets/tweets_4dd1419ab4d3b7ffa58d346f2967fdad.json'
+project_event_hash = '4dd1419ab4d3b7ffa58d346f2967fdad'
 project_events_file = 'Output/events.txt'
-project_agents_file = 'Output/Agents/agents_4dd1419ab4d3b7ffa58d346f2967fdad.json'
+
+
+def render_project(event_hash):
+    def build():
+        tweets, max_depth, next_cursor = load_tweets(event_hash)
+        events = load_events(project_events_file)
+        agents = load_agents(event_hash)
+        return render_template('index.html', tweets=tweets, events=events, agents=agents, max_depth=max_depth,
+                               next_cursor=next_cursor)
+
+    session = find_session(event_hash)
+    if session is None:
+        return build()
+    return versioned_response(session, f'page:{events_version()}', build, mimetype='text/html')
 
 
 @app.route('/')
 def show_default_tweets():
-    tweets, max_depth = load_tweets(project_tweets_file)
-    events = load_events(project_events_file)
-    agents = load_agents(project_agents_file)
-    return render_template('index.html', tweets=tweets, events=events, agents=agents, max_depth=max_depth)
+    return render_project(project_event_hash)
 
 
 @app.route('/project/<project_name>')
 def show_project_tweets(project_name):
-    tweets, max_depth = load_tweets(f'Output/Tweets/tweets_{project_name}.json')
-    events = load_events(project_events_file)
-    agents = load_agents(f'Output/Agents/agents_{project_name}.json')
-    return render_template('index.html', tweets=tweets, events=events, agents=agents, max_depth=max_depth)
+    return render_project(project_name)
 
 
 @app.route('/tweets', methods=['POST'])
@@ -116,14 +195,16 @@ def show_tweets():
     tweets_json = request.json
     tweets, max_depth = preprocess_tweets(tweets_json)
     events = load_events(project_events_file)
-    agents = load_agents(project_agents_file)
+    agents = load_agents(project_event_hash)
     return render_template('index.html', tweets=tweets, events=events, agents=agents, max_depth=max_depth)
 
 
 @app.route('/api/tweets', methods=['GET'])
 def get_tweets():
-    tweets, max_depth = load_tweets(project_tweets_file)
-    return jsonify(tweets)
+    session = find_session(project_event_hash)
+    if session is None:
+        return jsonify([])
+    return versioned_response(session, 'tweets', lambda: json_text(preprocess_tweets(session_tweets(session))[0]))
 
 
 @app.route('/api/events', methods=['POST'])
@@ -133,23 +214,39 @@ def save_events_api():
     return jsonify({"message": "Events saved successfully!"})
 
 
-@app.route('/api/event_data', methods=['POST'])
+@app.route('/api/event_data', methods=['GET', 'POST'])
 def get_event_data():
-    event = request.json.get('event', '')
+    # GET（?project_name=N 或 ?event=...）可以用 If-None-Match 得到 304；POST 保留原来的 JSON 请求体
+    if request.method == 'GET':
+        params = request.args
+        event = project_event() if 'project_name' in params else params.get('event', '')
+    else:
+        params = request.json
+        event = params.get('event', '')
     if isinstance(event, int):
         event = get_line_from_file('Output/events.txt', event)
     event_hash = md5_hash(event)
     print(f'hash:{event_hash}')
-    tweets_file = f'Output/Tweets/tweets_{event_hash}.json'
-    agents_file = f'Output/Agents/agents_{event_hash}.json'
+    files = scenario_files(event_hash)
 
-    if not os.path.exists(tweets_file) or not os.path.exists(agents_file):
+    if sessions.peek(event_hash) is None and (
+            not os.path.exists(files['tweets']) or not os.path.exists(files['agents'])):
         create_data(event_hash)
 
-    tweets, max_depth = load_tweets(tweets_file)
-    agents = load_agents(agents_file)
+    session = sessions.get(event)
+    page_size = params.get('page_size')
+
+    def build():
+        agents = session_agents(session)
+        if page_size is not None:
+            # 只返回第一页根推文；之后用 /api/threads 翻页，用 /api/threads/<hash_id>/replies 展开回复
+            page = thread_page(session, limit=page_size)
+            return json_text({"tweets": page['tweets'], "agents": agents, "max_depth": page['max_depth'],
+                              "next_cursor": page['next_cursor']})
+        tweets, max_depth = preprocess_tweets(session_tweets(session))
+        return json_text({"tweets": tweets, "agents": agents, "max_depth": max_depth})
 
-    return jsonify({"tweets": tweets, "agents": agents, "max_depth": max_depth})
+    return versioned_response(session, f'event_data:{page_size}', build)
 
 
 def get_line_from_file(file_path, line_number):
@@ -160,127 +257,215 @@ def get_line_from_file(file_path, line_number):
     raise ValueError("Line number is out of range")
 
 
+def project_event():
+    return get_line_from_file('Output/events.txt', int(request.args.get('project_name')))
+
+
+def project_session():
+    # 可选的 branch 参数选择同一事件的其他分支
+    event = project_event()
+    return sessions.get(event, scenario_id(md5_hash(event), request.args.get('branch', 'main')))
+
+
+def thread_response(session, parent_hash_id):
+    cursor = request.args.get('cursor')
+    limit = request.args.get('limit', THREAD_PAGE_SIZE)
+    # 游标和页大小组合很多，只用 ETag，不占用会话的响应缓存
+    try:
+        return versioned_response(session, f'threads:{parent_hash_id}:{cursor}:{limit}',
+                                  lambda: json_text(thread_page(session, parent_hash_id, cursor, limit)), cache=False)
+    except KeyError:
+        return jsonify({"message": "Unknown cursor."}), 400
+
+
+@app.route('/api/threads', methods=['GET'])
+def list_threads():
+    return thread_response(project_session(), None)
+
+
+@app.route('/api/threads/<hash_id>/replies', methods=['GET'])
+def list_replies(hash_id):
+    session = project_session()
+    if session.global_context.get_tweet(hash_id) is None:
+        return jsonify({"message": "Tweet not found."}), 404
+    return thread_response(session, hash_id)
+
+
 @app.route('/api/update_agent', methods=['POST'])
 def update_agent():
     data = request.json
-    project_name = request.args.get('project_name')
-
-    content = md5_hash(get_line_from_file('Output/events.txt', int(project_name)))
-
-    agents_file = f'Output/Agents/agents_{content}.json'
-
-    agents = load_agents(agents_file)
-    for agent in agents:
-        if (
-                agent['occupation'] == data.get('occupation') or
-                agent['experience'] == data.get('experience') or
-                agent['character'] == data.get('character') or
-                agent['interest'] == data.get('interest')
-        ):
-            agent['occupation'] = data.get('occupation')
-            agent['experience'] = data.get('experience')
-            agent['character'] = data.get('character')
-            agent['interest'] = data.get('interest')
-            agent['online'] = data.get('online')
-            break
-
-    save_agents(agents_file, agents)
+    session = project_session()
+
+    with session.writing():
+        for agent in session.global_context.agents:
+            if (
+                    agent.occupation == data.get('occupation') or
+                    agent.experience == data.get('experience') or
+                    agent.character == data.get('character') or
+                    agent.interest == data.get('interest')
+            ):
+                agent.update_profile(data.get('occupation'), data.get('experience'), data.get('character'),
+                                     data.get('interest'))
+                agent.online = data.get('online')
+                break
+
+        session.flush()
     return jsonify({"message": "Agent updated successfully!"})
 
 
 @app.route('/api/delete_agent', methods=['POST'])
 def delete_agent():
     data = request.json
-    project_name = request.args.get('project_name')
-
-    content = md5_hash(get_line_from_file('Output/events.txt', int(project_name)))
-
-    agents_file = f'Output/Agents/agents_{content}.json'
-
-    agents = load_agents(agents_file)
+    session = project_session()
     agent_name = data.get('name')
 
-    agents = [agent for agent in agents if agent['name'] != agent_name]
-
-    save_agents(agents_file, agents)
+    with session.writing():
+        global_context = session.global_context
+        global_context.agents = [agent for agent in global_context.agents if agent.name != agent_name]
+        global_context.needs_full_save = True
+        session.flush()
     return jsonify({"message": "Agent deleted successfully!"})
 
 
 @app.route('/api/add_agent', methods=['POST'])
 def add_agent():
     data = request.json
-    project_name = request.args.get('project_name')
-
-    content = md5_hash(get_line_from_file('Output/events.txt', int(project_name)))
-
-    agents_file = f'Output/Agents/agents_{content}.json'
-
-    agents = load_agents(agents_file)
-    new_agent = {
-        "name": data.get('name'),
-        "occupation": data.get('occupation'),
-        "experience": data.get('experience'),
-        "character": data.get('character'),
-        "interest": data.get('interest'),
-        "experiences": {},
-        "has_posted_new_tweet": False,
-        "feelings": {},
-        "mood": '',
-        "online": False
-    }
-    agents.append(new_agent)
-
-    save_agents(agents_file, agents)
+    session = project_session()
+
+    with session.writing():
+        global_context = session.global_context
+        new_agent = Agent(data.get('name'), data.get('occupation'), data.get('experience'), data.get('character'),
+                          data.get('interest'), global_context)
+        new_agent.online = False
+        global_context.agents.append(new_agent)
+        global_context.needs_full_save = True
+        session.flush()
     return jsonify({"message": "Agent added successfully!"})
 
 
 @app.route('/api/toggle_online_agent', methods=['POST'])
 def toggle_online_agent():
     data = request.json
-    project_name = request.args.get('project_name')
-
-    content = md5_hash(get_line_from_file('Output/events.txt', int(project_name)))
-    agents_file = f'Output/Agents/agents_{content}.json'
-
-    agents = load_agents(agents_file)
+    session = project_session()
     agent_name = data.get('name')
     online_status = data.get('online')
 
-    for agent in agents:
-        if agent['name'] == agent_name:
-            agent['online'] = online_status
-            break
+    with session.writing():
+        for agent in session.global_context.agents:
+            if agent.name == agent_name:
+                agent.online = online_status
+                break
 
-    save_agents(agents_file, agents)
+        session.flush()
     return jsonify({"message": "Agent online status updated successfully!"})
 
 
+@app.errorhandler(SessionBusy)
+def session_busy(error):
+    return jsonify({"message": "A simulation or another edit is running for this event, try again later."}), 409
+
+
+def simulation_job(event_hash, current_depth, text_tuning_mode=None, decision_mode=None):
+    def run(job):
+        # 任务开始时才取会话：排队期间会话可能已被淘汰并写回，不能沿用提交时的对象
+        with sessions.pinned(event_hash=event_hash) as session, session.writing(blocking=True):
+            def report(update):
+                job.report(update)
+                # 按深度过滤完成、每个 agent 处理完自己的事件都是提交点，模拟期间读请求仍有 ETag 和缓存
+                if update['type'] in ('start', 'agent'):
+                    session.bump()
+
+            try:
+                simulate_step(session.global_context, session.files, current_depth, progress=report,
+                              cancel_event=job.cancel_event, text_tuning_mode=text_tuning_mode,
+                              decision_mode=decision_mode)
+            except BaseException:
+                # 取消或出错时场景只更新了一半，恢复到上次保存的状态
+                session.reload()
+                raise
+        print(f'Simulation completed for event: {session.event} at depth: {current_depth}')
+
+    return run
+
+
 @app.route('/api/simulate', methods=['POST'])
 def simulate():
     data = request.json
-    current_depth = data.get('depth')
+    current_depth = int(data.get('depth'))
+    text_tuning_mode = data.get('text_tuning_mode')
+    decision_mode = data.get('decision_mode')
+
+    session = project_session()
+
+    # 模拟在后台任务中运行，请求立即返回任务 id
+    job, created = jobs.submit(session.event_hash,
+                               simulation_job(session.event_hash, current_depth, text_tuning_mode, decision_mode),
+                               {'event': session.event, 'depth': current_depth, 'text_tuning_mode': text_tuning_mode,
+                                'decision_mode': decision_mode})
+    if not created:
+        return jsonify({"message": "A simulation is already running for this event.", "job_id": job.id,
+                        "status": job.status}), 409
+
+    return jsonify({"message": "Simulation started!", "job_id": job.id, "status": job.status}), 202
+
 
-    project_name = request.args.get('project_name')
-    event_content = get_line_from_file('Output/events.txt', int(project_name))
+@app.route('/api/jobs', methods=['GET'])
+def list_jobs():
+    return jsonify(jobs.list())
 
-    result = process(event_content, int(current_depth))
 
-    print(f'Simulation completed for event: {event_content} at depth: {current_depth}')
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify({"message": "Job not found."}), 404
+    return jsonify(job.to_dict())
 
-    return jsonify({"message": "Simulation completed!", "result": result})
+
+@app.route('/api/jobs/<job_id>/cancel', methods=['POST'])
+def cancel_job(job_id):
+    job = jobs.cancel(job_id)
+    if job is None:
+        return jsonify({"message": "Job not found."}), 404
+    return jsonify(job.to_dict())
+
+
+@app.route('/api/jobs/<job_id>/events', methods=['GET'])
+def job_events(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify({"message": "Job not found."}), 404
+
+    # 断线重连时浏览器会带上 Last-Event-ID，从下一条继续推送
+    start = int(request.headers.get('Last-Event-ID', -1)) + 1
+
+    def stream():
+        index = start
+        while True:
+            events, done = job.wait_events(index, timeout=15)
+            if not events and not done:
+                yield ': keepalive\n\n'
+            for event in events:
+                yield f"id: {index}\nevent: {event['type']}\ndata: {json.dumps(event, ensure_ascii=False)}\n\n"
+                index += 1
+            if done:
+                return
+
+    return Response(stream_with_context(stream()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 
 @app.route('/api/add_post_to_queue', methods=['POST'])
 def add_post():
     data = request.json
-    project_name = request.args.get('project_name')
     author = data.get('author')
     content = data.get('content')
 
-    event_name = get_line_from_file('Output/events.txt', int(project_name))
+    session = project_session()
 
     # Call the method from main.py to add the post to the queue
-    add_post_to_queue(event_name, content, author)
+    with session.writing():
+        post_to_queue(session.global_context, session.files, content, author)
 
     return jsonify({"message": "Post added successfully!"})
 
@@ -288,20 +473,42 @@ def add_post():
 @app.route('/api/delete_post', methods=['POST'])
 def delete_post():
     data = request.json
-    project_name = md5_hash(get_line_from_file('Output/events.txt', int(request.args.get('project_name'))))
+    session = project_session()
     hash_id = data.get('hash_id')
 
-    tweets_file = f'Output/Tweets/tweets_{project_name}.json'
-    tweets, max_depth = load_tweets_with_comments(tweets_file)
+    with session.writing():
+        # Remove the tweet with the matching hash_id; the thread index is updated in place
+        session.global_context.delete_tweet(hash_id)
+        session.flush()
 
-    # Filter out the tweet with the matching hash_id
-    updated_tweets = [tweet for tweet in tweets if tweet['hash_id'] != hash_id]
+    return jsonify({"message": "Post deleted successfully!"})
 
-    # Save the updated tweets back to the JSON file
-    with open(tweets_file, 'w', encoding='utf-8') as f:
-        json.dump(updated_tweets, f, ensure_ascii=False, indent=4)
 
-    return jsonify({"message": "Post deleted successfully!"})
+@app.route('/api/snapshots', methods=['GET'])
+def list_snapshots():
+    return jsonify(SnapshotStore(md5_hash(project_event())).branches())
+
+
+@app.route('/api/branches', methods=['POST'])
+def create_branch():
+    data = request.json
+    event = project_event()
+    try:
+        scenario = branch_scenario(event, data.get('name', ''), int(data.get('depth')), data.get('source', 'main'))
+    except ValueError as e:
+        return jsonify({"message": str(e)}), 400
+    return jsonify({"message": "Branch created!", "scenario": scenario}), 201
+
+
+@app.route('/api/llm_stats', methods=['GET'])
+def llm_stats():
+    return jsonify(get_call_stats())
+
+
+@app.route('/api/llm_stats/reset', methods=['POST'])
+def reset_llm_stats():
+    reset_call_stats()
+    return jsonify({"message": "LLM stats reset."})
 
 
 @app.route('/simulation')
@@ -0,0 +1,211 @@
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from config import response_cache_entries, session_memory_budget
+from main import checkpoint_simulation_data, load_scenario, md5_hash
+
+# 粗略估算：每条记忆含 384 维 float32 嵌入和文本，每条推文只有文本
+MEMORY_BYTES = 4096
+TWEET_BYTES = 1024
+
+
+class SessionBusy(Exception):
+    # 场景正在被模拟或编辑，写请求不排队等待
+    pass
+
+
+class ScenarioSession:
+    # 常驻内存的场景（GlobalContext 及其 agent），在请求之间复用
+
+    def __init__(self, event_hash, event=None, revision=0):
+        self.event_hash = event_hash
+        self.global_context, self.files = load_scenario(event, event_hash)
+        # 串行化同一场景的写操作（模拟、发帖、agent 增删改）
+        self.lock = threading.RLock()
+        self.last_used = time.time()
+        # 后台任务正在使用的次数，大于 0 时不会被淘汰
+        self.pins = 0
+        # 修订号：在提交点（写操作结束、模拟中每个 agent 完成）加一，之前的缓存和 ETag 随之失效；
+        # 两个提交点之间读取到的仍是上一修订号
+        self.revision = revision
+        self._payloads = OrderedDict()
+        self._payloads_lock = threading.Lock()
+
+    @property
+    def event(self):
+        return self.global_context.event
+
+    def estimated_size(self):
+        global_context = self.global_context
+        memories = sum(len(agent.experiences) for agent in global_context.agents)
+        return memories * MEMORY_BYTES + len(global_context.tweet_log) * TWEET_BYTES
+
+    @contextmanager
+    def writing(self, blocking=False):
+        # 默认不等待：已有模拟或其他写操作进行中时抛出 SessionBusy
+        if not self.lock.acquire(blocking=blocking):
+            raise SessionBusy(self.event_hash)
+        try:
+            yield
+            # 只有正常结束的写操作才是提交点；中途抛出异常时修订号不变
+            self.bump()
+        finally:
+            self.lock.release()
+
+    def bump(self):
+        with self._payloads_lock:
+            self.revision += 1
+            self._payloads.clear()
+
+    def current_revision(self):
+        with self._payloads_lock:
+            return self.revision
+
+    def payload(self, key, revision, build):
+        # revision 为 None 时不缓存；只有构建期间没有经过提交点时才缓存
+        with self._payloads_lock:
+            cached = self._payloads.get(key)
+            if cached is not None and revision is not None and cached[0] == revision:
+                self._payloads.move_to_end(key)
+                return cached[1]
+        value = build()
+        with self._payloads_lock:
+            if revision is not None and revision == self.revision:
+                self._payloads[key] = (revision, value)
+                while len(self._payloads) > response_cache_entries:
+                    self._payloads.popitem(last=False)
+        return value
+
+    def flush(self):
+        with self.lock:
+            checkpoint_simulation_data(self.global_context, self.files)
+
+    def reload(self):
+        # 丢弃内存中未保存的修改（例如被取消的模拟只执行了一半），从磁盘和日志重新加载
+        with self.lock:
+            self.global_context, self.files = load_scenario(self.event, self.event_hash)
+            # 模拟中途的提交点已经发出过新的 ETag，恢复后的状态需要再换一个
+            self.bump()
+
+
+class SessionCache:
+    # 按事件 hash 的 LRU 会话缓存，超过估算的内存预算时淘汰
+
+    def __init__(self, memory_budget=session_memory_budget):
+        self.memory_budget = memory_budget
+        self._sessions = OrderedDict()
+        # 只保护上面的字典；加载场景和写回磁盘都在锁外进行，不阻塞其他场景的请求
+        self._lock = threading.Lock()
+        # 正在加载或正在淘汰写回的场景，同一场景的请求等待对应的 Event
+        self._pending = {}
+        # 被淘汰的会话的修订号；重新加载的内容与淘汰时写回的相同，沿用原修订号
+        self._revisions = {}
+
+    def get(self, event=None, event_hash=None):
+        event_hash = event_hash or md5_hash(event)
+        while True:
+            with self._lock:
+                session = self._sessions.get(event_hash)
+                if session is not None:
+                    self._sessions.move_to_end(event_hash)
+                    session.last_used = time.time()
+                    break
+                pending = self._pending.get(event_hash)
+                loading = pending is None
+                if loading:
+                    pending = self._pending[event_hash] = threading.Event()
+                    revision = self._revisions.pop(event_hash, 0)
+            if not loading:
+                pending.wait()
+                continue
+            try:
+                session = ScenarioSession(event_hash, event, revision)
+                with self._lock:
+                    self._sessions[event_hash] = session
+            except BaseException:
+                with self._lock:
+                    self._revisions.setdefault(event_hash, revision)
+                raise
+            finally:
+                with self._lock:
+                    del self._pending[event_hash]
+                pending.set()
+            break
+        if event and not session.global_context.event:
+            session.global_context.event = event
+        self._evict_over_budget(keep=event_hash)
+        return session
+
+    @contextmanager
+    def pinned(self, event=None, event_hash=None):
+        # 取得会话并在使用期间禁止淘汰，后台任务修改的始终是缓存中的那一份
+        event_hash = event_hash or md5_hash(event)
+        while True:
+            session = self.get(event, event_hash)
+            with self._lock:
+                # get 返回后到这里之间可能已被淘汰，重新取一次
+                if self._sessions.get(event_hash) is session:
+                    session.pins += 1
+                    break
+        try:
+            yield session
+        finally:
+            with self._lock:
+                session.pins -= 1
+
+    def peek(self, event_hash):
+        with self._lock:
+            return self._sessions.get(event_hash)
+
+    def _evict_over_budget(self, keep):
+        with self._lock:
+            total = sum(session.estimated_size() for session in self._sessions.values())
+            candidates = [item for item in self._sessions.items() if item[0] != keep]
+        for event_hash, session in candidates:
+            if total <= self.memory_budget:
+                break
+            # 正在被模拟或编辑的会话不能淘汰，否则磁盘重新加载后会出现两个分叉的副本
+            if not session.lock.acquire(blocking=False):
+                continue
+            try:
+                if not self._detach(event_hash, session):
+                    continue
+                total -= session.estimated_size()
+                self._write_back(event_hash, session)
+                print(f"Evicted scenario session {event_hash}")
+            finally:
+                session.lock.release()
+
+    def _detach(self, event_hash, session):
+        # 从缓存中移除，直到写回完成前同一场景的 get 都会等待，不会从磁盘读到旧数据
+        with self._lock:
+            if self._sessions.get(event_hash) is not session or session.pins:
+                return False
+            del self._sessions[event_hash]
+            self._revisions[event_hash] = session.revision
+            self._pending[event_hash] = threading.Event()
+        return True
+
+    def _write_back(self, event_hash, session):
+        try:
+            session.flush()
+        finally:
+            with self._lock:
+                pending = self._pending.pop(event_hash)
+            pending.set()
+
+    def evict(self, event_hash):
+        session = self.peek(event_hash)
+        if session is None:
+            return
+        with session.lock:
+            if self._detach(event_hash, session):
+                self._write_back(event_hash, session)
+
+    def flush_all(self):
+        with self._lock:
+            sessions = list(self._sessions.values())
+        for session in sessions:
+            session.flush()
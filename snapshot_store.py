@@ -0,0 +1,282 @@
+import glob
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+import weakref
+import zlib
+
+from agent_emotional import Agent
+from embedding_store import EmbeddingReader, EmbeddingWriter
+from tweet import Tweet
+from utils import Memory
+from virtual_time import VirtualTime
+
+# 每个对象平均保存的记忆或推文条数；块边界由 key 决定，未变化的块在各深度、各分支之间共享
+CHUNK_SIZE = 256
+MAX_CHUNK_SIZE = CHUNK_SIZE * 4
+BRANCH_NAME = re.compile(r'^[A-Za-z0-9_]+$')
+# 回退时沿用 agent 当前的资料，只恢复记忆和心理状态
+PROFILE_FIELDS = ('occupation', 'experience', 'character', 'interest', 'online')
+
+_refs_locks = {}
+_refs_locks_lock = threading.Lock()
+
+
+def _dumps(data):
+    # 固定键顺序和分隔符，相同内容总是得到相同的哈希
+    return json.dumps(data, ensure_ascii=False, sort_keys=True, separators=(',', ':')).encode('utf-8')
+
+
+def _split(items, key):
+    # 按内容切块：在 key 的 crc32 命中的条目之后切开，插入、删除或修改只影响所在的块，
+    # 之后的块不会像按位置切块那样整体移位
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if zlib.crc32(str(key(item)).encode('utf-8')) % CHUNK_SIZE == 0 or len(chunk) >= MAX_CHUNK_SIZE:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _refs_lock(refs_file):
+    with _refs_locks_lock:
+        return _refs_locks.setdefault(os.path.abspath(refs_file), threading.Lock())
+
+
+class SnapshotStore:
+    # 一个事件每个深度完成后的写时复制快照：对象按内容 hash 存放在 Snapshots/objects，
+    # 未变化的部分在深度和分支之间共享；refs/<event_hash>.json 记录各分支每个深度的清单
+
+    def __init__(self, event_hash, output_dir='Output'):
+        self.event_hash = event_hash
+        self.objects_dir = os.path.join(output_dir, 'Snapshots', 'objects')
+        self.refs_file = os.path.join(output_dir, 'Snapshots', 'refs', f'{event_hash}.json')
+        self._lock = _refs_lock(self.refs_file)
+        # 上次保存或恢复的块，下次保存时只重新序列化变化的块：
+        # agent 名 -> (MemoryStream 弱引用, {块内 key 元组: hash})，推文块指纹 -> hash
+        self._memory_chunks = {}
+        self._tweet_chunks = {}
+
+    def _object_path(self, digest, suffix='.json'):
+        return os.path.join(self.objects_dir, digest[:2], digest[2:] + suffix)
+
+    def _put(self, data, suffix='.json'):
+        digest = hashlib.sha1(data).hexdigest()
+        path = self._object_path(digest, suffix)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            temp_file = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+            with open(temp_file, 'wb') as f:
+                f.write(data)
+            os.replace(temp_file, path)
+        return digest
+
+    def _get(self, digest):
+        with open(self._object_path(digest), 'rb') as f:
+            return json.loads(f.read())
+
+    def _read_refs(self):
+        if not os.path.exists(self.refs_file):
+            return {}
+        with open(self.refs_file, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def _write_refs(self, refs):
+        os.makedirs(os.path.dirname(self.refs_file), exist_ok=True)
+        temp_file = self.refs_file + '.tmp'
+        with open(temp_file, 'w', encoding='utf-8') as f:
+            json.dump(refs, f, ensure_ascii=False, indent=4)
+        os.replace(temp_file, self.refs_file)
+
+    def branches(self):
+        refs = self._read_refs()
+        return {name: {'depths': sorted(int(depth) for depth in branch['depths']), 'source': branch['source'],
+                       'created': branch['created']}
+                for name, branch in refs.items()}
+
+    def manifest(self, branch, depth):
+        return self._read_refs().get(branch, {}).get('depths', {}).get(str(depth))
+
+    def latest(self, branch):
+        depths = self._read_refs().get(branch, {}).get('depths', {})
+        return max((int(depth) for depth in depths), default=None)
+
+    def _put_memories(self, items):
+        writer = EmbeddingWriter()
+        chunk = {'memories': [[str(key), memory.to_dict(writer)] for key, memory in items]}
+        if len(writer):
+            chunk['embeddings'] = self._put(writer.tobytes(), '.npy')
+        return self._put(_dumps(chunk))
+
+    def _save_memories(self, agent):
+        # 块内 key 不变且其中没有被修改的记忆时沿用上次的 hash
+        stream = agent.experiences
+        changed = stream.drain_changed()
+        cached = self._memory_chunks.get(agent.name)
+        previous = {} if changed is None or cached is None or cached[0]() is not stream else cached[1]
+        chunks = {}
+        for items in _split(list(stream.items()), lambda item: item[0]):
+            keys = tuple(key for key, _ in items)
+            digest = previous.get(keys)
+            if digest is None or not changed.isdisjoint(keys):
+                digest = self._put_memories(items)
+            chunks[keys] = digest
+        self._memory_chunks[agent.name] = (weakref.ref(stream), chunks)
+        return list(chunks.values())
+
+    def save(self, branch, depth, global_context):
+        # 记录 branch 在 depth 完成后的状态，返回清单 hash
+        agents = []
+        for agent in global_context.agents:
+            agents.append({
+                'state': self._put(_dumps(dict(agent.state_dict(), name=agent.name))),
+                'memories': self._save_memories(agent)
+            })
+        with global_context.lock:
+            tweet_chunks = []
+            for tweets in _split(global_context.tweet_log, lambda tweet: tweet.hash_id):
+                # 推文加入后只会增加点赞，(hash_id, 点赞数) 相同的块内容不变
+                fingerprint = tuple((tweet.hash_id, len(tweet.likes)) for tweet in tweets)
+                digest = self._tweet_chunks.get(fingerprint)
+                tweet_chunks.append((fingerprint, digest, None if digest else [tweet.to_dict() for tweet in tweets]))
+            queue = [list(event) for event in global_context.global_queue]
+            virtual_time = global_context.virtual_time.to_dict()
+        self._tweet_chunks = {fingerprint: digest or self._put(_dumps(tweets))
+                              for fingerprint, digest, tweets in tweet_chunks}
+        digest = self._put(_dumps({
+            'depth': depth,
+            'agents': agents,
+            'tweets': [self._tweet_chunks[fingerprint] for fingerprint, _, _ in tweet_chunks],
+            'queue': self._put(_dumps(queue)),
+            'virtual_time': self._put(_dumps(virtual_time))
+        }))
+
+        with self._lock:
+            refs = self._read_refs()
+            refs.setdefault(branch, {'depths': {}, 'source': None, 'created': time.time()})
+            refs[branch]['depths'][str(depth)] = digest
+            self._write_refs(refs)
+        return digest
+
+    def _load_memories(self, chunks):
+        # 返回记忆和 {块内 key 元组: hash}
+        memories = {}
+        loaded = {}
+        for digest in chunks:
+            chunk = self._get(digest)
+            reader = None
+            if chunk.get('embeddings'):
+                reader = EmbeddingReader(self._object_path(chunk['embeddings'], '.npy'), defer_open=True)
+            for key, data in chunk['memories']:
+                memories[key] = Memory.from_dict(data, reader)
+            loaded[tuple(key for key, _ in chunk['memories'])] = digest
+        return memories, loaded
+
+    def restore(self, branch, depth, global_context):
+        # 仍存在的 agent 保留当前资料，depth 之后的修改不会被回退；之后新增的 agent 没有记忆。
+        # 没有该深度的快照时返回 False
+        digest = self.manifest(branch, depth)
+        if digest is None:
+            return False
+        manifest = self._get(digest)
+
+        snapshot_agents = {}
+        for entry in manifest['agents']:
+            data = self._get(entry['state'])
+            snapshot_agents[data['name']] = (data, entry['memories'])
+        live_agents = {agent.name: agent for agent in global_context.agents}
+
+        agents = []
+        for name in live_agents or snapshot_agents:
+            live = live_agents.get(name)
+            if name not in snapshot_agents:
+                agent = Agent(name, live.occupation, live.experience, live.character, live.interest, global_context)
+                agent.online = live.online
+                agents.append(agent)
+                continue
+            data, chunks = snapshot_agents[name]
+            if live is not None:
+                data.update({field: getattr(live, field) for field in PROFILE_FIELDS})
+            agent = Agent.from_dict(dict(data, experiences={}), global_context)
+            agent.experiences, loaded = self._load_memories(chunks)
+            # 恢复的内容就是这些块，回退后再次保存时只重写之后变化的块
+            agent.experiences.drain_changed()
+            self._memory_chunks[name] = (weakref.ref(agent.experiences), loaded)
+            agents.append(agent)
+
+        tweet_chunks = {digest: self._get(digest) for digest in manifest['tweets']}
+        self._tweet_chunks = {tuple((tweet['hash_id'], len(tweet['likes'])) for tweet in tweets): digest
+                              for digest, tweets in tweet_chunks.items()}
+        tweets = [tweet for digest in manifest['tweets'] for tweet in tweet_chunks[digest]]
+        with global_context.lock:
+            global_context.agents = agents
+            global_context.tweet_log = [Tweet.from_dict(tweet) for tweet in tweets]
+            global_context.global_queue = self._get(manifest['queue'])
+            global_context.virtual_time = VirtualTime.from_dict(self._get(manifest['virtual_time']))
+        return True
+
+    def rewind(self, branch, depth):
+        # 删除 branch 从 depth 起的快照记录，对象留到 collect_garbage 时删除
+        with self._lock:
+            refs = self._read_refs()
+            if branch not in refs:
+                return
+            refs[branch]['depths'] = {key: digest for key, digest in refs[branch]['depths'].items()
+                                      if int(key) < depth}
+            self._write_refs(refs)
+
+    def branch(self, source, name, depth):
+        # 创建分支 name，共享 source 在 depth 之前的快照
+        if not BRANCH_NAME.match(name) or name == 'main':
+            raise ValueError(f'Invalid branch name: {name}')
+        with self._lock:
+            refs = self._read_refs()
+            if name in refs:
+                raise ValueError(f'Branch already exists: {name}')
+            if source not in refs or str(depth - 1) not in refs[source]['depths']:
+                raise ValueError(f'No snapshot of branch {source} before depth {depth}')
+            refs[name] = {
+                'depths': {key: digest for key, digest in refs[source]['depths'].items() if int(key) < depth},
+                'source': [source, depth],
+                'created': time.time()
+            }
+            self._write_refs(refs)
+
+
+def collect_garbage(output_dir='Output'):
+    # 删除没有任何清单引用的对象，返回删除数
+    reachable = set()
+    for refs_file in glob.glob(os.path.join(output_dir, 'Snapshots', 'refs', '*.json')):
+        store = SnapshotStore(os.path.splitext(os.path.basename(refs_file))[0], output_dir)
+        for branch in store._read_refs().values():
+            for digest in branch['depths'].values():
+                if digest in reachable:
+                    continue
+                reachable.add(digest)
+                manifest = store._get(digest)
+                reachable.update((manifest['queue'], manifest['virtual_time'], *manifest['tweets']))
+                for agent in manifest['agents']:
+                    reachable.add(agent['state'])
+                    for chunk_digest in agent['memories']:
+                        reachable.add(chunk_digest)
+                        embeddings = store._get(chunk_digest).get('embeddings')
+                        if embeddings:
+                            reachable.add(embeddings)
+
+    removed = 0
+    for path in glob.glob(os.path.join(output_dir, 'Snapshots', 'objects', '*', '*')):
+        directory, name = os.path.split(path)
+        digest = os.path.basename(directory) + name.split('.')[0]
+        if digest not in reachable and not name.endswith('.tmp'):
+            os.remove(path)
+            removed += 1
+    return removed
+
+
+if __name__ == '__main__':
+    print(f'Removed {collect_garbage()} unreferenced snapshot objects')
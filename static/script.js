@@ -1,10 +1,58 @@
 $(document).ready(function () {
     let currentProjectName = '';
     let previousDepth = 0;
+    const THREAD_PAGE_SIZE = 20;
+
+    // 回复在第一次展开时才按页请求
+    $(document).on('click', '.comments-toggle, .replies-toggle', function () {
+        var list = $(this).siblings('.comments-list, .nested-comments').first();
+        if (!list.data('loaded') && $(this).data('hash-id')) {
+            list.data('loaded', true);
+            loadReplies($(this).data('hash-id'), list, null);
+        }
+        list.toggle();
+    });
+
+    $(document).on('click', '.load-more-replies', function () {
+        var button = $(this);
+        loadReplies(button.data('hash-id'), button.parent(), button.data('cursor'));
+        button.remove();
+    });
 
-    function bindCommentToggle() {
-        $('.comments-toggle').off('click').on('click', function () {
-            $(this).siblings('.comments-list').toggle();
+    $(document).on('click', '#load-more-tweets', function () {
+        var button = $(this);
+        $.ajax({
+            url: '/api/threads?project_name=' + currentProjectName + '&limit=' + THREAD_PAGE_SIZE +
+                '&cursor=' + encodeURIComponent(button.data('cursor')),
+            method: 'GET',
+            success: function (response) {
+                button.remove();
+                appendTweets(response.tweets, response.next_cursor);
+                filterTweets($('#search-input').val().toLowerCase());
+            },
+            error: function (error) {
+                console.log('Error loading tweets: ' + error.responseText);
+            }
+        });
+    });
+
+    function loadReplies(hashId, list, cursor) {
+        var url = '/api/threads/' + hashId + '/replies?project_name=' + currentProjectName + '&limit=' +
+            THREAD_PAGE_SIZE + (cursor ? '&cursor=' + encodeURIComponent(cursor) : '');
+        $.ajax({
+            url: url,
+            method: 'GET',
+            success: function (response) {
+                list.append(renderComments(response.tweets));
+                if (response.next_cursor) {
+                    list.append('<button class="load-more-replies" data-hash-id="' + hashId + '" data-cursor="' +
+                        response.next_cursor + '">More replies</button>');
+                }
+                filterTweets($('#search-input').val().toLowerCase());
+            },
+            error: function (error) {
+                console.log('Error loading replies: ' + error.responseText);
+            }
         });
     }
 
@@ -100,13 +148,23 @@ $(document).ready(function () {
     function updateCommentCounts(depth, searchQuery) {
         $('.tweet-container').each(function () {
             var commentCount = 0;
-            $(this).find('.comment-container').each(function () {
-                var commentDepth = $(this).data('depth');
-                var commentContent = $(this).find('.comment-content').text().toLowerCase();
-                if (commentDepth <= depth && commentContent.includes(searchQuery)) {
-                    commentCount++;
-                }
-            });
+            var byDepth = $(this).data('comments-by-depth');
+            if (byDepth && !searchQuery) {
+                // 未展开的回复不在页面上，按服务端返回的各深度评论数计算
+                Object.keys(byDepth).forEach(function (commentDepth) {
+                    if (parseInt(commentDepth) <= depth) {
+                        commentCount += byDepth[commentDepth];
+                    }
+                });
+            } else {
+                $(this).find('.comment-container').each(function () {
+                    var commentDepth = $(this).data('depth');
+                    var commentContent = $(this).find('.comment-content').first().text().toLowerCase();
+                    if (commentDepth <= depth && commentContent.includes(searchQuery)) {
+                        commentCount++;
+                    }
+                });
+            }
             $(this).find('.comments-count').text(commentCount);
         });
     }
@@ -167,14 +225,15 @@ $(document).ready(function () {
     });
 
     function loadEventData(eventContent, projectName) {
+        // GET 请求由浏览器缓存，并用 If-None-Match 重新验证；场景没有变化时服务端返回 304
         $.ajax({
             url: '/api/event_data',
-            method: 'POST',
-            contentType: 'application/json',
-            data: JSON.stringify({event: eventContent}),
+            method: 'GET',
+            // 数字表示 events.txt 中的行号，与原来 POST 请求体中的 event 含义相同
+            data: typeof eventContent === 'number' ? {project_name: eventContent, page_size: THREAD_PAGE_SIZE} :
+                {event: eventContent, page_size: THREAD_PAGE_SIZE},
             success: function (response) {
-                updateUI(response.tweets, response.agents, response.max_depth);
-                bindCommentToggle();
+                updateUI(response.tweets, response.agents, response.max_depth, response.next_cursor);
             },
             error: function (error) {
                 console.log('Error loading event data: ' + error.responseText);
@@ -192,11 +251,15 @@ $(document).ready(function () {
             commentHtml += '<div class="comment-content">' + comment.content + '</div>';
             commentHtml += '</div>';
 
-            // 递归渲染子评论
+            // 递归渲染子评论；分页返回的评论只带回复数，展开时再加载
             if (comment.comments && comment.comments.length > 0) {
                 commentHtml += '<div class="nested-comments">';
                 commentHtml += renderComments(comment.comments);
                 commentHtml += '</div>';
+            } else if (comment.reply_count > 0) {
+                commentHtml += '<span class="replies-toggle" data-hash-id="' + comment.hash_id + '">' +
+                    comment.reply_count + (comment.reply_count === 1 ? ' reply' : ' replies') + '</span>';
+                commentHtml += '<div class="nested-comments" style="display: none;"></div>';
             }
 
             commentHtml += '</div>'; // 关闭 comment-container
@@ -204,16 +267,15 @@ $(document).ready(function () {
         return commentHtml;
     }
 
-    function updateUI(tweets, agents, maxDepth) {
-        $('#depthRange').attr('max', 5);
-        $('#depthRange').data('initial-value', maxDepth);
-        updateDepthValue(maxDepth, maxDepth);
-
+    function appendTweets(tweets, nextCursor) {
         var tweetsContainer = $('#tweets-container');
-        tweetsContainer.empty();
         tweets.forEach(function (tweet) {
+            // 分页返回的根推文不带回复，展开评论时按 hash_id 加载
+            var loadable = tweet.comments.length === 0 && tweet.reply_count > 0;
+            var byDepth = tweet.comments_by_depth ? JSON.stringify(tweet.comments_by_depth) : '';
             var tweetItem = `
-            <div class="tweet-container" data-depth="${tweet.depth}" data-hash-id="${tweet.hash_id}">
+            <div class="tweet-container" data-depth="${tweet.depth}" data-hash-id="${tweet.hash_id}"
+                data-comments-by-depth='${byDepth}'>
                 <div class="title">
                     ${tweet.author}
                     <button class="delete-post">Delete</button> <!-- Delete button inside the title div -->
@@ -225,7 +287,7 @@ $(document).ready(function () {
                     <span class="likes-list">${tweet.likes.join(', ')}</span>
                 </div>
                 <div class="tweet-comments">
-                    <span class="comments-toggle">
+                    <span class="comments-toggle" ${loadable ? `data-hash-id="${tweet.hash_id}"` : ''}>
                         <img src="/static/comments.png" alt="Comments" class="icon">
                         <span class="comments-count">${tweet.total_comments}</span>
                     </span>
@@ -236,6 +298,18 @@ $(document).ready(function () {
             </div>`;
             tweetsContainer.append(tweetItem);
         });
+        if (nextCursor) {
+            tweetsContainer.append(`<button id="load-more-tweets" data-cursor="${nextCursor}">Load more</button>`);
+        }
+    }
+
+    function updateUI(tweets, agents, maxDepth, nextCursor) {
+        $('#depthRange').attr('max', 5);
+        $('#depthRange').data('initial-value', maxDepth);
+        updateDepthValue(maxDepth, maxDepth);
+
+        $('#tweets-container').empty();
+        appendTweets(tweets, nextCursor);
 
         var agentsContainer = $('.npc-list');
         agentsContainer.empty();
@@ -450,22 +524,68 @@ $(document).ready(function () {
             data: JSON.stringify({depth: currentDepth}),
             success: function (response) {
                 console.log('Simulation confirmed at depth:', currentDepth);
-
-                // 隐藏处理中的模态框
-                $('#processing-modal').hide();
-
-                // 重新加载事件数据
-                loadEventData(currentProjectName, currentProjectName);
+                followSimulationJob(response.job_id);
             },
             error: function (error) {
                 console.log('Error confirming simulation: ' + error.responseText);
 
+                // 同一事件已有模拟在运行时，跟踪该任务
+                if (error.status === 409 && error.responseJSON) {
+                    followSimulationJob(error.responseJSON.job_id);
+                    return;
+                }
+
                 // 隐藏处理中的模态框，即使出错也要隐藏
                 $('#processing-modal').hide();
             }
         });
     });
 
+    var currentJobId = null;
+
+    function followSimulationJob(jobId) {
+        currentJobId = jobId;
+        $('#processing-progress').text('');
+
+        var source = new EventSource('/api/jobs/' + jobId + '/events');
+        var processed = 0;
+        var total = 0;
+
+        source.addEventListener('start', function (e) {
+            total = JSON.parse(e.data).events;
+            $('#processing-progress').text('0 / ' + total + ' events');
+        });
+
+        source.addEventListener('event', function (e) {
+            var data = JSON.parse(e.data);
+            processed += 1;
+            $('#processing-progress').text(processed + ' / ' + total + ' events (' + data.agent + ')');
+        });
+
+        source.addEventListener('status', function (e) {
+            var data = JSON.parse(e.data);
+            if (data.status === 'running') {
+                return;
+            }
+            source.close();
+            currentJobId = null;
+            console.log('Simulation ' + data.status + (data.error ? ': ' + data.error : ''));
+
+            // 隐藏处理中的模态框
+            $('#processing-modal').hide();
+
+            // 重新加载事件数据
+            loadEventData(currentProjectName, currentProjectName);
+        });
+    }
+
+    $('#cancel-processing').on('click', function () {
+        if (currentJobId) {
+            $.post('/api/jobs/' + currentJobId + '/cancel');
+            $('#processing-progress').text('Cancelling...');
+        }
+    });
+
     $(window).on('click', function (event) {
         if ($(event.target).is('#npc-detail-modal')) {
             $('#npc-detail-modal').hide();
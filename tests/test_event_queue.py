@@ -0,0 +1,71 @@
+import random
+from collections import deque
+
+from event_queue import EventQueue
+
+
+def event(name, depth):
+    # 与全局队列中的事件相同，下标 3 为深度
+    return (name, 'author', 'hash', depth)
+
+
+def reference_feed(events, rng, size=6):
+    # 原先在队列列表上的抽样
+    events = list(events)
+    mandatory = [item for item in events if item[3] == 0]
+    others = [item for item in events if item[3] != 0]
+    return mandatory + rng.sample(others, min(max(0, size - len(mandatory)), len(others)))
+
+
+def test_iteration_matches_deque():
+    queue, expected = EventQueue(max_per_depth=None), deque()
+    for index, (depth, left) in enumerate([(0, False), (1, False), (1, True), (2, False), (0, True), (1, False)]):
+        item = event(f'e{index}', depth)
+        queue.append(item, left=left)
+        expected.appendleft(item) if left else expected.append(item)
+    assert list(queue) == list(expected)
+    assert len(queue) == 6
+    assert queue.depth_counts() == {0: 2, 1: 3, 2: 1}
+
+
+def test_append_caps_each_depth_except_user_posts():
+    queue = EventQueue(max_per_depth=2)
+    assert queue.append(event('a', 1))
+    assert queue.append(event('b', 1))
+    assert not queue.append(event('c', 1))
+    assert queue.append(event('d', 2))
+    # 用户发帖从左侧加入，不受上限限制
+    assert queue.append(event('post', 1), left=True)
+    assert [item[0] for item in queue] == ['post', 'a', 'b', 'd']
+
+
+def test_prune_drops_old_depths():
+    queue = EventQueue([event(f'e{depth}', depth) for depth in range(5)], max_per_depth=None, retention_depths=2)
+    assert queue.prune(4) == 3
+    assert queue.depth_counts() == {3: 1, 4: 1}
+    assert len(queue) == 2
+
+    unbounded = EventQueue([event('a', 0), event('b', 1)], retention_depths=None)
+    assert unbounded.prune(10) is None
+    assert len(unbounded) == 2
+
+
+def test_feed_matches_list_sampling():
+    queue = EventQueue(max_per_depth=None)
+    rng = random.Random(0)
+    for index in range(200):
+        queue.append(event(f'e{index}', rng.choice([0, 1, 1, 2, 3])), left=index % 7 == 0)
+    for depths in ([0, 1, 2, 3], [1]):
+        view = EventQueue([item for item in queue if item[3] in depths], max_per_depth=None)
+        for seed in range(5):
+            assert view.feed(random.Random(seed)) == reference_feed(view, random.Random(seed))
+            assert view.feed(random.Random(seed), size=50) == reference_feed(view, random.Random(seed), size=50)
+
+
+def test_feed_sees_later_changes():
+    queue = EventQueue([event('a', 1)], max_per_depth=None, retention_depths=1)
+    assert queue.feed(random.Random(0)) == [event('a', 1)]
+    queue.append(event('root', 0))
+    assert queue.feed(random.Random(0)) == [event('root', 0), event('a', 1)]
+    queue.prune(5)
+    assert queue.feed(random.Random(0)) == []
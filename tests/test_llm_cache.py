@@ -0,0 +1,87 @@
+import time
+
+import pytest
+
+import llm_base
+from llm_cache import ResponseCache
+
+
+class CountingBackend:
+    # 每次调用返回不同的回复，用来判断是否命中缓存
+    name = 'counting'
+    model = 'counting'
+    cacheable = True
+
+    def __init__(self):
+        self.calls = 0
+
+    def complete(self, system_message, user_message, model, json_mode=False):
+        self.calls += 1
+        return f'reply {self.calls}', 10, 2
+
+    def is_retryable(self, error):
+        return False
+
+
+@pytest.fixture
+def cache(tmp_path):
+    cache = ResponseCache(str(tmp_path / 'cache.sqlite3'), evict_every=1)
+    yield cache
+    cache.close()
+
+
+def test_key_separates_backend_model_and_json_mode(cache):
+    cache.put('openai', 'gpt', 'system', 'user', 'text reply')
+    assert cache.get('openai', 'gpt', 'system', 'user') == 'text reply'
+    assert cache.get('openai', 'gpt', 'system', 'user', json_mode=True) is None
+    assert cache.get('stub', 'gpt', 'system', 'user') is None
+    assert cache.get('openai', 'other', 'system', 'user') is None
+
+    cache.put('openai', 'gpt', 'system', 'user', '{"tweet": "json reply"}', json_mode=True)
+    assert cache.get('openai', 'gpt', 'system', 'user') == 'text reply'
+    assert cache.get('openai', 'gpt', 'system', 'user', json_mode=True) == '{"tweet": "json reply"}'
+    assert cache.stats() == {'hits': 3, 'misses': 3, 'entries': 2}
+
+
+def test_eviction_keeps_most_recently_accessed(tmp_path):
+    cache = ResponseCache(str(tmp_path / 'cache.sqlite3'), max_entries=2, evict_every=1)
+    cache.put('b', 'm', 's', 'first', '1')
+    time.sleep(0.01)
+    cache.put('b', 'm', 's', 'second', '2')
+    time.sleep(0.01)
+    # 读取使 first 比 second 更新，第三条写入时淘汰 second
+    assert cache.get('b', 'm', 's', 'first') == '1'
+    time.sleep(0.01)
+    cache.put('b', 'm', 's', 'third', '3')
+    assert cache.get('b', 'm', 's', 'second') is None
+    assert cache.get('b', 'm', 's', 'first') == '1'
+    assert cache.get('b', 'm', 's', 'third') == '3'
+    cache.close()
+
+
+def test_expired_entries_miss_and_are_evicted(tmp_path):
+    cache = ResponseCache(str(tmp_path / 'cache.sqlite3'), max_age=0.05, evict_every=1000)
+    cache.put('b', 'm', 's', 'u', 'old')
+    time.sleep(0.1)
+    assert cache.get('b', 'm', 's', 'u') is None
+    assert cache.stats()['entries'] == 1
+    cache.evict()
+    assert cache.stats()['entries'] == 0
+    cache.close()
+
+
+def test_send_message_uses_cache_only_when_asked(cache, monkeypatch):
+    backend = CountingBackend()
+    monkeypatch.setattr(llm_base, '_backend', backend)
+    monkeypatch.setattr(llm_base, '_cache', cache)
+    monkeypatch.setattr(llm_base, '_request_bucket', None)
+    monkeypatch.setattr(llm_base, '_token_bucket', None)
+
+    assert llm_base.send_message('system', 'user') == 'reply 1'
+    assert llm_base.send_message('system', 'user') == 'reply 1'
+    assert llm_base.send_message('system', 'user', json_mode=True) == 'reply 2'
+    # 随机采样的调用点不读也不写缓存
+    assert llm_base.send_message('system', 'user', use_cache=False) == 'reply 3'
+    assert llm_base.send_message('system', 'other', use_cache=False) == 'reply 4'
+    assert llm_base.send_message('system', 'other') == 'reply 5'
+    assert backend.calls == 5
@@ -0,0 +1,73 @@
+import time
+
+import pytest
+
+import llm_base
+from rate_limiter import TokenBucket
+
+
+class FlakyBackend:
+    # 前 failures 次调用抛出可重试的错误，之后返回固定的回复和 token 数
+    name = 'flaky'
+    model = 'flaky'
+    cacheable = False
+
+    def __init__(self, failures):
+        self.failures = failures
+        self.calls = 0
+
+    def complete(self, system_message, user_message, model, json_mode=False):
+        self.calls += 1
+        if self.failures:
+            self.failures -= 1
+            raise TimeoutError()
+        return 'ok', 100, 20
+
+    def is_retryable(self, error):
+        return True
+
+
+def test_acquire_spends_without_waiting_while_tokens_last():
+    bucket = TokenBucket(600, capacity=10)
+    assert bucket.acquire(4) == 0
+    assert bucket.acquire(6) == 0
+    assert bucket._tokens == pytest.approx(0, abs=0.1)
+
+
+def test_acquire_waits_for_refill():
+    # 每秒补充 100 个令牌
+    bucket = TokenBucket(6000, capacity=10)
+    bucket.acquire(10)
+    start = time.monotonic()
+    waited = bucket.acquire(5)
+    assert waited > 0
+    assert time.monotonic() - start >= 0.04
+
+
+def test_acquire_caps_amount_at_capacity():
+    bucket = TokenBucket(6000, capacity=10)
+    assert bucket.acquire(1000) == 0
+
+
+def test_adjust_settles_the_difference():
+    bucket = TokenBucket(60, capacity=100)
+    bucket.acquire(50)
+    # 实际消耗比预扣多 80：余额可以为负，之后的调用等待
+    bucket.adjust(80)
+    assert bucket._tokens == pytest.approx(-30, abs=1)
+    bucket.adjust(-200)
+    assert bucket._tokens == pytest.approx(100)
+
+
+def test_failed_attempts_refund_their_estimate(monkeypatch):
+    bucket = TokenBucket(60, capacity=100000)
+    backend = FlakyBackend(failures=2)
+    monkeypatch.setattr(llm_base, '_backend', backend)
+    monkeypatch.setattr(llm_base, '_request_bucket', None)
+    monkeypatch.setattr(llm_base, '_token_bucket', bucket)
+    monkeypatch.setattr(llm_base, 'retry_delay', lambda attempt, error: 0)
+
+    assert llm_base.send_message('system', 'user', use_cache=False) == 'ok'
+    assert backend.calls == 3
+    # 只按成功那次的实际用量扣除
+    assert bucket._tokens == pytest.approx(100000 - 120, abs=1)
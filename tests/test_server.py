@@ -0,0 +1,94 @@
+import contextlib
+import io
+import threading
+
+import pytest
+
+import llm_base
+from embedding_model import EmbeddingService, HashingEncoder, set_embedding_service
+from llm_stub import StubBackend
+
+# 与 test_simulation.py 相同：离线的桩 LLM 和哈希嵌入
+llm_base.set_backend(StubBackend())
+llm_base.set_response_cache(None)
+llm_base.set_rate_limits(None, None)
+set_embedding_service(EmbeddingService(model=HashingEncoder()))
+
+import main  # noqa: E402
+import server  # noqa: E402
+
+EVENT = 'A new city law bans private cars from downtown'
+EVENT_DATA = '/api/event_data?project_name=1'
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    main.make_output_dirs()
+    (tmp_path / 'Output' / 'events.txt').write_text(EVENT + '\n')
+    with contextlib.redirect_stdout(io.StringIO()):
+        main.process(EVENT, 0, seed=1)
+    yield server.app.test_client()
+    with contextlib.redirect_stdout(io.StringIO()):
+        server.sessions.evict(main.md5_hash(EVENT))
+
+
+def session():
+    return server.sessions.peek(main.md5_hash(EVENT))
+
+
+def test_matching_etag_returns_304(client):
+    first = client.get(EVENT_DATA)
+    assert first.status_code == 200
+    etag = first.headers['ETag']
+    assert etag.startswith('W/')
+
+    again = client.get(EVENT_DATA, headers={'If-None-Match': etag})
+    assert again.status_code == 304
+    assert again.data == b''
+    assert again.headers['ETag'] == etag
+
+
+def test_write_changes_etag(client):
+    etag = client.get(EVENT_DATA).headers['ETag']
+    with contextlib.redirect_stdout(io.StringIO()):
+        posted = client.post('/api/add_post_to_queue?project_name=1', json={'author': 'Artful_Alan', 'content': 'hi'})
+    assert posted.status_code == 200
+
+    after = client.get(EVENT_DATA, headers={'If-None-Match': etag})
+    assert after.status_code == 200
+    assert after.headers['ETag'] != etag
+
+
+def test_failed_write_keeps_revision(client):
+    etag = client.get(EVENT_DATA).headers['ETag']
+    revision = session().revision
+    with pytest.raises(ValueError):
+        with session().writing():
+            raise ValueError()
+    assert session().revision == revision
+    assert client.get(EVENT_DATA, headers={'If-None-Match': etag}).status_code == 304
+
+
+def test_busy_write_returns_409_and_keeps_revision(client):
+    etag = client.get(EVENT_DATA).headers['ETag']
+    # 另一个线程持有写锁，模拟正在运行的模拟任务
+    held, release = threading.Event(), threading.Event()
+
+    def hold():
+        with session().writing():
+            held.set()
+            release.wait()
+
+    thread = threading.Thread(target=hold)
+    thread.start()
+    held.wait()
+    try:
+        busy = client.post('/api/toggle_online_agent?project_name=1', json={'name': 'Artful_Alan', 'online': False})
+        assert busy.status_code == 409
+        assert client.get(EVENT_DATA, headers={'If-None-Match': etag}).status_code == 304
+    finally:
+        release.set()
+        thread.join()
+    # 持有锁的写操作正常结束，修订号前进
+    assert client.get(EVENT_DATA, headers={'If-None-Match': etag}).status_code == 200
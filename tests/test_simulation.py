@@ -0,0 +1,78 @@
+import contextlib
+import io
+import json
+
+import pytest
+
+import llm_base
+from embedding_model import EmbeddingService, HashingEncoder, set_embedding_service
+from llm_stub import StubBackend
+
+# 与 benchmark.py 相同：在创建任何 Agent 之前换成离线的桩 LLM 和哈希嵌入，不访问网络，不读写响应缓存
+llm_base.set_backend(StubBackend())
+llm_base.set_response_cache(None)
+llm_base.set_rate_limits(None, None)
+set_embedding_service(EmbeddingService(model=HashingEncoder()))
+
+import main  # noqa: E402
+
+EVENT = 'A new city law bans private cars from downtown'
+SEED = 7
+# 每个深度完成后的 (推文数, 各 agent 记忆数)
+EXPECTED_COUNTS = [(4, [4, 4, 4]), (5, [4, 7, 7]), (11, [8, 11, 11])]
+
+
+def counts(global_context):
+    return len(global_context.tweet_log), [len(agent.experiences) for agent in global_context.agents]
+
+
+def state(global_context):
+    # 按保存到磁盘的形式比较：经过 JSON 往返（元组变为列表、记忆 key 变为字符串），也不与之后的修改共享对象
+    return json.loads(json.dumps({
+        'tweets': [tweet.to_dict() for tweet in global_context.tweet_log],
+        'agents': {agent.name: (agent.state_dict(),
+                                {str(key): memory.to_dict() for key, memory in agent.experiences.items()})
+                   for agent in global_context.agents},
+        'queue': [list(event) for event in global_context.global_queue],
+        'virtual_time': global_context.virtual_time.to_dict()
+    }))
+
+
+def load(depth=None):
+    with contextlib.redirect_stdout(io.StringIO()):
+        return main.load_scenario(EVENT, depth=depth)
+
+
+def simulate(global_context, files, depth):
+    with contextlib.redirect_stdout(io.StringIO()):
+        main.simulate_step(global_context, files, depth, seed=SEED)
+
+
+@pytest.fixture
+def scenario(tmp_path, monkeypatch):
+    # 模拟三个深度，返回内存中的场景和每个深度完成后的状态
+    monkeypatch.chdir(tmp_path)
+    main.make_output_dirs()
+    global_context, files = load()
+    states = []
+    for depth in range(len(EXPECTED_COUNTS)):
+        simulate(global_context, files, depth)
+        states.append(state(global_context))
+        assert counts(global_context) == EXPECTED_COUNTS[depth]
+    return global_context, states
+
+
+def test_journal_replay_matches_live_state(scenario):
+    global_context, states = scenario
+    assert global_context.journal.record_count > 0
+    replayed, _ = load()
+    assert state(replayed) == states[-1]
+
+
+def test_rewind_round_trip(scenario):
+    _, states = scenario
+    # 回退到深度 1：恢复深度 0 完成后的快照，用同一种子重新模拟得到相同的结果
+    global_context, files = load(depth=1)
+    assert state(global_context) == states[0]
+    simulate(global_context, files, 1)
+    assert state(global_context) == states[1]
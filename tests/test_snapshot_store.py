@@ -0,0 +1,102 @@
+import contextlib
+import glob
+import io
+
+import pytest
+
+import llm_base
+from embedding_model import EmbeddingService, HashingEncoder, set_embedding_service
+from llm_stub import StubBackend
+
+# 与 test_simulation.py 相同：离线的桩 LLM 和哈希嵌入
+llm_base.set_backend(StubBackend())
+llm_base.set_response_cache(None)
+llm_base.set_rate_limits(None, None)
+set_embedding_service(EmbeddingService(model=HashingEncoder()))
+
+import main  # noqa: E402
+import snapshot_store  # noqa: E402
+from snapshot_store import SnapshotStore, collect_garbage  # noqa: E402
+
+EVENT = 'A new city law bans private cars from downtown'
+
+
+@pytest.fixture
+def scenario(tmp_path, monkeypatch):
+    # 块调小，少量记忆也能分成多块；返回模拟两个深度后的场景和记录每次写入块大小的列表
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(snapshot_store, 'CHUNK_SIZE', 4)
+    monkeypatch.setattr(snapshot_store, 'MAX_CHUNK_SIZE', 8)
+    puts = []
+    put_memories = SnapshotStore._put_memories
+    monkeypatch.setattr(SnapshotStore, '_put_memories', lambda self, items: puts.append(len(items)) or
+                        put_memories(self, items))
+    main.make_output_dirs()
+    with contextlib.redirect_stdout(io.StringIO()):
+        global_context, files = main.load_scenario(EVENT)
+        for depth in range(2):
+            main.simulate_step(global_context, files, depth, seed=1)
+    return global_context, puts
+
+
+def full_save(global_context, depth):
+    # 新建的 store 没有上次保存的块，全部重新序列化
+    return SnapshotStore(global_context.snapshots.event_hash).save('scratch', depth, global_context)
+
+
+def test_split_boundaries_follow_content():
+    items = [f'key {index}' for index in range(200)]
+    chunks = list(snapshot_store._split(items, str))
+    assert [item for chunk in chunks for item in chunk] == items
+    assert all(len(chunk) <= snapshot_store.MAX_CHUNK_SIZE for chunk in chunks)
+    # 在开头插入一条只影响第一块，之后的块不移位
+    shifted = list(snapshot_store._split(['inserted'] + items, str))
+    assert shifted[1:] == chunks[1:]
+
+
+def test_unchanged_save_reuses_every_chunk(scenario):
+    global_context, puts = scenario
+    assert sum(len(agent.experiences) for agent in global_context.agents) > 8
+    puts.clear()
+    digest = global_context.snapshots.save('main', 1, global_context)
+    assert puts == []
+    assert digest == global_context.snapshots.manifest('main', 1)
+    assert digest == full_save(global_context, 1)
+
+
+def test_changed_memory_rewrites_only_its_chunk(scenario):
+    global_context, puts = scenario
+    agent = global_context.agents[0]
+    assert len(global_context.snapshots._memory_chunks[agent.name][1]) > 1
+    memory = next(iter(agent.experiences.values()))
+    memory.emotion_intensity = 9
+    puts.clear()
+    digest = global_context.snapshots.save('main', 1, global_context)
+    assert len(puts) == 1
+    assert digest == full_save(global_context, 1)
+
+
+def test_restore_then_save_writes_only_changes(scenario):
+    global_context, puts = scenario
+    store = global_context.snapshots
+    assert store.restore('main', 0, global_context)
+    puts.clear()
+    assert store.save('main', 0, global_context) == store.manifest('main', 0)
+    assert puts == []
+
+
+def test_collect_garbage_keeps_referenced_objects(scenario):
+    global_context, _ = scenario
+    store = global_context.snapshots
+    full_save(global_context, 1)
+    # 没有修改时 scratch 与 main 共享全部对象，删除任何一个都不回收
+    assert collect_garbage() == 0
+
+    objects = len(glob.glob('Output/Snapshots/objects/*/*'))
+    store.rewind('main', 1)
+    SnapshotStore(store.event_hash).rewind('scratch', 0)
+    removed = collect_garbage()
+    assert 0 < removed < objects
+    # 剩余的深度 0 快照仍能完整恢复
+    assert store.restore('main', 0, global_context)
+    assert collect_garbage() == 0
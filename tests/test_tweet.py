@@ -0,0 +1,114 @@
+import pytest
+
+from tweet import Tweet, TweetLog
+
+
+def make_tweet(hash_id, author, parent=None, depth=0):
+    tweet = Tweet(f'content {hash_id}', author, '2024-01-01 00:00:00', hash_id=hash_id, depth=depth)
+    tweet.reply_to_hash_id = parent
+    return tweet
+
+
+def make_log():
+    # A <- B <- C，A <- D，E 为另一条根推文
+    return TweetLog([
+        make_tweet('A', 'alice'),
+        make_tweet('B', 'bob', 'A', 1),
+        make_tweet('C', 'alice', 'B', 2),
+        make_tweet('D', 'carol', 'A', 1),
+        make_tweet('E', 'bob'),
+    ])
+
+
+def test_lookup_indexes():
+    log = make_log()
+    assert log.get('C').author == 'alice'
+    assert log.get('missing') is None
+    assert [tweet.hash_id for tweet in log.children('A')] == ['B', 'D']
+    assert log.reply_count('A') == 2
+    assert log.reply_count('C') == 0
+    assert [tweet.hash_id for tweet in log.by_author('alice')] == ['A', 'C']
+    assert log.max_depth == 2
+
+
+def test_append_updates_indexes():
+    log = make_log()
+    log.append(make_tweet('F', 'alice', 'C', 3))
+    assert log.get('F') is log[-1]
+    assert [tweet.hash_id for tweet in log.children('C')] == ['F']
+    assert [tweet.hash_id for tweet in log.by_author('alice')] == ['A', 'C', 'F']
+    assert log.max_depth == 3
+
+
+def test_duplicate_hash_id_keeps_the_first():
+    log = make_log()
+    log.append(make_tweet('A', 'dave'))
+    assert log.get('A').author == 'alice'
+    assert len(log.by_author('dave')) == 1
+    assert log.delete('A') == 2
+    assert log.get('A') is None
+    assert len(log) == 4
+
+
+def test_list_mutations_rebuild_indexes():
+    log = make_log()
+    log.pop()
+    assert log.get('E') is None
+    assert log.by_author('bob') == [log.get('B')]
+    log.insert(0, make_tweet('E', 'bob'))
+    assert log.get('E') is log[0]
+
+
+def thread_state(log):
+    return {tweet.hash_id: log.comment_counts(tweet.hash_id) for tweet in log}, log.thread_page(limit=100)[0]
+
+
+def test_comment_counts_by_depth():
+    log = make_log()
+    assert log.comment_counts('A') == {1: 2, 2: 1}
+    assert log.total_comments('A') == 3
+    assert log.comment_counts('B') == {2: 1}
+    assert log.total_comments('E') == 0
+
+
+def test_incremental_counts_match_rebuild():
+    log = make_log()
+    log.append(make_tweet('F', 'dave', 'C', 3))
+    # 回复先于父推文加入：父推文加入时计入已有的回复
+    log.append(make_tweet('H', 'dave', 'G', 2))
+    log.append(make_tweet('G', 'dave', 'E', 1))
+    assert log.comment_counts('A') == {1: 2, 2: 1, 3: 1}
+    assert log.comment_counts('E') == {1: 1, 2: 1}
+    assert thread_state(log) == thread_state(TweetLog(list(log)))
+
+    assert log.delete('B') == 1
+    assert log.delete('missing') == 0
+    assert log.comment_counts('A') == {1: 1}
+    assert log.total_comments('E') == 2
+    assert log.max_depth == 3
+    assert thread_state(log) == thread_state(TweetLog(list(log)))
+
+    log.delete('F')
+    assert log.max_depth == 2
+
+
+def test_thread_page_cursor():
+    log = make_log()
+    for index in range(5):
+        log.append(make_tweet(f'R{index}', 'erin'))
+    page, cursor = log.thread_page(limit=3)
+    assert [tweet.hash_id for tweet in page] == ['A', 'E', 'R0']
+    page, cursor = log.thread_page(cursor=cursor, limit=3)
+    assert [tweet.hash_id for tweet in page] == ['R1', 'R2', 'R3']
+    log.delete('R3')
+    log.delete('R4')
+    page, next_cursor = log.thread_page(cursor='R2', limit=3)
+    assert page == [] and next_cursor is None
+    # 已删除的游标由调用方按未知游标处理
+    with pytest.raises(KeyError):
+        log.thread_page(cursor='R3')
+
+    replies, cursor = log.thread_page('A', limit=1)
+    assert [tweet.hash_id for tweet in replies] == ['B'] and cursor == 'B'
+    replies, cursor = log.thread_page('A', cursor=cursor, limit=1)
+    assert [tweet.hash_id for tweet in replies] == ['D'] and cursor is None
@@ -1,10 +1,14 @@
+import bisect
 import json
 import hashlib
 import random
+from collections import defaultdict
 from config import get_depth
 
 
 class Tweet:
+    __slots__ = ('content', 'author', 'tweet_time', '_likes', 'hash_id', 'reply_to_hash_id', 'depth')
+
     def __init__(self, content, author, tweet_time, is_retweet=False, hash_id='no hash id input', depth=None):
         self.content = content
         self.author = author
@@ -14,13 +18,28 @@ class Tweet:
         self.reply_to_hash_id = None
         self.depth = depth if depth is not None else get_depth()
 
+    @property
+    def likes(self):
+        # 内部用 dict 作有序集合，对外仍是按点赞顺序排列的列表
+        return list(self._likes)
+
+    @likes.setter
+    def likes(self, user_names):
+        self._likes = dict.fromkeys(user_names)
+
+    def liked_by(self, user_name):
+        return user_name in self._likes
+
     def like(self, user_name):
-        if user_name not in self.likes:
-            self.likes.append(user_name)
+        # 已经点过赞时返回 False
+        if user_name in self._likes:
+            return False
+        self._likes[user_name] = None
+        return True
 
     @staticmethod
-    def generate_hash_id(content, tweet_time):
-        random_number = random.randint(0, 1000000)
+    def generate_hash_id(content, tweet_time, rng=random):
+        random_number = rng.randint(0, 1000000)
         hash_input = f"{content}{tweet_time}{random_number}".encode('utf-8')
         return hashlib.md5(hash_input).hexdigest()
 
@@ -56,3 +75,242 @@ class Tweet:
         with open(filename, 'r', encoding='utf-8') as f:
             data = json.load(f)
         return [Tweet.from_dict(tweet) for tweet in data]
+
+
+def _depth(tweet):
+    return tweet.depth if tweet.depth is not None else 0
+
+
+class TweetLog(list):
+    # 按发布顺序排列的推文，按 hash_id、父推文和作者索引，并维护线程树（根推文、各子树按深度的评论数）；
+    # 追加和 delete 增量更新索引，其他原地修改会重建。加入前须设置好 hash_id、reply_to_hash_id、author 和 depth
+
+    def __init__(self, tweets=()):
+        super().__init__(tweets)
+        self._reindex()
+
+    def _reindex(self):
+        self._by_hash_id = {}
+        self._children = defaultdict(list)
+        self._by_author = defaultdict(list)
+        # 线程索引：根推文及其序号（分页游标），各子树按深度统计的评论数
+        self._roots = []
+        self._root_seq = []
+        self._seq = {}
+        self._next_seq = 0
+        self._comment_counts = {}
+        self._duplicates = set()
+        # 各深度的推文数，删帖后仍能得到最大深度
+        self._depth_counts = {}
+        # 整体建索引时评论数最后自底向上统一计算，不逐条沿父链更新
+        for tweet in self:
+            self._index(tweet, update_counts=False)
+        self._count_all()
+
+    def _index(self, tweet, update_counts=True):
+        self._by_author[tweet.author].append(tweet)
+        self._add_counts(self._depth_counts, {_depth(tweet): 1}, 1)
+        if tweet.hash_id in self._by_hash_id:
+            # hash_id 重复时与原先的线性查找一致，取最早的那条；后来的不进入线程索引
+            self._duplicates.add(tweet.hash_id)
+            return
+        self._by_hash_id[tweet.hash_id] = tweet
+        self._seq[tweet.hash_id] = self._next_seq
+        self._next_seq += 1
+
+        # 父推文可能晚于回复加入，此时先统计已有的回复
+        counts = {}
+        if update_counts:
+            for child in self._children.get(tweet.hash_id, ()):
+                self._add_counts(counts, self._subtree_counts(child), 1)
+        self._comment_counts[tweet.hash_id] = counts
+        if tweet.reply_to_hash_id is None:
+            self._roots.append(tweet)
+            self._root_seq.append(self._seq[tweet.hash_id])
+        else:
+            self._children[tweet.reply_to_hash_id].append(tweet)
+            if update_counts:
+                self._update_ancestors(tweet, 1)
+
+    def _count_all(self):
+        # 后序遍历：子推文的子树统计完成后再累加到父推文；仍在栈上的推文说明有循环引用，跳过
+        done, on_stack = set(), set()
+        for hash_id in self._by_hash_id:
+            if hash_id in done:
+                continue
+            on_stack.add(hash_id)
+            stack = [(hash_id, iter(self._children.get(hash_id, ())))]
+            while stack:
+                parent_hash_id, children = stack[-1]
+                child = next(children, None)
+                if child is None:
+                    stack.pop()
+                    on_stack.discard(parent_hash_id)
+                    done.add(parent_hash_id)
+                    if stack:
+                        self._add_counts(self._comment_counts[stack[-1][0]],
+                                         self._subtree_counts(self._by_hash_id[parent_hash_id]), 1)
+                elif child.hash_id in done:
+                    self._add_counts(self._comment_counts[parent_hash_id], self._subtree_counts(child), 1)
+                elif child.hash_id not in on_stack:
+                    on_stack.add(child.hash_id)
+                    stack.append((child.hash_id, iter(self._children.get(child.hash_id, ()))))
+
+    @staticmethod
+    def _add_counts(counts, delta, sign):
+        for depth, count in delta.items():
+            counts[depth] = counts.get(depth, 0) + sign * count
+            if not counts[depth]:
+                del counts[depth]
+
+    def _subtree_counts(self, tweet):
+        # 推文自身加上它的全部回复
+        counts = dict(self._comment_counts[tweet.hash_id])
+        self._add_counts(counts, {_depth(tweet): 1}, 1)
+        return counts
+
+    def _update_ancestors(self, tweet, sign):
+        delta = self._subtree_counts(tweet)
+        parent_hash_id = tweet.reply_to_hash_id
+        seen = {tweet.hash_id}
+        # 沿父链向上，直到根推文或缺失的父推文；seen 防止错误数据中的循环引用
+        while parent_hash_id is not None and parent_hash_id in self._by_hash_id and parent_hash_id not in seen:
+            seen.add(parent_hash_id)
+            self._add_counts(self._comment_counts[parent_hash_id], delta, sign)
+            parent_hash_id = self._by_hash_id[parent_hash_id].reply_to_hash_id
+
+    @property
+    def max_depth(self):
+        return max(0, max(self._depth_counts, default=0))
+
+    def get(self, hash_id, default=None):
+        return self._by_hash_id.get(hash_id, default)
+
+    def children(self, hash_id):
+        return list(self._children.get(hash_id, ()))
+
+    def reply_count(self, hash_id):
+        return len(self._children.get(hash_id, ()))
+
+    def by_author(self, author):
+        return list(self._by_author.get(author, ()))
+
+    def comment_counts(self, hash_id):
+        # hash_id 下回复树中各深度的推文数
+        return dict(self._comment_counts.get(hash_id, {}))
+
+    def total_comments(self, hash_id):
+        return sum(self._comment_counts.get(hash_id, {}).values())
+
+    def thread_page(self, parent_hash_id=None, cursor=None, limit=20):
+        # 返回 cursor 之后的根推文（或 parent_hash_id 的直接回复）和下一页游标；未知游标抛出 KeyError
+        if parent_hash_id is None:
+            tweets, seqs = self._roots, self._root_seq
+        else:
+            tweets = self._children.get(parent_hash_id, [])
+            seqs = [self._seq[tweet.hash_id] for tweet in tweets]
+        start = 0 if cursor is None else bisect.bisect_right(seqs, self._seq[cursor])
+        page = tweets[start:start + limit]
+        next_cursor = page[-1].hash_id if page and start + limit < len(tweets) else None
+        return list(page), next_cursor
+
+    def delete(self, hash_id):
+        # 删除该 hash_id 的所有推文；它的回复留在日志中，但离开线程树
+        tweet = self._by_hash_id.get(hash_id)
+        if tweet is None:
+            return 0
+        if hash_id in self._duplicates:
+            # 重复的 hash_id 很少见，直接重建
+            kept = [other for other in self if other.hash_id != hash_id]
+            removed = len(self) - len(kept)
+            list.__init__(self, kept)
+            self._reindex()
+            return removed
+
+        if tweet.reply_to_hash_id is None:
+            position = bisect.bisect_left(self._root_seq, self._seq[hash_id])
+            del self._roots[position], self._root_seq[position]
+        else:
+            self._update_ancestors(tweet, -1)
+            self._children[tweet.reply_to_hash_id].remove(tweet)
+        list.remove(self, tweet)
+        self._by_author[tweet.author].remove(tweet)
+        self._add_counts(self._depth_counts, {_depth(tweet): 1}, -1)
+        del self._by_hash_id[hash_id], self._seq[hash_id], self._comment_counts[hash_id]
+        return 1
+
+    def append(self, tweet):
+        super().append(tweet)
+        self._index(tweet)
+
+    def extend(self, tweets):
+        for tweet in tweets:
+            self.append(tweet)
+
+    def __iadd__(self, tweets):
+        self.extend(tweets)
+        return self
+
+    def _mutating(name):
+        def method(self, *args, **kwargs):
+            result = getattr(list, name)(self, *args, **kwargs)
+            self._reindex()
+            return result
+
+        method.__name__ = name
+        return method
+
+    insert = _mutating('insert')
+    remove = _mutating('remove')
+    pop = _mutating('pop')
+    clear = _mutating('clear')
+    sort = _mutating('sort')
+    reverse = _mutating('reverse')
+    __setitem__ = _mutating('__setitem__')
+    __delitem__ = _mutating('__delitem__')
+    __imul__ = _mutating('__imul__')
+    del _mutating
+
+
+# 把推文字典组装成评论树供页面渲染，server 和 benchmark 共用
+def preprocess_tweets(tweets, individual_comment=False):
+    tweet_dict = {}
+    root_tweets = []
+    max_depth = 0
+
+    for tweet in tweets:
+        tweet['comments'] = []
+        tweet_dict[tweet['hash_id']] = tweet
+        if tweet['depth'] > max_depth:
+            max_depth = tweet['depth']
+
+    for tweet in tweets:
+        if not individual_comment:
+            if tweet['reply_to_hash_id'] is None:
+                root_tweets.append(tweet)
+            else:
+                parent_tweet = tweet_dict.get(tweet['reply_to_hash_id'])
+                if parent_tweet:
+                    parent_tweet['comments'].append(tweet)
+                else:
+                    print(f"Warning: Parent tweet with hash_id {tweet['reply_to_hash_id']} not found.")
+        else:
+            root_tweets.append(tweet)
+            if tweet['reply_to_hash_id'] is not None:
+                parent_tweet = tweet_dict.get(tweet['reply_to_hash_id'])
+                if parent_tweet:
+                    parent_tweet['comments'].append(tweet)
+                else:
+                    print(f"Warning: Parent tweet with hash_id {tweet['reply_to_hash_id']} not found.")
+
+    for tweet in root_tweets:
+        tweet['total_comments'] = count_comments(tweet)
+
+    return root_tweets, max_depth
+
+
+def count_comments(tweet):
+    total = len(tweet['comments'])
+    for comment in tweet['comments']:
+        total += count_comments(comment)
+    return total
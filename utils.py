@@ -1,64 +1,241 @@
 import json
-from collections import deque
+import random
+import threading
+from contextlib import contextmanager
 
 import numpy as np
-from sentence_transformers import SentenceTransformer
 
-from tweet import Tweet
-from config import get_depth
-from virtual_time import VirtualTime
+from embedding_model import get_embedding_service
+from embedding_store import LazyEmbedding
+from event_queue import EventQueue
+from tweet import Tweet, TweetLog
+from config import decision_mode, get_depth, text_tuning_mode
+from virtual_time import VirtualTime, from_epoch_minutes, to_epoch_minutes
 
 
 class Memory:
-    def __init__(self, content, importance, event_time, emotion_type=None, emotion_intensity=1, depth=None):
+    # 长时间模拟会产生大量记忆：不使用实例 __dict__，时间只保存整数分钟
+    __slots__ = ('content', '_importance', '_minutes', 'emotion_type', '_emotion_intensity', 'depth', '_embedding',
+                 '_stream', '_row', '__weakref__')
+
+    def __init__(self, content, importance, event_time, emotion_type=None, emotion_intensity=1, depth=None,
+                 embedding=None):
+        # 所属的 MemoryStream 及行号；检索相关字段修改时同步到检索数组
+        self._stream = None
+        self._row = None
         self.content = content
         self.importance = importance
         self.event_time = event_time
         self.emotion_type = emotion_type
         self.emotion_intensity = emotion_intensity
-        self.depth = get_depth()
+        self.depth = get_depth() if depth is None else depth
+
+        self.embedding = embedding
+        if embedding is None:
+            get_embedding_service().queue(self)
+
+    def _refresh_stream(self):
+        if self._stream is not None:
+            self._stream.refresh(self)
+
+    @property
+    def importance(self):
+        return self._importance
+
+    @importance.setter
+    def importance(self, value):
+        self._importance = value
+        self._refresh_stream()
+
+    @property
+    def event_time(self):
+        return from_epoch_minutes(self._minutes)
+
+    @event_time.setter
+    def event_time(self, value):
+        self._minutes = to_epoch_minutes(value)
+        self._refresh_stream()
+
+    @property
+    def minutes(self):
+        return self._minutes
 
-        self.update_embedding(SentenceTransformer('./Models/all-MiniLM-L6-v2'))
+    @property
+    def emotion_intensity(self):
+        return self._emotion_intensity
+
+    @emotion_intensity.setter
+    def emotion_intensity(self, value):
+        self._emotion_intensity = value
+        self._refresh_stream()
+
+    @property
+    def embedding(self):
+        if isinstance(self._embedding, LazyEmbedding):
+            # 不经过 setter：只是读出已存储的值，不算修改，检索数组由 MemoryStream 批量补齐
+            self._embedding = self._embedding.load()
+        if self._embedding is None and self._stream is not None:
+            # 加入 MemoryStream 后嵌入只保存在其矩阵中，这里返回只读视图
+            return self._stream.embedding_view(self)
+        return self._embedding
+
+    @embedding.setter
+    def embedding(self, value):
+        if value is not None and not isinstance(value, LazyEmbedding):
+            value = np.asarray(value, dtype=np.float32)
+        self._embedding = value
+        self._refresh_stream()
 
     def update_embedding(self, model):
         self.embedding = model.encode(self.content)
 
-    def to_dict(self):
-        return {
+    def to_dict(self, embedding_writer=None):
+        data = {
             'content': self.content,
             'importance': self.importance,
             'event_time': self.event_time,
             'emotion_type': self.emotion_type,
             'emotion_intensity': self.emotion_intensity,
-            'embedding': self.embedding.tolist() if self.embedding is not None else None,
             'depth': self.depth
         }
+        if embedding_writer is None:
+            data['embedding'] = self.embedding.tolist() if self.embedding is not None else None
+        elif self.embedding is not None:
+            # 嵌入写入 .npy 旁路文件，JSON 中只保留行号
+            data['embedding_row'] = embedding_writer.add(self.embedding)
+        return data
 
     @classmethod
-    def from_dict(cls, data):
+    def from_dict(cls, data, embedding_reader=None):
         global global_depth_flag
+        embedding = None
+        if data.get('embedding') is not None:
+            embedding = np.asarray(data['embedding'], dtype=np.float32)
+        elif embedding_reader is not None and 'embedding_row' in data:
+            embedding = LazyEmbedding(embedding_reader, data['embedding_row'])
         memory = cls(
             content=data['content'],
             importance=data['importance'],
             event_time=data['event_time'],
             emotion_type=data['emotion_type'],
             emotion_intensity=data['emotion_intensity'],
-            depth=data.get('depth', get_depth())
+            depth=data.get('depth', get_depth()),
+            embedding=embedding
         )
-        if data['embedding'] is not None:
-            memory.embedding = np.array(data['embedding'])
 
         return memory
 
 
 class GlobalContext:
     def __init__(self, event):
-        self.global_queue = deque()
-        self.tweet_log = []
+        self.global_queue = EventQueue()
+        self.tweet_log = TweetLog()
         self.event = event
         self.agents = []
         self.current_event_index = 0
         self.virtual_time = VirtualTime()
+        self.rng = random
+        # 每次运行可单独选择的生成方式
+        self.text_tuning_mode = text_tuning_mode
+        self.decision_mode = decision_mode
+        self.journal = None
+        # 深度快照：所属分支，以及内存中的状态对应哪一深度完成之后（未知时为 None）
+        self.snapshots = None
+        self.branch = 'main'
+        self.snapshot_depth = None
+        # 深度回退等整体性修改无法增量记录，下次保存时写完整快照
+        self.needs_full_save = False
+        # 并发模式下对 tweet_log、global_queue、virtual_time 和点赞的修改都经由下面的方法
+        self.lock = threading.RLock()
+        self._staging = threading.local()
+
+    @property
+    def tweet_log(self):
+        return self._tweet_log
+
+    @tweet_log.setter
+    def tweet_log(self, tweets):
+        # 整体替换（加载、按深度过滤、删帖）时重建索引
+        self._tweet_log = tweets if isinstance(tweets, TweetLog) else TweetLog(tweets)
+
+    @property
+    def global_queue(self):
+        return self._global_queue
+
+    @global_queue.setter
+    def global_queue(self, events):
+        # 加载、快照恢复时传入列表，按深度重新建索引
+        self._global_queue = events if isinstance(events, EventQueue) else EventQueue(events)
+
+    def get_tweet(self, hash_id):
+        return self._tweet_log.get(hash_id)
+
+    def _apply(self, change):
+        changes = getattr(self._staging, 'changes', None)
+        if changes is not None:
+            changes.append(change)
+        else:
+            with self.lock:
+                change()
+
+    @contextmanager
+    def staged_changes(self):
+        # 当前线程的修改先暂存，之后由 commit_changes 按确定的顺序提交
+        self._staging.changes = changes = []
+        try:
+            yield changes
+        finally:
+            self._staging.changes = None
+
+    def commit_changes(self, changes):
+        with self.lock:
+            for change in changes:
+                change()
+
+    def record(self, op, **fields):
+        if self.journal is not None:
+            self.journal.append(op, **fields)
+
+    def append_tweet(self, tweet):
+        with self.lock:
+            self.tweet_log.append(tweet)
+            self.record('tweet', tweet=tweet.to_dict())
+
+    def delete_tweet(self, hash_id):
+        # 删帖无法用追加日志表达，下次保存时写完整快照
+        with self.lock:
+            if self.tweet_log.delete(hash_id):
+                self.needs_full_save = True
+
+    def publish_tweet(self, tweet):
+        def change():
+            tweet.tweet_time = self.virtual_time.advance(rng=self.rng)
+            self.append_tweet(tweet)
+
+        self._apply(change)
+
+    def enqueue(self, event, left=False):
+        def change():
+            # 该深度的事件数已达上限时不入队，也不写日志
+            if self.global_queue.append(event, left=left):
+                self.record('enqueue', event=list(event), left=left)
+
+        self._apply(change)
+
+    def prune_queue(self, min_depth):
+        with self.lock:
+            # 日志记录实际保留的最小深度，回放时不依赖当时的保留配置
+            min_depth = self.global_queue.prune(min_depth)
+            if min_depth is not None:
+                self.record('prune_queue', min_depth=min_depth)
+
+    def like_tweet(self, hash_id, user_name):
+        def change():
+            tweet = self.get_tweet(hash_id)
+            if tweet is not None and tweet.like(user_name):
+                self.record('like', hash_id=hash_id, user=user_name)
+
+        self._apply(change)
 
     def save_global_queue(self, filename):
         with open(filename, 'w', encoding='utf-8') as f:
@@ -67,7 +244,7 @@ class GlobalContext:
     def load_global_queue(self, filename):
         with open(filename, 'r', encoding='utf-8') as f:
             data = json.load(f)
-        self.global_queue = deque(data)
+        self.global_queue = data
 
     def load_property(self, events=None, tweets=None):
         if events:
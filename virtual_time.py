@@ -1,6 +1,19 @@
 import json
 import random
 from datetime import datetime, timedelta
+from functools import lru_cache
+
+EPOCH = datetime(1970, 1, 1)
+
+
+@lru_cache(maxsize=4096)
+def to_epoch_minutes(time_str):
+    return (datetime.strptime(time_str, "%Y-%m-%d %H:%M") - EPOCH) // timedelta(minutes=1)
+
+
+@lru_cache(maxsize=4096)
+def from_epoch_minutes(minutes):
+    return (EPOCH + timedelta(minutes=minutes)).strftime("%Y-%m-%d %H:%M")
 
 
 class VirtualTime:
@@ -10,15 +23,18 @@ class VirtualTime:
         else:
             self.current_time = start_time
 
-    def advance(self, minutes=None):
+    def advance(self, minutes=None, rng=random):
         if minutes is None:
-            minutes = random.randint(3, 5)
+            minutes = rng.randint(3, 5)
         self.current_time += timedelta(minutes=minutes)
         return self.current_time.strftime("%Y-%m-%d %H:%M")
 
     def get_current_time(self):
         return self.current_time.strftime("%Y-%m-%d %H:%M")
 
+    def get_current_minutes(self):
+        return (self.current_time.replace(second=0, microsecond=0) - EPOCH) // timedelta(minutes=1)
+
     def to_dict(self):
         return {
             'current_time': self.current_time.strftime("%Y-%m-%d %H:%M:%S")